@@ -0,0 +1,355 @@
+"""
+File: memory_store.py
+Description: The columnar storage format of an associative memory.
+
+Originally, an associative memory was saved as nodes.json, a JSON object of
+every node, embeddings.json, every embedding as a list of JSON floats, and
+kw_strength.json. Loading it meant parsing all of them and replaying every
+node through add_event/add_thought/add_chat. In the columnar format, the
+associative_memory folder holds instead:
+  nodes.npy       -- the numeric columns of the nodes, a numpy structured
+                     array of NODE_COLUMNS with a row per node (the row of
+                     node_<n> is n - 1).
+  node_text.json  -- the text columns of the nodes, a JSON list with a list
+                     of TEXT_COLUMNS per node, in the same order.
+  embeddings.npy  -- the L2-normalized float32 embedding of every node, a
+                     row per node. It is memory-mapped when loaded, and only
+                     the rows that are used are ever read from the disk.
+  keywords.json   -- the keyword postings of the events, thoughts and chats
+                     (the node counts under every keyword, newest first) and
+                     the keyword strengths.
+The embeddings of the memory, keyed by their text, are then only rebuilt
+from embeddings.npy when they are looked up (see EmbeddingMap).
+
+AssociativeMemory loads a memory in either format and saves it in the
+format of <memory_format>. reverie/backend_server/convert_memory.py converts
+existing memories to the columnar format.
+
+The changes since the last full save are in the journal of the persona (see
+persona/memory_structures/memory_journal.py); read_memory reads the memory of
+a persona with its journal applied, without changing any file.
+"""
+import datetime
+import json
+import os
+import struct
+import zlib
+from collections.abc import MutableMapping
+
+import numpy
+
+# <NODE_TYPES> are the node types, in the order of their codes in nodes.npy.
+NODE_TYPES = ["event", "chat", "thought"]
+# <NODE_COLUMNS> are the numeric columns of nodes.npy. created and expiration
+# are in seconds since EPOCH (NO_EXPIRATION for no expiration), and
+# embedding_norm is the norm of the embedding before it was normalized.
+NODE_COLUMNS = numpy.dtype([("type", "u1"),
+                            ("type_count", "<i4"),
+                            ("depth", "<i4"),
+                            ("created", "<i8"),
+                            ("expiration", "<i8"),
+                            ("embedding_norm", "<f4")])
+# <TEXT_COLUMNS> are the columns of every row of node_text.json. The
+# embedding_key is null when it is the same as the description.
+TEXT_COLUMNS = ["subject", "predicate", "object", "description",
+                "embedding_key", "poignancy", "keywords", "filling"]
+EPOCH = datetime.datetime(1970, 1, 1)
+NO_EXPIRATION = numpy.iinfo(numpy.int64).min
+# <MEMORY_FILES> are the files of a memory in each format.
+MEMORY_FILES = {"json": ["nodes.json", "embeddings.json", "kw_strength.json"],
+                "columnar": ["nodes.npy", "node_text.json", "embeddings.npy",
+                             "keywords.json"]}
+# <JOURNAL_FILE> is the journal in the bootstrap_memory folder of a persona,
+# and <RECORD_HEADER> precedes every one of its records: the length and
+# CRC-32 of the payload.
+JOURNAL_FILE = "memory_journal.log"
+RECORD_HEADER = struct.Struct("<II")
+
+
+def is_columnar(folder):
+  """
+  Returns whether the associative memory in <folder> is in the columnar
+  format.
+  """
+  return os.path.exists(f"{folder}/nodes.npy")
+
+
+def to_seconds(time):
+  return int((time - EPOCH).total_seconds())
+
+
+def from_seconds(seconds):
+  return EPOCH + datetime.timedelta(seconds=int(seconds))
+
+
+def replace_file(file, write):
+  """
+  Writes <file> through a temporary file that replaces it once it is
+  complete, so that a memory-mapped <file> keeps its old content.
+
+  INPUT
+    file: The file to write.
+    write: A function that writes the content to the open file it is given.
+  OUTPUT
+    None
+  """
+  with open(file + ".tmp", "wb") as outfile:
+    write(outfile)
+  os.replace(file + ".tmp", file)
+
+
+def write_columns(folder, nodes, matrix, norms, postings):
+  """
+  Saves an associative memory in the columnar format.
+
+  INPUT
+    folder: The associative_memory folder.
+    nodes: The <ConceptNode>s of the memory, in the order of their node
+           counts.
+    matrix: The float32 matrix of the normalized embeddings of <nodes>, or
+            None if there are no nodes.
+    norms: The norms of the embeddings of <nodes> before they were
+           normalized.
+    postings: The keyword postings and strengths (see read_columns).
+  OUTPUT
+    None
+  """
+  table = numpy.zeros(len(nodes), dtype=NODE_COLUMNS)
+  text = []
+  for row, node in enumerate(nodes):
+    expiration = NO_EXPIRATION
+    if node.expiration:
+      expiration = to_seconds(node.expiration)
+    table[row] = (NODE_TYPES.index(node.type), node.type_count, node.depth,
+                  to_seconds(node.created), expiration, norms[row])
+    embedding_key = node.embedding_key
+    if embedding_key == node.description:
+      embedding_key = None
+    text += [[node.subject, node.predicate, node.object, node.description,
+              embedding_key, node.poignancy, list(node.keywords),
+              node.filling]]
+
+  if matrix is None:
+    matrix = numpy.zeros((0, 0), dtype=numpy.float32)
+  replace_file(f"{folder}/embeddings.npy",
+               lambda outfile: numpy.save(outfile, matrix[:len(nodes)]))
+  replace_file(f"{folder}/node_text.json",
+               lambda outfile: outfile.write(json.dumps(text).encode()))
+  replace_file(f"{folder}/keywords.json",
+               lambda outfile: outfile.write(json.dumps(postings).encode()))
+  replace_file(f"{folder}/nodes.npy",
+               lambda outfile: numpy.save(outfile, table))
+
+
+def read_columns(folder):
+  """
+  Loads an associative memory saved by write_columns.
+
+  INPUT
+    folder: The associative_memory folder.
+  OUTPUT
+    table: The structured array of the NODE_COLUMNS of every node.
+    text: The list of the TEXT_COLUMNS of every node.
+    matrix: The memory-mapped matrix of the normalized embeddings, or None
+            if there are no nodes.
+    postings: A dictionary of the keyword postings, "kw_to_event",
+              "kw_to_thought" and "kw_to_chat" (the node counts under every
+              keyword, newest first), and of the keyword strengths,
+              "kw_strength_event" and "kw_strength_thought".
+  """
+  table = numpy.load(f"{folder}/nodes.npy")
+  with open(f"{folder}/node_text.json") as json_file:
+    text = json.load(json_file)
+  with open(f"{folder}/keywords.json") as json_file:
+    postings = json.load(json_file)
+  matrix = None
+  if len(table):
+    matrix = numpy.load(f"{folder}/embeddings.npy", mmap_mode="r")
+  return table, text, matrix, postings
+
+
+def read_nodes(folder):
+  """
+  Returns the nodes of the associative memory in <folder>, in either format,
+  as the dictionary of nodes.json.
+  """
+  if not is_columnar(folder):
+    with open(f"{folder}/nodes.json") as json_file:
+      return json.load(json_file)
+
+  table = numpy.load(f"{folder}/nodes.npy")
+  with open(f"{folder}/node_text.json") as json_file:
+    text = json.load(json_file)
+  nodes = dict()
+  for row in range(len(table) - 1, -1, -1):
+    columns = dict(zip(TEXT_COLUMNS, text[row]))
+    expiration = None
+    if table["expiration"][row] != NO_EXPIRATION:
+      expiration = (from_seconds(table["expiration"][row])
+                    .strftime('%Y-%m-%d %H:%M:%S'))
+    nodes[f"node_{row + 1}"] = {
+      "node_count": row + 1,
+      "type_count": int(table["type_count"][row]),
+      "type": NODE_TYPES[table["type"][row]],
+      "depth": int(table["depth"][row]),
+      "created": (from_seconds(table["created"][row])
+                  .strftime('%Y-%m-%d %H:%M:%S')),
+      "expiration": expiration,
+      "subject": columns["subject"],
+      "predicate": columns["predicate"],
+      "object": columns["object"],
+      "description": columns["description"],
+      "embedding_key": columns["embedding_key"] or columns["description"],
+      "poignancy": columns["poignancy"],
+      "keywords": columns["keywords"],
+      "filling": columns["filling"]}
+  return nodes
+
+
+def read_journal(folder):
+  """
+  Reads the journal of the memory of a persona, up to the first record that
+  is incomplete or corrupt. The journal is left as it is.
+
+  INPUT
+    folder: The bootstrap_memory folder of the persona.
+  OUTPUT
+    records: The complete records, in order.
+    length: The length of the complete records, in bytes.
+  """
+  file = f"{folder}/{JOURNAL_FILE}"
+  if not os.path.exists(file):
+    return [], 0
+  with open(file, "rb") as journal_file:
+    data = journal_file.read()
+  records = []
+  offset = 0
+  while offset + RECORD_HEADER.size <= len(data):
+    length, checksum = RECORD_HEADER.unpack_from(data, offset)
+    start = offset + RECORD_HEADER.size
+    payload = data[start:start + length]
+    if len(payload) < length or zlib.crc32(payload) != checksum:
+      break
+    records += [json.loads(payload)]
+    offset = start + length
+  return records, offset
+
+
+def read_memory(folder):
+  """
+  Returns the memory of a persona as of its last save: the saved memory in
+  <folder>, with the changes of its journal applied.
+
+  INPUT
+    folder: The bootstrap_memory folder of the persona.
+  OUTPUT
+    scratch: The dictionary of scratch.json.
+    spatial: The tree of spatial_memory.json.
+    nodes: The nodes of the associative memory, as the dictionary of
+           nodes.json (see read_nodes).
+  """
+  with open(f"{folder}/scratch.json") as json_file:
+    scratch = json.load(json_file)
+  with open(f"{folder}/spatial_memory.json") as json_file:
+    spatial = json.load(json_file)
+  nodes = read_nodes(f"{folder}/associative_memory")
+
+  records = read_journal(folder)[0]
+  for record in records:
+    for node in record.get("nodes", []):
+      if node["node_count"] <= len(nodes):
+        continue
+      if node["node_count"] != len(nodes) + 1:
+        raise ValueError(f"{folder}/{JOURNAL_FILE} skips the nodes before "
+                         f"node_{node['node_count']}")
+      # The type count and depth are derived as in AssociativeMemory.add_*.
+      type_count = 1 + sum(1 for other in nodes.values()
+                           if other["type"] == node["type"])
+      depth = 0
+      if node["type"] == "thought":
+        depth = 1
+        filling = node["filling"] or []
+        if filling and all(i in nodes for i in filling):
+          depth += max(nodes[i]["depth"] for i in filling)
+      nodes[f"node_{node['node_count']}"] = {
+        "node_count": node["node_count"],
+        "type_count": type_count,
+        "type": node["type"],
+        "depth": depth,
+        "created": node["created"],
+        "expiration": node["expiration"],
+        "subject": node["subject"],
+        "predicate": node["predicate"],
+        "object": node["object"],
+        "description": node["description"],
+        "embedding_key": node["embedding_key"],
+        "poignancy": node["poignancy"],
+        "keywords": node["keywords"],
+        "filling": node["filling"]}
+    if "scratch" in record:
+      scratch.update(record["scratch"])
+    if "spatial" in record:
+      spatial = record["spatial"]
+  return scratch, spatial, nodes
+
+
+def remove_files(folder, memory_format):
+  """
+  Removes the files of the associative memory in <folder> that are in
+  <memory_format>, e.g., the files left behind by the other format.
+  """
+  for file in MEMORY_FILES[memory_format]:
+    if os.path.exists(f"{folder}/{file}"):
+      os.remove(f"{folder}/{file}")
+
+
+class EmbeddingMap(MutableMapping):
+  """
+  The embeddings of a memory loaded from the columnar format, keyed by their
+  text like the dictionary of embeddings.json. The embeddings of the loaded
+  nodes are only rebuilt from the rows of embeddings.npy when they are
+  looked up; the embeddings that are added later are kept as they are.
+  """
+  def __init__(self, keys, matrix, norms):
+    # <rows> is the row of <matrix> of every loaded embedding key, and
+    # <norms> the norm of every row before it was normalized. <added> holds
+    # the embeddings that were set since.
+    self.rows = {key: row for row, key in enumerate(keys)}
+    self.matrix = matrix
+    self.norms = norms
+    self.added = dict()
+
+
+  def __getitem__(self, key):
+    if key in self.added:
+      return self.added[key]
+    row = self.rows[key]
+    return (self.matrix[row].astype(numpy.float64)
+            * float(self.norms[row])).tolist()
+
+
+  def __setitem__(self, key, embedding):
+    self.added[key] = embedding
+
+
+  def __delitem__(self, key):
+    if key not in self.added and key not in self.rows:
+      raise KeyError(key)
+    self.added.pop(key, None)
+    self.rows.pop(key, None)
+
+
+  def __contains__(self, key):
+    return key in self.added or key in self.rows
+
+
+  def __iter__(self):
+    yield from self.rows
+    for key in self.added:
+      if key not in self.rows:
+        yield key
+
+
+  def __len__(self):
+    return len(self.rows) + sum(1 for key in self.added
+                                if key not in self.rows)
@@ -0,0 +1,52 @@
+"""
+File: step_channel.py
+Description: The frontend end of the step channel. The backend server
+(reverie/backend_server/step_channel.py) listens on a local socket and
+advertises its address in temp_storage/step_channel.json. Through it, the
+frontend pushes the environment of each step and receives the movements as
+soon as they are computed, instead of exchanging files.
+"""
+import json
+import socket
+
+from global_methods import *
+
+f_step_channel = "temp_storage/step_channel.json"
+
+
+def step_channel_request(sim_code, request, timeout=0):
+  """
+  Sends a single request to the backend's step channel and returns its
+  response.
+
+  ARGS:
+    sim_code: The simulation the request is about. The request is only sent
+              if the backend advertises a channel for that simulation.
+    request: The request dictionary (see the backend's step_channel.py).
+    timeout: The number of seconds the backend may hold the request before
+             responding.
+  RETURNS:
+    The response dictionary, or None if there is no channel to talk to (in
+    which case the caller should fall back to the files).
+  """
+  if not check_if_file_exists(f_step_channel):
+    return None
+  try:
+    with open(f_step_channel) as json_file:
+      address = json.load(json_file)
+    if address["sim_code"] != sim_code:
+      return None
+
+    request = dict(request, sim_code=sim_code)
+    with socket.create_connection((address["host"], address["port"]),
+                                  timeout=timeout + 5) as sock:
+      sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+      with sock.makefile("rb") as sock_file:
+        response = json.loads(sock_file.readline())
+  except (OSError, ValueError, KeyError):
+    # The backend is gone (or the address file is stale).
+    return None
+
+  if not response.get("ok"):
+    return None
+  return response
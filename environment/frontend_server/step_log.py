@@ -0,0 +1,230 @@
+"""
+File: step_log.py
+Description: Append-only logs of the environment and the movements of every
+step of a simulation.
+
+Originally, every step was saved as its own pretty-printed JSON file,
+storage/<sim_code>/environment/<step>.json and storage/<sim_code>/movement/
+<step>.json, so that a day of simulation left thousands of small files
+behind, and finding the last step meant listing the whole folder. Now the
+environment and movement folders each hold a step log instead, split into
+segments of SEGMENT_STEPS steps:
+  steps-<segment>.log -- the records of the steps, one after another. Each
+                         record is a RECORD_HEADER (the length of the
+                         payload and the step) followed by the compact JSON
+                         of the environment/movements.
+  steps-<segment>.idx -- the sidecar index: one INDEX_ENTRY per step of the
+                         segment, holding the offset of the step's record in
+                         the .log file plus one (0 for a step that is not in
+                         the log).
+Appending a step, reading any step and finding the last step only touch a
+couple of records, no matter how long the simulation is. A step that is
+written again (e.g., the frontend resending an environment) is appended
+anew and its index entry is pointed at the new record.
+
+Each log has a single writer at a time (the backend, or the frontend when
+there is no step channel), while the other server may read it concurrently:
+the record is flushed before its index entry, so readers never see a step
+before it is complete.
+
+The storage folders of older simulations, with one JSON file per step, are
+still read (see read_step). reverie/backend_server/convert_step_log.py
+converts them to step logs.
+"""
+import json
+import os
+import struct
+
+# <SEGMENT_STEPS> is the number of steps in each segment of a step log (a
+# day of simulation is 8640 steps).
+SEGMENT_STEPS = 1024
+# <RECORD_HEADER> precedes every record: the length of the payload and the
+# step of the record.
+RECORD_HEADER = struct.Struct("<IQ")
+# <INDEX_ENTRY> is the offset of a step's record plus one.
+INDEX_ENTRY = struct.Struct("<Q")
+
+
+class StepLog:
+  def __init__(self, folder):
+    # <folder> is the folder of the log, e.g., storage/<sim_code>/movement
+    # <segment> is the segment that <log> and <index> are open for writing.
+    self.folder = folder
+    self.segment = None
+    self.log = None
+    self.index = None
+
+
+  def segment_files(self, segment):
+    return (f"{self.folder}/steps-{segment}.log",
+            f"{self.folder}/steps-{segment}.idx")
+
+
+  def segments(self):
+    """
+    Returns the numbers of the segments of the log, in ascending order.
+    """
+    if not os.path.isdir(self.folder):
+      return []
+    segments = []
+    for i in os.listdir(self.folder):
+      if i.startswith("steps-") and i.endswith(".idx"):
+        segments += [int(i[len("steps-"):-len(".idx")])]
+    return sorted(segments)
+
+
+  def append(self, step, data):
+    """
+    Appends the environment or movements of <step> to the log.
+
+    INPUT
+      step: The step number.
+      data: The environment/movements dictionary.
+    OUTPUT
+      None
+    """
+    segment = step // SEGMENT_STEPS
+    if segment != self.segment:
+      self.close()
+      os.makedirs(self.folder, exist_ok=True)
+      log_file, index_file = self.segment_files(segment)
+      self.log = open(log_file, "ab")
+      self.index = open(index_file, "r+b" if os.path.exists(index_file)
+                                     else "w+b")
+      self.segment = segment
+
+    payload = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    self.log.seek(0, os.SEEK_END)
+    offset = self.log.tell()
+    self.log.write(RECORD_HEADER.pack(len(payload), step) + payload)
+    self.log.flush()
+    self.index.seek((step % SEGMENT_STEPS) * INDEX_ENTRY.size)
+    self.index.write(INDEX_ENTRY.pack(offset + 1))
+    self.index.flush()
+
+
+  def read(self, step):
+    """
+    Reads the environment or movements of <step> from the log.
+
+    INPUT
+      step: The step number.
+    OUTPUT
+      The environment/movements dictionary, or None if <step> is not in the
+      log.
+    """
+    log_file, index_file = self.segment_files(step // SEGMENT_STEPS)
+    try:
+      with open(index_file, "rb") as index:
+        index.seek((step % SEGMENT_STEPS) * INDEX_ENTRY.size)
+        entry = index.read(INDEX_ENTRY.size)
+      if len(entry) < INDEX_ENTRY.size:
+        return None
+      offset = INDEX_ENTRY.unpack(entry)[0] - 1
+      if offset < 0:
+        return None
+      with open(log_file, "rb") as log:
+        log.seek(offset)
+        length, record_step = RECORD_HEADER.unpack(
+                                log.read(RECORD_HEADER.size))
+        payload = log.read(length)
+    except (OSError, struct.error):
+      return None
+    if record_step != step or len(payload) < length:
+      return None
+    return json.loads(payload)
+
+
+  def last_step(self):
+    """
+    Returns the last step in the log, or None if the log is empty.
+    """
+    for segment in reversed(self.segments()):
+      _, index_file = self.segment_files(segment)
+      with open(index_file, "rb") as index:
+        entries = index.read()
+      for i in range(len(entries) // INDEX_ENTRY.size - 1, -1, -1):
+        if INDEX_ENTRY.unpack_from(entries, i * INDEX_ENTRY.size)[0]:
+          return segment * SEGMENT_STEPS + i
+    return None
+
+
+  def close(self):
+    if self.log:
+      self.log.close()
+      self.index.close()
+    self.segment = None
+    self.log = None
+    self.index = None
+
+
+def fork_folder(sim_folder, step):
+  """
+  Returns the folder of the simulation that <sim_folder> reads <step> from
+  if it is a layered fork (see reverie.py), i.e., if <step> is not after the
+  step it was forked at, and None otherwise.
+  """
+  try:
+    with open(f"{sim_folder}/reverie/meta.json") as json_file:
+      reverie_meta = json.load(json_file)
+  except (OSError, ValueError):
+    return None
+  if "fork_step" not in reverie_meta or step > reverie_meta["fork_step"]:
+    return None
+  return f"{os.path.dirname(sim_folder)}/{reverie_meta['fork_sim_code']}"
+
+
+def read_step(sim_folder, folder, step):
+  """
+  Reads the environment or movements of <step> of a simulation. A layered
+  fork only holds the steps it ran itself, so the steps up to its
+  <fork_step> are read from the simulation it was forked from (which may be
+  a layered fork itself). Simulations that still have one JSON file per step
+  are read as well.
+
+  INPUT
+    sim_folder: The folder of the simulation, e.g., storage/<sim_code>
+    folder: "environment" or "movement"
+    step: The step number.
+  OUTPUT
+    The environment/movements dictionary, or None if no simulation in the
+    fork chain has <step>.
+  """
+  while sim_folder:
+    data = StepLog(f"{sim_folder}/{folder}").read(step)
+    if data is not None:
+      return data
+    try:
+      with open(f"{sim_folder}/{folder}/{step}.json") as json_file:
+        return json.load(json_file)
+    except (OSError, ValueError):
+      pass
+    sim_folder = fork_folder(sim_folder, step)
+  return None
+
+
+def last_step(sim_folder, folder):
+  """
+  Returns the last step with an environment or movements in a simulation,
+  including the steps a layered fork reads from the simulation it was
+  forked from (see read_step), or None if there is none.
+  """
+  last = StepLog(f"{sim_folder}/{folder}").last_step()
+  if last is None and os.path.isdir(f"{sim_folder}/{folder}"):
+    for i in os.listdir(f"{sim_folder}/{folder}"):
+      if i.endswith(".json") and i.split(".")[0].isdigit():
+        last = max(-1 if last is None else last, int(i.split(".")[0]))
+
+  try:
+    with open(f"{sim_folder}/reverie/meta.json") as json_file:
+      reverie_meta = json.load(json_file)
+  except (OSError, ValueError):
+    return last
+  if "fork_step" in reverie_meta and (last is None
+                                     or last < reverie_meta["fork_step"]):
+    fork_last = last_step(f"{os.path.dirname(sim_folder)}/"
+                          f"{reverie_meta['fork_sim_code']}", folder)
+    if fork_last is not None:
+      fork_last = min(fork_last, reverie_meta["fork_step"])
+      last = fork_last if last is None else max(last, fork_last)
+  return last
@@ -13,6 +13,9 @@ import datetime
 from django.shortcuts import render, redirect, HttpResponseRedirect
 from django.http import HttpResponse, JsonResponse
 from global_methods import *
+from step_channel import *
+from step_log import StepLog, read_step, last_step
+from memory_store import read_memory
 
 from django.contrib.staticfiles.templatetags.staticfiles import static
 from .models import *
@@ -128,17 +131,12 @@ def home(request):
       persona_names_set.add(x)
 
   persona_init_pos = []
-  file_count = []
-  for i in find_filenames(f"storage/{sim_code}/environment", ".json"):
-    x = i.split("/")[-1].strip()
-    if x[0] != ".": 
-      file_count += [int(x.split(".")[0])]
-  curr_json = f'storage/{sim_code}/environment/{str(max(file_count))}.json'
-  with open(curr_json) as json_file:  
-    persona_init_pos_dict = json.load(json_file)
-    for key, val in persona_init_pos_dict.items(): 
-      if key in persona_names_set: 
-        persona_init_pos += [[key, val["x"], val["y"]]]
+  persona_init_pos_dict = read_step(f"storage/{sim_code}", "environment", 
+                                    last_step(f"storage/{sim_code}", 
+                                              "environment"))
+  for key, val in persona_init_pos_dict.items(): 
+    if key in persona_names_set: 
+      persona_init_pos += [[key, val["x"], val["y"]]]
 
   context = {"sim_code": sim_code,
              "step": step, 
@@ -162,17 +160,12 @@ def replay(request, sim_code, step):
       persona_names_set.add(x)
 
   persona_init_pos = []
-  file_count = []
-  for i in find_filenames(f"storage/{sim_code}/environment", ".json"):
-    x = i.split("/")[-1].strip()
-    if x[0] != ".": 
-      file_count += [int(x.split(".")[0])]
-  curr_json = f'storage/{sim_code}/environment/{str(max(file_count))}.json'
-  with open(curr_json) as json_file:  
-    persona_init_pos_dict = json.load(json_file)
-    for key, val in persona_init_pos_dict.items(): 
-      if key in persona_names_set: 
-        persona_init_pos += [[key, val["x"], val["y"]]]
+  persona_init_pos_dict = read_step(f"storage/{sim_code}", "environment", 
+                                    last_step(f"storage/{sim_code}", 
+                                              "environment"))
+  for key, val in persona_init_pos_dict.items(): 
+    if key in persona_names_set: 
+      persona_init_pos += [[key, val["x"], val["y"]]]
 
   context = {"sim_code": sim_code,
              "step": step,
@@ -193,14 +186,9 @@ def replay_persona_state(request, sim_code, step, persona_name):
   if not os.path.exists(memory): 
     memory = f"compressed_storage/{sim_code}/personas/{persona_name}/bootstrap_memory"
 
-  with open(memory + "/scratch.json") as json_file:  
-    scratch = json.load(json_file)
-
-  with open(memory + "/spatial_memory.json") as json_file:  
-    spatial = json.load(json_file)
-
-  with open(memory + "/associative_memory/nodes.json") as json_file:  
-    associative = json.load(json_file)
+  # The memory as of the last save, including the changes that are only in
+  # the journal of the persona. 
+  scratch, spatial, associative = read_memory(memory)
 
   a_mem_event = []
   a_mem_chat = []
@@ -242,8 +230,9 @@ def process_environment(request):
   """
   <FRONTEND to BACKEND> 
   This sends the frontend visual world information to the backend server. 
-  It does this by writing the current environment representation to 
-  "storage/environment.json" file. 
+  It does this by pushing the current environment representation through 
+  the backend's step channel, or, if the backend does not have one, by 
+  appending it to the environment step log of the simulation (step_log.py). 
 
   ARGS:
     request: Django request
@@ -259,8 +248,12 @@ def process_environment(request):
   sim_code = data["sim_code"]
   environment = data["environment"]
 
-  with open(f"storage/{sim_code}/environment/{step}.json", "w") as outfile:
-    outfile.write(json.dumps(environment, indent=2))
+  request = {"op": "push_environment", "step": step, 
+             "environment": environment}
+  if not step_channel_request(sim_code, request): 
+    step_log = StepLog(f"storage/{sim_code}/environment")
+    step_log.append(step, environment)
+    step_log.close()
 
   return HttpResponse("received")
 
@@ -270,8 +263,9 @@ def update_environment(request):
   <BACKEND to FRONTEND> 
   This sends the backend computation of the persona behavior to the frontend
   visual server. 
-  It does this by reading the new movement information from 
-  "storage/movement.json" file.
+  It does this by waiting on the backend's step channel for the new movement
+  information, or, if the backend does not have one, by reading it from the
+  movement step log of the simulation (step_log.py).
 
   ARGS:
     request: Django request
@@ -287,9 +281,18 @@ def update_environment(request):
   sim_code = data["sim_code"]
 
   response_data = {"<step>": -1}
-  if (check_if_file_exists(f"storage/{sim_code}/movement/{step}.json")):
-    with open(f"storage/{sim_code}/movement/{step}.json") as json_file: 
-      response_data = json.load(json_file)
+  # The channel holds on to the request until the movement is ready (or for 
+  # a couple of seconds, after which the frontend simply asks again). 
+  request = {"op": "pull_movement", "step": step, "timeout": 2}
+  channel_response = step_channel_request(sim_code, request, timeout=2)
+  if channel_response: 
+    if channel_response["movement"]: 
+      response_data = channel_response["movement"]
+      response_data["<step>"] = step
+  else: 
+    movement = read_step(f"storage/{sim_code}", "movement", step)
+    if movement: 
+      response_data = movement
       response_data["<step>"] = step
 
   return JsonResponse(response_data)
@@ -0,0 +1,545 @@
+"""
+File: benchmark.py
+Description: Measures the throughput of the simulation engine on synthetic
+worlds of growing size, to find where start_server and the cognitive stages
+(perceive, retrieve, new_retrieve, plan, reflect, execute, path_finder) stop
+scaling.
+
+For every persona count, a fresh process:
+  1) builds a synthetic maze in the Maze CSV format: a grid of houses, each
+     with a main room and a kitchen, walls, a door and a few game objects.
+  2) builds a synthetic simulation with that many personas. Every persona is
+     bootstrapped at the end of a short action at a game object somewhere in
+     the town, with <memory> associative memories and a day of short
+     activities, and reflects after a few new events. So, during the run,
+     the personas keep re-planning their next action, walking to it across
+     the town and reflecting on what they have perceived. They perceive,
+     remember and react to each other, but do not start conversations.
+  3) runs the steps headless, with the "fake" inference and embedding
+     backends (see persona/prompt_template/backends.py) and the tracer on.
+  4) reports the steps per second, the time per cognitive stage (from the
+     trace summary) and the peak RSS of the process.
+
+Usage (from reverie/backend_server, with your utils.py in place):
+  python benchmark.py
+  python benchmark.py --personas 3 25 100 500 --steps 20 --maze 140x100
+  python benchmark.py --personas 25 --latency 0.5 --concurrency 8
+
+Everything is written to a temporary folder; the storage of your simulations
+is not touched.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import utils
+from step_log import StepLog
+
+BLOCK_WIDTH = 14
+BLOCK_HEIGHT = 10
+WORLD = "bench town"
+START_TIME = datetime.datetime(2023, 2, 13, 9, 0, 0)
+# <ACTIVITY_MINUTES> are the durations of the activities of the day. They are
+# shorter than an hour, so that they are not decomposed (see
+# _determine_action).
+ACTIVITY_MINUTES = [5, 10, 15]
+STAGES = ["move", "perceive", "retrieve", "new_retrieve", "plan", "reflect",
+          "execute", "path_finder", "get_embedding"]
+
+FIRST_NAMES = ["Ada", "Ben", "Cleo", "Dan", "Eva", "Finn", "Gus", "Hana",
+               "Ivan", "Jade", "Kai", "Lena", "Milo", "Nora", "Omar", "Pia",
+               "Quinn", "Rosa", "Sam", "Tara", "Uri", "Vera", "Wes", "Yara"]
+LAST_NAMES = ["Abbott", "Baker", "Cruz", "Diaz", "Evans", "Fox", "Gray",
+              "Hill", "Ito", "Jones", "Khan", "Lee", "Moss", "Nash", "Ortiz",
+              "Park", "Reed", "Shaw", "Tran", "Vance", "Webb", "Young"]
+ACTIVITIES = ["reading a book", "cooking lunch", "writing a letter",
+              "fixing the sink", "painting a picture", "studying for a test",
+              "drinking coffee", "cleaning the table", "playing the piano",
+              "talking on the phone"]
+
+
+def build_maze(folder, width, height):
+  """
+  Writes a synthetic maze in the Maze CSV format (see maze.py).
+
+  INPUT
+    folder: The matrix folder to write, the equivalent of <env_matrix>.
+    width, height: The size of the maze in tiles. The houses are laid out in
+                   a grid of BLOCK_WIDTH x BLOCK_HEIGHT blocks.
+  OUTPUT
+    The houses as a list of (sector, {arena: [game objects]}, spawn tile).
+  """
+  collision_id = str(utils.collision_block_id)
+  layers = {name: [["0"] * width for _ in range(height)]
+            for name in ["collision", "sector", "arena", "game_object",
+                         "spawning_location"]}
+  blocks = {name: [] for name in ["sector", "arena", "game_object",
+                                  "spawning_location"]}
+  next_id = [40000]
+  def new_id():
+    next_id[0] += 1
+    return str(next_id[0])
+
+  object_ids = dict()
+  def place_object(name, tiles):
+    if name not in object_ids:
+      object_ids[name] = new_id()
+      blocks["game_object"] += [[object_ids[name], WORLD, "<all>", name]]
+    for x, y in tiles:
+      layers["game_object"][y][x] = object_ids[name]
+
+  houses = []
+  for by in range(0, height - BLOCK_HEIGHT + 1, BLOCK_HEIGHT):
+    for bx in range(0, width - BLOCK_WIDTH + 1, BLOCK_WIDTH):
+      sector = f"house {len(houses) + 1}"
+      sector_id = new_id()
+      blocks["sector"] += [[sector_id, WORLD, sector]]
+      # The house is surrounded by a street, and its walls have a door at
+      # the bottom of the main room and a gap between its two rooms.
+      x0, y0 = bx + 1, by + 1
+      x1, y1 = bx + BLOCK_WIDTH - 2, by + BLOCK_HEIGHT - 2
+      divider = bx + BLOCK_WIDTH // 2
+      for y in range(y0, y1 + 1):
+        for x in range(x0, x1 + 1):
+          layers["sector"][y][x] = sector_id
+          if x in [x0, x1, divider] or y in [y0, y1]:
+            layers["collision"][y][x] = collision_id
+      layers["collision"][y1][x0 + 3] = "0"
+      layers["collision"][y1 - 2][divider] = "0"
+
+      arenas = dict()
+      for arena, ax0, ax1 in [["main room", x0 + 1, divider - 1],
+                              ["kitchen", divider + 1, x1 - 1]]:
+        arena_id = new_id()
+        blocks["arena"] += [[arena_id, WORLD, sector, arena]]
+        for y in range(y0 + 1, y1):
+          for x in range(ax0, ax1 + 1):
+            layers["arena"][y][x] = arena_id
+        arenas[arena] = []
+      place_object("bed", [(x0 + 1, y0 + 1), (x0 + 2, y0 + 1)])
+      place_object("desk", [(x0 + 4, y0 + 1)])
+      place_object("stove", [(divider + 2, y0 + 1), (divider + 3, y0 + 1)])
+      place_object("table", [(divider + 2, y1 - 2), (divider + 3, y1 - 2)])
+      arenas["main room"] = ["bed", "desk"]
+      arenas["kitchen"] = ["stove", "table"]
+
+      spawn_id = new_id()
+      spawn = (x0 + 2, y1 - 1)
+      blocks["spawning_location"] += [[spawn_id, WORLD, sector, "main room",
+                                       "sp-A"]]
+      layers["spawning_location"][spawn[1]][spawn[0]] = spawn_id
+      houses += [(sector, arenas, spawn)]
+
+  os.makedirs(f"{folder}/maze", exist_ok=True)
+  os.makedirs(f"{folder}/special_blocks", exist_ok=True)
+  with open(f"{folder}/maze_meta_info.json", "w") as outfile:
+    outfile.write(json.dumps({"world_name": WORLD,
+                              "maze_width": width,
+                              "maze_height": height,
+                              "sq_tile_size": 32,
+                              "special_constraint": ""}, indent=2))
+  with open(f"{folder}/special_blocks/world_blocks.csv", "w") as outfile:
+    outfile.write(f"{new_id()}, {WORLD}\n")
+  for name, rows in blocks.items():
+    with open(f"{folder}/special_blocks/{name}_blocks.csv", "w") as outfile:
+      for row in rows:
+        outfile.write(", ".join(row) + "\n")
+  for name, layer in layers.items():
+    with open(f"{folder}/maze/{name}_maze.csv", "w") as outfile:
+      outfile.write(", ".join(i for row in layer for i in row))
+  return houses
+
+
+def build_simulation(folder, houses, n_personas, memory, rng):
+  """
+  Writes a synthetic simulation (the equivalent of a base simulation in
+  storage) with <n_personas> personas living in <houses>.
+
+  INPUT
+    folder: The simulation folder to write.
+    houses: The houses returned by build_maze.
+    n_personas: The number of personas.
+    memory: The number of associative memories every persona starts with.
+    rng: The random.Random the world is drawn from.
+  OUTPUT
+    None
+  """
+  from persona.prompt_template.embedding import get_embedding
+
+  names = [f"{FIRST_NAMES[i % len(FIRST_NAMES)]} "
+           f"{LAST_NAMES[i // len(FIRST_NAMES) % len(LAST_NAMES)]}"
+           + (f" {i // (len(FIRST_NAMES) * len(LAST_NAMES)) + 1}"
+              if i >= len(FIRST_NAMES) * len(LAST_NAMES) else "")
+           for i in range(n_personas)]
+  tree = {WORLD: {sector: {arena: objects[:]
+                           for arena, objects in arenas.items()}
+                  for sector, arenas, spawn in houses}}
+
+  # The personas go to different game objects as far as there are enough of
+  # them, so that they do not queue for the same one.
+  targets = [f"{WORLD}:{sector}:{arena}:{game_object}"
+             for sector, arenas, spawn in houses
+             for arena, objects in arenas.items()
+             for game_object in objects]
+  rng.shuffle(targets)
+
+  environment = dict()
+  for count, name in enumerate(names):
+    home, home_arenas, spawn = houses[count % len(houses)]
+    act_address = targets[count % len(targets)]
+    activity = rng.choice(ACTIVITIES)
+    # The day is spent asleep until START_TIME, and then on short activities
+    # until midnight.
+    start = START_TIME.hour * 60 + START_TIME.minute
+    schedule = [["sleeping", start]]
+    while start < 24 * 60:
+      duration = min(rng.choice(ACTIVITY_MINUTES), 24 * 60 - start)
+      schedule += [[rng.choice(ACTIVITIES), duration]]
+      start += duration
+    environment[name] = {"maze": "bench", "x": spawn[0], "y": spawn[1]}
+
+    scratch = {
+      "vision_r": 8, "att_bandwidth": 8, "retention": 8,
+      "curr_time": START_TIME.strftime("%B %d, %Y, %H:%M:%S"),
+      "curr_tile": None,
+      "daily_plan_req": f"{name} spends the day {activity}.",
+      "name": name,
+      "first_name": name.split()[0],
+      "last_name": name.split()[1],
+      "age": rng.randint(20, 70),
+      "innate": "curious, friendly, patient",
+      "learned": f"{name} lives in {home}.",
+      "currently": f"{name} is {activity}.",
+      "lifestyle": f"{name} goes to bed around 11pm, awakes up around 7am.",
+      "living_area": f"{WORLD}:{home}:main room",
+      "concept_forget": 100, "daily_reflection_time": 180,
+      "daily_reflection_size": 5, "overlap_reflect_th": 4,
+      "kw_strg_event_reflect_th": 10, "kw_strg_thought_reflect_th": 9,
+      "recency_w": 1, "relevance_w": 1, "importance_w": 1,
+      "recency_decay": 0.995,
+      # A low trigger makes the personas reflect every few events.
+      "importance_trigger_max": 15, "importance_trigger_curr": 15,
+      "importance_ele_n": 0, "thought_count": 5,
+      "daily_req": [f"{activity} from 9am to midnight"],
+      "f_daily_schedule": schedule,
+      "f_daily_schedule_hourly_org": schedule,
+      # The action ends within the first minutes of the run, after which
+      # the persona plans its next one from the schedule.
+      "act_address": act_address,
+      "act_start_time": START_TIME.strftime("%B %d, %Y, %H:%M:%S"),
+      "act_duration": rng.randint(1, 3),
+      "act_description": activity,
+      "act_pronunciatio": "🙂",
+      "act_event": [name, "is", activity],
+      "act_obj_description": "being used",
+      "act_obj_pronunciatio": "🙂",
+      "act_obj_event": [act_address, "is", "being used"],
+      "chatting_with": None, "chat": None,
+      # The conversations are left out (as if everybody had just talked to
+      # everybody else): they still depend on the hourly schedule format
+      # that the prompts are being migrated away from.
+      "chatting_with_buffer": {other: 10**9 for other in names
+                               if other != name},
+      "chatting_end_time": None,
+      "act_path_set": False, "planned_path": []
+    }
+
+    # The memories are events and thoughts about the other personas, spread
+    # over the last week.
+    nodes = dict()
+    embeddings = dict()
+    for i in range(memory):
+      other = rng.choice(names)
+      other_activity = rng.choice(ACTIVITIES)
+      node_type = "thought" if i % 5 == 4 else "event"
+      description = (f"{other} is {other_activity}" if node_type == "event"
+                     else f"{other} seems to enjoy {other_activity}")
+      if description not in embeddings:
+        embeddings[description] = list(get_embedding(description))
+      created = START_TIME - datetime.timedelta(
+        minutes=(memory - i) * 7 * 24 * 60 // max(memory, 1))
+      nodes[f"node_{i + 1}"] = {
+        "node_count": i + 1, "type_count": i + 1, "type": node_type,
+        "depth": 0 if node_type == "event" else 1,
+        "created": created.strftime("%Y-%m-%d %H:%M:%S"),
+        "expiration": None,
+        "subject": other, "predicate": "is", "object": other_activity,
+        "description": description, "embedding_key": description,
+        "poignancy": rng.randint(1, 9),
+        "keywords": [other, other_activity], "filling": []
+      }
+
+    memory_folder = f"{folder}/personas/{name}/bootstrap_memory"
+    os.makedirs(f"{memory_folder}/associative_memory", exist_ok=True)
+    with open(f"{memory_folder}/scratch.json", "w") as outfile:
+      outfile.write(json.dumps(scratch, indent=2))
+    with open(f"{memory_folder}/spatial_memory.json", "w") as outfile:
+      outfile.write(json.dumps(tree, indent=2))
+    with open(f"{memory_folder}/associative_memory/nodes.json", "w") as outfile:
+      outfile.write(json.dumps(nodes))
+    with open(f"{memory_folder}/associative_memory/embeddings.json", "w") as outfile:
+      outfile.write(json.dumps(embeddings))
+    with open(f"{memory_folder}/associative_memory/kw_strength.json", "w") as outfile:
+      outfile.write(json.dumps({"kw_strength_event": {},
+                                "kw_strength_thought": {}}))
+
+  os.makedirs(f"{folder}/reverie", exist_ok=True)
+  with open(f"{folder}/reverie/meta.json", "w") as outfile:
+    outfile.write(json.dumps({
+      "fork_sim_code": "bench_base",
+      "start_date": START_TIME.strftime("%B %d, %Y"),
+      "curr_time": START_TIME.strftime("%B %d, %Y, %H:%M:%S"),
+      "sec_per_step": 10,
+      "maze_name": "bench",
+      "persona_names": names,
+      "step": 0
+    }, indent=2))
+  step_log = StepLog(f"{folder}/environment")
+  step_log.append(0, environment)
+  step_log.close()
+
+
+def load_schedules(personas):
+  """
+  Turns the [task, duration] rows of the schedules that the personas have
+  loaded into the <HourlyScheduleItem>s that _determine_action reads. The
+  scratch still saves and loads the rows, as the planner is being migrated
+  to the items.
+
+  INPUT
+    personas: The dictionary of the <Persona>s of the server.
+  OUTPUT
+    None
+  """
+  from persona.common import HourlyScheduleItem
+
+  for persona in personas.values():
+    schedule = []
+    start = 0
+    for task, duration in persona.scratch.f_daily_schedule:
+      schedule += [HourlyScheduleItem(task, start, duration)]
+      start += duration
+    persona.scratch.f_daily_schedule = schedule
+    persona.scratch.f_daily_schedule_hourly_org = schedule[:]
+
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == "darwin":
+    return peak / 2**20
+  return peak / 2**10
+
+
+def run(args, n_personas):
+  """
+  Runs the benchmark of one persona count in the current process. The
+  settings below override utils.py, so they have to be in place before the
+  engine is imported.
+
+  INPUT
+    args: The command line arguments.
+    n_personas: The number of personas.
+  OUTPUT
+    A dictionary with the results.
+  """
+  workdir = tempfile.mkdtemp(prefix="reverie-bench-", dir=args.workdir)
+  width, height = [int(i) for i in args.maze.lower().split("x")]
+  utils.env_matrix = f"{workdir}/matrix"
+  utils.fs_storage = f"{workdir}/storage"
+  utils.fs_temp_storage = f"{workdir}/temp_storage"
+  utils.inference_backend = "fake"
+  utils.embedding_backend = "fake"
+  utils.fake_inference_latency = args.latency
+  utils.fake_embedding_dim = args.embedding_dim
+  # Some of the prompts of _determine_action are still deprecated ones, which
+  # otherwise stop the run.
+  utils.inference_deprecated_override = True
+  utils.trace_enabled = True
+  utils.cassette_mode = None
+  utils.headless = True
+  utils.step_audit_log = False
+  utils.skip_quiet_steps = args.skip_quiet_steps
+  utils.cooperative_paths = args.cooperative_paths
+  utils.concurrent_personas = args.concurrency
+  utils.random_seed = args.seed
+  os.makedirs(utils.fs_storage)
+  os.makedirs(utils.fs_temp_storage)
+
+  result = {"personas": n_personas, "maze": args.maze,
+            "memory": args.memory, "steps": args.steps}
+  try:
+    rng = random.Random(args.seed)
+    houses = build_maze(utils.env_matrix, width, height)
+    build_simulation(f"{utils.fs_storage}/bench_base", houses, n_personas,
+                     args.memory, rng)
+    result["houses"] = len(houses)
+
+    from reverie import ReverieServer
+
+    start = time.perf_counter()
+    rs = ReverieServer("bench_base", "bench_run")
+    result["load_s"] = time.perf_counter() - start
+    load_schedules(rs.personas)
+
+    # The inference strategies find the server through the event loop, just
+    # like in open_server_in_event_loop.
+    rs.loop = asyncio.new_event_loop()
+    rs.loop.reverie_server = rs
+    asyncio.set_event_loop(rs.loop)
+
+    start = time.perf_counter()
+    try:
+      rs.start_server(args.steps, headless=True)
+    except Exception as e:
+      traceback.print_exc()
+      result["error"] = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+    rs.loop.close()
+    rs.close()
+    steps = rs.step
+    result["steps_run"] = steps
+    result["run_s"] = elapsed
+    result["steps_per_s"] = steps / elapsed if elapsed and steps else 0
+    result["path_cache"] = rs.maze.path_cache.metrics()
+
+    # The trace summary has one row per step, persona and stage.
+    stages = dict()
+    summary_file = f"{utils.fs_storage}/bench_run/trace/summary.csv"
+    with open(summary_file) as csv_file:
+      for row in csv.DictReader(csv_file):
+        stage = stages.setdefault(row["stage"], {"calls": 0, "wall_ms": 0,
+                                                 "llm_calls": 0})
+        stage["calls"] += int(row["calls"])
+        stage["wall_ms"] += float(row["wall_ms"])
+        stage["llm_calls"] += int(row["llm_calls"])
+    for stage in stages.values():
+      stage["ms_per_step"] = stage["wall_ms"] / max(steps, 1)
+    result["stages"] = stages
+  finally:
+    result["peak_rss_mb"] = peak_rss_mb()
+    if not args.keep:
+      shutil.rmtree(workdir, ignore_errors=True)
+    else:
+      result["workdir"] = workdir
+  return result
+
+
+def print_results(results):
+  header = (["personas", "steps/s", "load s", "peak RSS MB", "paths",
+             "path hits %"]
+            + [f"{stage} ms" for stage in STAGES])
+  rows = []
+  for result in results:
+    stages = result.get("stages", {})
+    path_cache = result.get("path_cache", {})
+    rows += [[str(result["personas"]),
+              f"{result.get('steps_per_s', 0):.2f}",
+              f"{result.get('load_s', 0):.1f}",
+              f"{result.get('peak_rss_mb', 0):.0f}",
+              str(path_cache.get("hits", 0) + path_cache.get("misses", 0)),
+              f"{100 * path_cache.get('hit_rate', 0):.0f}"]
+             + [f"{stages[stage]['ms_per_step']:.2f}" if stage in stages
+                else "-" for stage in STAGES]]
+  widths = [max(len(row[i]) for row in rows + [header])
+            for i in range(len(header))]
+  print ("Stage times are per step, summed over the personas; paths are the "
+         "path searches, found or cached.")
+  for row in [header] + rows:
+    print ("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+  for result in results:
+    if "error" in result:
+      print (f"{result['personas']} personas stopped at step "
+             f"{result.get('steps_run')}: {result['error']}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--personas", type=int, nargs="+",
+                      default=[3, 25, 100, 500],
+                      help="The persona counts to benchmark.")
+  parser.add_argument("--steps", type=int, default=20,
+                      help="The number of steps to run.")
+  parser.add_argument("--maze", default="140x100",
+                      help="The size of the synthetic maze, in tiles.")
+  parser.add_argument("--memory", type=int, default=50,
+                      help="The number of bootstrap memories per persona.")
+  parser.add_argument("--embedding-dim", type=int, default=768)
+  parser.add_argument("--latency", type=float, default=0,
+                      help="The latency of every fake LLM call, in seconds.")
+  parser.add_argument("--concurrency", type=int, default=1,
+                      help="The <concurrent_personas> setting.")
+  parser.add_argument("--skip-quiet-steps", action="store_true")
+  parser.add_argument("--cooperative-paths", action="store_true",
+                      help="Plan the paths around each other.")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--workdir", default=None,
+                      help="Where the temporary worlds are created.")
+  parser.add_argument("--keep", action="store_true",
+                      help="Keep the temporary worlds.")
+  parser.add_argument("--out", default=None,
+                      help="A JSON file to write the results to.")
+  parser.add_argument("--run", type=int, default=None,
+                      help=argparse.SUPPRESS)
+  parser.add_argument("--result", default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.workdir:
+    args.workdir = os.path.abspath(args.workdir)
+    os.makedirs(args.workdir, exist_ok=True)
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+  if args.run is not None:
+    # A child process: the engine's own output goes to the log, and the
+    # results to the result file.
+    result = run(args, args.run)
+    with open(args.result, "w") as outfile:
+      outfile.write(json.dumps(result))
+    return
+
+  # Every persona count runs in its own process, so that the peak RSS and
+  # the caches of one run do not leak into the next.
+  results = []
+  for n_personas in args.personas:
+    print (f"Benchmarking {n_personas} personas ...", flush=True)
+    with tempfile.TemporaryDirectory() as folder:
+      command = [sys.executable, __file__, "--run", str(n_personas),
+                 "--result", f"{folder}/result.json",
+                 "--steps", str(args.steps), "--maze", args.maze,
+                 "--memory", str(args.memory),
+                 "--embedding-dim", str(args.embedding_dim),
+                 "--latency", str(args.latency),
+                 "--concurrency", str(args.concurrency),
+                 "--seed", str(args.seed)]
+      command += ["--skip-quiet-steps"] if args.skip_quiet_steps else []
+      command += ["--cooperative-paths"] if args.cooperative_paths else []
+      command += ["--keep"] if args.keep else []
+      command += ["--workdir", args.workdir] if args.workdir else []
+      with open(f"{folder}/log.txt", "w") as log:
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+      if not os.path.exists(f"{folder}/result.json"):
+        with open(f"{folder}/log.txt") as log:
+          print ("".join(log.readlines()[-20:]))
+        results += [{"personas": n_personas, "error": "the run crashed"}]
+        continue
+      with open(f"{folder}/result.json") as json_file:
+        results += [json.load(json_file)]
+
+  print_results(results)
+  if args.out:
+    with open(args.out, "w") as outfile:
+      outfile.write(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
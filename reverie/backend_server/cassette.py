@@ -0,0 +1,269 @@
+"""
+File: cassette.py
+Description: Records every LLM call, embedding and random seed of a
+simulation into a cassette file, and replays them later.
+
+Set <cassette_mode> in utils.py to:
+  "record" -- the simulation runs as usual, and every prompt and response
+              (of both the InferenceStrategy chains and the legacy
+              safe_generate_response paths), every embedding and the random
+              seeds of the personas are appended to the cassette.
+  "replay" -- the answers are read back from the cassette instead of being
+              inferred, so that the simulation repeats the recorded run
+              exactly, without any model. This is what we profile the engine
+              with.
+The cassette is <cassette_file> (by default storage/cassette.jsonl). It is
+opened as soon as this module is imported, since the InferenceStrategy
+example selectors already embed their examples at import time. To replay a
+recording, fork the simulation the recording started from again and run the
+same commands.
+
+The cassette is a JSON-lines file, one record per line:
+  {"kind": "llm", "key": ..., "model": ..., "messages": ..., "content": ...}
+  {"kind": "embedding", "key": ..., "text": ..., "embedding": ..., ...}
+  {"kind": "seed", "key": ..., "seed": ...}
+The sidecar <cassette_file>.index maps every key to the byte offsets of its
+records, in the order they were recorded, so that a replay only reads the
+records it needs. When the index is missing (e.g., the recording was
+interrupted), it is rebuilt from the cassette.
+
+A prompt that is sent more than once (e.g., a retry) is answered with its
+recorded responses in order. Note that with <concurrent_personas> above 1,
+two personas sending the very same prompt in the same step may swap their
+answers.
+"""
+import atexit
+import hashlib
+import json
+import os
+import threading
+
+import numpy
+from typing import Any, List, Optional
+from langchain.schema import AIMessage, BaseMessage
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import utils as config
+
+cassette_mode = getattr(config, "cassette_mode", None)
+
+
+class CassetteMiss(KeyError):
+  """
+  Raised when a replay asks for something that was never recorded, i.e.,
+  the replayed run diverged from the recorded one.
+  """
+  pass
+
+
+class Cassette:
+  def __init__(self):
+    # <mode> is "record", "replay" or None (the cassette is not in use).
+    # <index> maps the key of every record to the offsets of its lines.
+    # <uses> counts how many times each key was asked for so far, so that
+    # repeated prompts get their recorded responses in order.
+    self.mode = None
+    self.file = None
+    self.index = dict()
+    self.uses = dict()
+    self.lock = threading.Lock()
+    self.data = None
+
+
+  def open(self, file, mode):
+    """
+    Opens the cassette for recording or replaying. A recording replaces the
+    cassette of a previous run in the same file.
+
+    INPUT
+      file: The cassette file, e.g., storage/<sim_code>/cassette.jsonl
+      mode: "record" or "replay"
+    OUTPUT
+      None
+    """
+    if mode not in ["record", "replay"]:
+      raise ValueError(f"Unknown cassette mode: {mode}")
+    self.file = file
+    self.mode = mode
+    self.index = dict()
+    self.uses = dict()
+
+    if mode == "record":
+      os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+      self.data = open(file, "wb")
+      return
+
+    self.data = open(file, "rb")
+    index_file = f"{file}.index"
+    if (os.path.exists(index_file)
+        and os.path.getmtime(index_file) >= os.path.getmtime(file)):
+      with open(index_file) as json_file:
+        self.index = json.load(json_file)
+    else:
+      offset = 0
+      for line in self.data:
+        self.index.setdefault(json.loads(line)["key"], []).append(offset)
+        offset += len(line)
+      self.save_index()
+    print (f"Replaying {sum(len(i) for i in self.index.values())} records "
+           f"from {file}")
+
+
+  def save_index(self):
+    if self.mode == "record":
+      with self.lock:
+        self.data.flush()
+    with open(f"{self.file}.index", "w") as outfile:
+      outfile.write(json.dumps(self.index))
+
+
+  def close(self):
+    if not self.mode:
+      return
+    if self.mode == "record":
+      self.save_index()
+    self.data.close()
+    self.mode = None
+
+
+  def record(self, record):
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    with self.lock:
+      self.index.setdefault(record["key"], []).append(self.data.tell())
+      self.data.write(line)
+
+
+  def lookup(self, key):
+    """
+    Returns the next recorded record of <key>.
+    """
+    with self.lock:
+      use = self.uses.get(key, 0)
+      offsets = self.index.get(key, [])
+      if use >= len(offsets):
+        raise CassetteMiss(f"{key} (use {use + 1}) is not in {self.file}")
+      self.uses[key] = use + 1
+      self.data.seek(offsets[use])
+      return json.loads(self.data.readline())
+
+
+  def seed(self, name, seed):
+    """
+    Returns the seed to use for <name>: the recorded one when replaying,
+    and <seed> otherwise (which is recorded when recording).
+
+    INPUT
+      name: What the seed is for, e.g., "Isabella Rodriguez:12".
+      seed: The seed the simulation would use.
+    OUTPUT
+      The seed.
+    """
+    key = f"seed:{name}"
+    if self.mode == "replay":
+      return self.lookup(key)["seed"]
+    if self.mode == "record":
+      self.record({"kind": "seed", "key": key, "seed": seed})
+    return seed
+
+
+  def embedding(self, embed):
+    """
+    Wraps an embedding backend so that its embeddings are recorded or
+    replayed. Embeddings keep their numpy dtype, so that the similarities
+    computed from replayed embeddings are exactly the recorded ones.
+    """
+    def recorded_embed(text, *args, **kwargs):
+      if not self.mode:
+        return embed(text, *args, **kwargs)
+      if self.mode == "replay":
+        return self.replay_embedding(text)
+      embedding = embed(text, *args, **kwargs)
+      self.record_embedding(text, embedding)
+      return embedding
+    return recorded_embed
+
+
+  def embeddings(self, embed):
+    """
+    Wraps a batch embedding backend (see backends.embedding_batch_backend)
+    so that its embeddings are recorded or replayed. Every text of a batch
+    is recorded on its own, just as if it had been embedded alone.
+    """
+    def recorded_embed(texts, *args, **kwargs):
+      if not self.mode:
+        return embed(texts, *args, **kwargs)
+      if self.mode == "replay":
+        return [self.replay_embedding(text) for text in texts]
+      embeddings = embed(texts, *args, **kwargs)
+      for text, embedding in zip(texts, embeddings):
+        self.record_embedding(text, embedding)
+      return embeddings
+    return recorded_embed
+
+
+  def record_embedding(self, text, embedding):
+    key = "embedding:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+    dtype = (str(embedding.dtype) if isinstance(embedding, numpy.ndarray)
+             else None)
+    self.record({"kind": "embedding", "key": key, "text": text,
+                 "embedding": numpy.asarray(embedding).tolist(),
+                 "dtype": dtype})
+
+
+  def replay_embedding(self, text):
+    key = "embedding:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+    record = self.lookup(key)
+    if record["dtype"]:
+      return numpy.asarray(record["embedding"], dtype=record["dtype"])
+    return record["embedding"]
+
+
+  def chat_model(self, model, model_name, prompt_config, callbacks):
+    """
+    Wraps the chat model of the inference backend so that its answers are
+    recorded or replayed. When replaying, <model> is not needed (None).
+    """
+    return CassetteChatModel(cassette=self, model=model,
+                             model_name=model_name,
+                             prompt_config=prompt_config,
+                             callbacks=callbacks)
+
+
+class CassetteChatModel(BaseChatModel):
+  cassette: Any
+  model: Optional[BaseChatModel] = None
+  model_name: str
+  prompt_config: dict
+
+  @property
+  def _llm_type(self) -> str:
+    return "cassette"
+
+  def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+    prompt = [[message.type, message.content] for message in messages]
+    key = "llm:" + hashlib.sha256(json.dumps(
+      [self.model_name, self.prompt_config, prompt, stop],
+      sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    if self.cassette.mode == "replay":
+      record = self.cassette.lookup(key)
+      # Replayed answers report no token usage, so the tracer counts them
+      # as cache hits.
+      return ChatResult(
+        generations=[ChatGeneration(message=AIMessage(content=record["content"]))])
+
+    result = self.model._generate(messages, stop=stop, **kwargs)
+    content = result.generations[0].message.content
+    self.cassette.record({"kind": "llm", "key": key,
+                          "model": self.model_name, "messages": prompt,
+                          "content": content})
+    return result
+
+
+cassette = Cassette()
+if cassette_mode:
+  cassette.open(getattr(config, "cassette_file",
+                        f"{config.fs_storage}/cassette.jsonl"),
+                cassette_mode)
+  atexit.register(cassette.close)
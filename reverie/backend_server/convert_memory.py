@@ -0,0 +1,107 @@
+"""
+File: convert_memory.py
+Description: Converts the associative memories of the personas of
+simulations from nodes.json, embeddings.json and kw_strength.json into the
+columnar format of persona/memory_structures/memory_store.py.
+
+Every memory is loaded as before, saved in the columnar format, loaded back
+and compared with the original, and only then are the JSON files removed
+(unless --keep is given). Memories that are already columnar are left alone,
+so an interrupted conversion can simply be run again.
+
+Usage (from reverie/backend_server):
+  python convert_memory.py base_the_ville_isabella_maria_klaus
+  python convert_memory.py --all
+  python convert_memory.py --all --keep --storage /path/to/storage
+"""
+import argparse
+import os
+
+import numpy
+
+from persona.memory_structures.associative_memory import *
+
+
+def node_columns(node):
+  return (node.node_id, node.type, node.type_count, node.depth,
+          node.created, node.expiration, node.subject, node.predicate,
+          node.object, node.description, node.embedding_key,
+          node.poignancy, sorted(node.keywords), node.filling)
+
+
+def convert_memory(folder, keep=False):
+  """
+  Converts one associative memory.
+
+  INPUT
+    folder: The associative_memory folder of a persona.
+    keep: Whether to keep the JSON files.
+  OUTPUT
+    The number of nodes of the memory, or None if it was already columnar
+    or is missing some of its JSON files.
+  """
+  if is_columnar(folder):
+    return None
+  if not all(os.path.exists(f"{folder}/{file}")
+             for file in MEMORY_FILES["json"]):
+    return None
+  json_mem = AssociativeMemory(folder)
+  json_mem.save_columns(folder)
+
+  mem = AssociativeMemory(folder)
+  for node_id, node in json_mem.id_to_node.items():
+    if node_columns(mem.id_to_node[node_id]) != node_columns(node):
+      raise ValueError(f"{node_id} of {folder} differs from its JSON")
+  for attr in ["kw_to_event", "kw_to_thought", "kw_to_chat"]:
+    postings = {kw: [node.node_id for node in kw_nodes]
+                for kw, kw_nodes in getattr(mem, attr).items()}
+    json_postings = {kw: [node.node_id for node in kw_nodes]
+                     for kw, kw_nodes in getattr(json_mem, attr).items()}
+    if postings != json_postings:
+      raise ValueError(f"The {attr} postings of {folder} differ")
+  for key, embedding in json_mem.embeddings.items():
+    if not numpy.allclose(mem.embeddings[key], embedding, atol=1e-6):
+      raise ValueError(f"The embedding of {key!r} of {folder} differs")
+
+  if not keep:
+    remove_files(folder, "json")
+  return len(mem.id_to_node)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("sim_codes", nargs="*",
+                      help="The simulations to convert.")
+  parser.add_argument("--all", action="store_true",
+                      help="Convert every simulation in the storage.")
+  parser.add_argument("--storage",
+                      default="../../environment/frontend_server/storage",
+                      help="The storage folder (<fs_storage>).")
+  parser.add_argument("--keep", action="store_true",
+                      help="Keep the JSON files.")
+  args = parser.parse_args()
+
+  sim_codes = args.sim_codes
+  if args.all:
+    sim_codes = sorted(i for i in os.listdir(args.storage)
+                       if os.path.isdir(f"{args.storage}/{i}/personas"))
+  if not sim_codes:
+    parser.error("give the simulations to convert, or --all")
+
+  for sim_code in sim_codes:
+    personas_folder = f"{args.storage}/{sim_code}/personas"
+    for persona_name in sorted(os.listdir(personas_folder)):
+      folder = (f"{personas_folder}/{persona_name}"
+                f"/bootstrap_memory/associative_memory")
+      if not os.path.isdir(folder):
+        continue
+      nodes = convert_memory(folder, args.keep)
+      if nodes is None:
+        print (f"{sim_code}/{persona_name}: already columnar or incomplete, "
+               f"skipped")
+      else:
+        print (f"{sim_code}/{persona_name}: {nodes} nodes converted")
+
+
+if __name__ == '__main__':
+  main()
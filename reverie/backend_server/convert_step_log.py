@@ -0,0 +1,87 @@
+"""
+File: convert_step_log.py
+Description: Converts the storage folders of simulations that still keep
+one environment/<step>.json and movement/<step>.json file per step into the
+append-only step logs of step_log.py.
+
+The steps are appended in order, every converted step is read back from the
+log and compared with its JSON file, and only then are the JSON files
+removed (unless --keep is given). Steps that are already in the log are left
+alone, so an interrupted conversion can simply be run again.
+
+Usage (from reverie/backend_server):
+  python convert_step_log.py July1_the_ville_isabella_maria_klaus-step-3-20
+  python convert_step_log.py --all
+  python convert_step_log.py --all --keep --storage /path/to/storage
+"""
+import argparse
+import json
+import os
+
+from step_log import StepLog
+
+
+def convert_folder(folder, keep=False):
+  """
+  Converts the JSON files of one environment or movement folder.
+
+  INPUT
+    folder: The folder, e.g., storage/<sim_code>/movement
+    keep: Whether to keep the JSON files.
+  OUTPUT
+    The number of steps that were appended to the log.
+  """
+  if not os.path.isdir(folder):
+    return 0
+  steps = sorted(int(i.split(".")[0]) for i in os.listdir(folder)
+                 if i.endswith(".json") and i.split(".")[0].isdigit())
+
+  step_log = StepLog(folder)
+  converted = 0
+  for step in steps:
+    if step_log.read(step) is not None:
+      continue
+    with open(f"{folder}/{step}.json") as json_file:
+      step_log.append(step, json.load(json_file))
+    converted += 1
+  step_log.close()
+
+  for step in steps:
+    with open(f"{folder}/{step}.json") as json_file:
+      if step_log.read(step) != json.load(json_file):
+        raise ValueError(f"Step {step} of {folder} differs from its log")
+  if not keep:
+    for step in steps:
+      os.remove(f"{folder}/{step}.json")
+  return converted
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("sim_codes", nargs="*",
+                      help="The simulations to convert.")
+  parser.add_argument("--all", action="store_true",
+                      help="Convert every simulation in the storage.")
+  parser.add_argument("--storage",
+                      default="../../environment/frontend_server/storage",
+                      help="The storage folder (<fs_storage>).")
+  parser.add_argument("--keep", action="store_true",
+                      help="Keep the JSON files.")
+  args = parser.parse_args()
+
+  sim_codes = args.sim_codes
+  if args.all:
+    sim_codes = sorted(i for i in os.listdir(args.storage)
+                       if os.path.isdir(f"{args.storage}/{i}/reverie"))
+  if not sim_codes:
+    parser.error("give the simulations to convert, or --all")
+
+  for sim_code in sim_codes:
+    for folder in ["environment", "movement"]:
+      converted = convert_folder(f"{args.storage}/{sim_code}/{folder}",
+                                 args.keep)
+      print (f"{sim_code}: {converted} {folder} steps converted")
+
+
+if __name__ == '__main__':
+  main()
@@ -210,20 +210,22 @@ def std(list_of_val):
   return std
 
 
-def copyanything(src, dst):
+def copyanything(src, dst, skip=[]):
   """
   Copy over everything in the src folder to dst folder. 
   If fs_overwrite_existing_directories is True and the dst folder exists, it will be removed before copying.
   ARGS:
     src: address of the source folder  
     dst: address of the destination folder  
+    skip: names of the top-level entries of src that are not copied
   RETURNS: 
     None
   """
   try:
     if fs_overwrite_existing_directories and os.path.exists(dst):
       shutil.rmtree(dst)
-    shutil.copytree(src, dst)
+    shutil.copytree(src, dst, ignore=lambda folder, names: 
+                    [i for i in names if folder == src and i in skip])
   except OSError as exc:
     if exc.errno in (errno.ENOTDIR, errno.EINVAL):
       shutil.copy(src, dst)
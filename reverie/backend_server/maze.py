@@ -11,10 +11,334 @@ import datetime
 import pickle
 import time
 import math
+import hashlib
+import os
+import tempfile
 
 from global_methods import *
+from path_finder import CollisionGrid, DistanceFields, PathCache
+from path_finder import path_from_distance_field
+from path_hierarchy import PathHierarchy
+from path_reservations import ReservationTable
 from utils import *
 
+# <EMPTY_EVENTS> is what get_tile_events returns for a tile without events.
+EMPTY_EVENTS = frozenset()
+# <EVENT_CELL_SIZE> is the width and height, in tiles, of the grid cells that
+# the tiles with events are bucketed in (see get_nearby_events). 
+EVENT_CELL_SIZE = 8
+
+# COMPILED MAZES
+# Parsing the maze csv files of a big map takes a while, so the parsed maze
+# is compiled into <maze_cache_file> (an uncompressed numpy .npz archive 
+# next to the matrix files by default) the first time it is loaded, and 
+# later Maze instances load the arrays from there. The archive records the
+# size, modification time and sha256 hash of every source file. When a size
+# or modification time changed, the hashes are compared, and the maze is 
+# compiled again if any source really changed. Set <maze_cache_file> to None
+# in utils.py to always parse the csv files. 
+# <MAZE_CACHE_VERSION> must be bumped whenever the layout of the archive 
+# changes. 
+MAZE_CACHE_VERSION = 1
+MAZE_SOURCES = ["maze_meta_info.json", 
+                "special_blocks/world_blocks.csv", 
+                "special_blocks/sector_blocks.csv", 
+                "special_blocks/arena_blocks.csv", 
+                "special_blocks/game_object_blocks.csv", 
+                "special_blocks/spawning_location_blocks.csv", 
+                "maze/collision_maze.csv", 
+                "maze/sector_maze.csv", 
+                "maze/arena_maze.csv", 
+                "maze/game_object_maze.csv", 
+                "maze/spawning_location_maze.csv"]
+maze_cache_file = globals().get("maze_cache_file", 
+                                f"{env_matrix}/compiled_maze.npz")
+# <distance_field_budget> is the number of megabytes that the cached 
+# distance fields of the addresses may take (see get_distance_field). A 
+# field of the Ville takes 56 KB. 
+distance_field_budget = globals().get("distance_field_budget", 64)
+# <path_cache_size> is the number of paths the maze keeps for the personas 
+# to walk again (see PathCache in path_finder.py). 
+path_cache_size = globals().get("path_cache_size", 4096)
+# <hierarchical_paths> makes the personas plan their paths over the 
+# transitions between the arenas and sectors first (see path_hierarchy.py),
+# which is meant for maps much larger than the Ville. 
+hierarchical_paths = globals().get("hierarchical_paths", False)
+# <cooperative_paths> makes the personas plan their paths around each other
+# (see path_reservations.py). 
+cooperative_paths = globals().get("cooperative_paths", False)
+
+def intern_blocks(maze_raw, blocks, shape): 
+  """
+  Turns a raw maze matrix of Tiled color markers into an array of name ids. 
+
+  INPUT
+    maze_raw: The single row matrix read from the maze csv file. 
+      e.g., ['0', '0', ... '32138', '0', ...]
+    blocks: The dictionary from the color markers to the names. 
+      e.g., {'32138': "Latoya Williams's room", ...}
+    shape: The (maze_height, maze_width) of the maze. 
+  OUTPUT
+    names: The list of the distinct names. names[0] is always "". 
+    ids: The (maze_height, maze_width) array of the ids in <names>. 
+  """
+  names = [""]
+  name_ids = {"": 0}
+  markers, inverse = numpy.unique(numpy.array(maze_raw), return_inverse=True)
+  marker_ids = numpy.zeros(len(markers), dtype=numpy.int32)
+  for count, marker in enumerate(markers): 
+    name = blocks.get(str(marker), "")
+    if name not in name_ids: 
+      name_ids[name] = len(names)
+      names += [name]
+    marker_ids[count] = name_ids[name]
+  return names, marker_ids[inverse].reshape(shape)
+
+
+def group_tiles(id_arrays, mask): 
+  """
+  Groups the tiles in <mask> by their combination of ids. 
+
+  INPUT
+    id_arrays: A list of id arrays, e.g., [sector_ids, arena_ids]
+    mask: A boolean array of the tiles to group. 
+  OUTPUT
+    A list of (ids, tiles), where <ids> is a tuple of one id per array and 
+    <tiles> is the list of the (x, y) coordinates of the tiles with those 
+    ids, in row-major order. 
+  """
+  ys, xs = numpy.nonzero(mask)
+  if len(ys) == 0: 
+    return []
+  keys = numpy.stack([ids[ys, xs] for ids in id_arrays], axis=1)
+  unique_keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  order = numpy.argsort(inverse, kind="stable")
+  splits = numpy.cumsum(numpy.bincount(inverse))[:-1]
+  groups = []
+  for key, tiles in zip(unique_keys.tolist(), numpy.split(order, splits)): 
+    groups += [(tuple(key), list(zip(xs[tiles].tolist(), 
+                                     ys[tiles].tolist())))]
+  return groups
+
+
+def compile_maze(folder): 
+  """
+  Parses the maze csv files of a map into the arrays the Maze is made of. 
+
+  INPUT
+    folder: The matrix folder of the map, i.e., <env_matrix>. 
+  OUTPUT
+    A dictionary of numpy arrays: 
+      <collision_maze>: the raw collision markers, as a 2-d string array. 
+      <world_names>, <sector_names>, ...: the interned names of every level.
+      <sector_ids>, <arena_ids>, ...: the name ids of every tile. 
+      <collision>: whether every tile is a collision block. 
+      <tile_name_ids>, <tile_name_combinations>: the id of the combination 
+        of world, sector, arena and game object ids of every tile, and the 
+        combinations. 
+      <address_names>, <address_offsets>, <address_coordinates>, 
+      <address_is_game_object>: the tiles of every string address (see 
+        Maze.address_tiles) -- the (x, y) coordinates of address i are 
+        address_coordinates[address_offsets[i]:address_offsets[i+1]]. 
+  """
+  meta_info = json.load(open(f"{folder}/maze_meta_info.json"))
+  shape = (int(meta_info["maze_height"]), int(meta_info["maze_width"]))
+
+  # READING IN SPECIAL BLOCKS
+  # Special blocks are those that are colored in the Tiled map. 
+
+  # Here is an example row for the arena block file: 
+  # e.g., "25335, Double Studio, Studio, Common Room"
+  # And here is another example row for the game object block file: 
+  # e.g, "25331, Double Studio, Studio, Bedroom 2, Painting"
+
+  # Notice that the first element here is the color marker digit from the 
+  # Tiled export. Then we basically have the block path: 
+  # World, Sector, Arena, Game Object -- again, these paths need to be 
+  # unique within an instance of Reverie. 
+  blocks_folder = f"{folder}/special_blocks"
+
+  _wb = blocks_folder + "/world_blocks.csv"
+  wb_rows = read_file_to_list(_wb, header=False)
+  wb = wb_rows[0][-1]
+ 
+  _sb = blocks_folder + "/sector_blocks.csv"
+  sb_rows = read_file_to_list(_sb, header=False)
+  sb_dict = dict()
+  for i in sb_rows: sb_dict[i[0]] = i[-1]
+  
+  _ab = blocks_folder + "/arena_blocks.csv"
+  ab_rows = read_file_to_list(_ab, header=False)
+  ab_dict = dict()
+  for i in ab_rows: ab_dict[i[0]] = i[-1]
+  
+  _gob = blocks_folder + "/game_object_blocks.csv"
+  gob_rows = read_file_to_list(_gob, header=False)
+  gob_dict = dict()
+  for i in gob_rows: gob_dict[i[0]] = i[-1]
+  
+  _slb = blocks_folder + "/spawning_location_blocks.csv"
+  slb_rows = read_file_to_list(_slb, header=False)
+  slb_dict = dict()
+  for i in slb_rows: slb_dict[i[0]] = i[-1]
+
+  # [SECTION 3] Reading in the matrices 
+  # This is your typical two dimensional matrices. It's made up of 0s and 
+  # the number that represents the color block from the blocks folder. 
+  maze_folder = f"{folder}/maze"
+
+  _cm = maze_folder + "/collision_maze.csv"
+  collision_maze_raw = read_file_to_list(_cm, header=False)[0]
+  _sm = maze_folder + "/sector_maze.csv"
+  sector_maze_raw = read_file_to_list(_sm, header=False)[0]
+  _am = maze_folder + "/arena_maze.csv"
+  arena_maze_raw = read_file_to_list(_am, header=False)[0]
+  _gom = maze_folder + "/game_object_maze.csv"
+  game_object_maze_raw = read_file_to_list(_gom, header=False)[0]
+  _slm = maze_folder + "/spawning_location_maze.csv"
+  spawning_location_maze_raw = read_file_to_list(_slm, header=False)[0]
+
+  # Loading the maze. The mazes are taken directly from the json exports of
+  # Tiled maps. They should be in csv format. 
+  # Importantly, they are "not" in a 2-d matrix format -- they are single 
+  # row matrices with the length of width x height of the maze. So we need
+  # to convert here. 
+  # We can do this all at once since the dimension of all these matrices are
+  # identical (e.g., 70 x 40).
+  # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
+  # 25309 is the collision bar number right now.
+  compiled = dict()
+  compiled["collision_maze"] = numpy.array(collision_maze_raw).reshape(shape)
+  compiled["world_names"] = numpy.array(["", wb])
+  world_ids = numpy.ones(shape, dtype=numpy.int32)
+  for level, maze_raw, blocks in [
+      ("sector", sector_maze_raw, sb_dict), 
+      ("arena", arena_maze_raw, ab_dict), 
+      ("game_object", game_object_maze_raw, gob_dict), 
+      ("spawning_location", spawning_location_maze_raw, slb_dict)]: 
+    names, ids = intern_blocks(maze_raw, blocks, shape)
+    compiled[f"{level}_names"] = numpy.array(names)
+    compiled[f"{level}_ids"] = ids
+  compiled["collision"] = compiled["collision_maze"] != "0"
+
+  sector_ids = compiled["sector_ids"]
+  arena_ids = compiled["arena_ids"]
+  game_object_ids = compiled["game_object_ids"]
+  spawning_location_ids = compiled["spawning_location_ids"]
+  tile_ids = numpy.stack([world_ids, sector_ids, arena_ids, game_object_ids],
+                         axis=-1).reshape(-1, 4)
+  combinations, inverse = numpy.unique(tile_ids, axis=0, return_inverse=True)
+  compiled["tile_name_ids"] = inverse.reshape(shape).astype(numpy.int32)
+  compiled["tile_name_combinations"] = combinations.astype(numpy.int32)
+
+  # Reverse tile access (see Maze.address_tiles). 
+  sector_names = compiled["sector_names"].tolist()
+  arena_names = compiled["arena_names"].tolist()
+  game_object_names = compiled["game_object_names"].tolist()
+  spawning_location_names = compiled["spawning_location_names"].tolist()
+  address_tiles = dict()
+  game_object_addresses = set()
+  for key, tiles in group_tiles([sector_ids], sector_ids != 0): 
+    add = f'{wb}:{sector_names[key[0]]}'
+    address_tiles.setdefault(add, []).extend(tiles)
+  for key, tiles in group_tiles([sector_ids, arena_ids], arena_ids != 0): 
+    add = f'{wb}:{sector_names[key[0]]}:{arena_names[key[1]]}'
+    address_tiles.setdefault(add, []).extend(tiles)
+  for key, tiles in group_tiles([sector_ids, arena_ids, game_object_ids], 
+                                game_object_ids != 0): 
+    add = f'{wb}:{sector_names[key[0]]}:{arena_names[key[1]]}'
+    add += f':{game_object_names[key[2]]}'
+    address_tiles.setdefault(add, []).extend(tiles)
+    game_object_addresses.add(add)
+  for key, tiles in group_tiles([spawning_location_ids], 
+                                spawning_location_ids != 0): 
+    add = f'<spawn_loc>{spawning_location_names[key[0]]}'
+    address_tiles.setdefault(add, []).extend(tiles)
+
+  compiled["address_names"] = numpy.array(list(address_tiles.keys()))
+  compiled["address_offsets"] = numpy.cumsum(
+    [0] + [len(tiles) for tiles in address_tiles.values()]).astype(numpy.int64)
+  compiled["address_coordinates"] = numpy.array(
+    [tile for tiles in address_tiles.values() for tile in tiles], 
+    dtype=numpy.int32).reshape(-1, 2)
+  compiled["address_is_game_object"] = numpy.array(
+    [add in game_object_addresses for add in address_tiles], dtype=bool)
+  return compiled
+
+
+def load_compiled_maze(folder): 
+  """
+  Returns the compiled arrays of a map (see compile_maze), from 
+  <maze_cache_file> if it is up to date. Otherwise, the map is compiled and
+  saved to <maze_cache_file>. 
+
+  INPUT
+    folder: The matrix folder of the map, i.e., <env_matrix>. 
+  OUTPUT
+    The dictionary of numpy arrays. 
+  """
+  if not maze_cache_file: 
+    return compile_maze(folder)
+
+  sources = [f"{folder}/{i}" for i in MAZE_SOURCES]
+  stats = [[os.stat(i).st_size, os.stat(i).st_mtime_ns] for i in sources]
+  hashes = None
+  try: 
+    with numpy.load(maze_cache_file) as cache: 
+      manifest = json.loads(str(cache["manifest"]))
+      if (manifest["version"] == MAZE_CACHE_VERSION 
+          and manifest["folder"] == os.path.abspath(folder)): 
+        if manifest["stats"] == stats: 
+          return dict(cache)
+        # The files were touched. If their contents are the same, we only 
+        # need to update their stats in the cache. 
+        hashes = [file_sha256(i) for i in sources]
+        if manifest["hashes"] == hashes: 
+          compiled = dict(cache)
+          del compiled["manifest"]
+          save_compiled_maze(compiled, folder, stats, hashes)
+          return compiled
+  except (OSError, KeyError, ValueError): 
+    pass
+
+  compiled = compile_maze(folder)
+  if not hashes: 
+    hashes = [file_sha256(i) for i in sources]
+  save_compiled_maze(compiled, folder, stats, hashes)
+  return compiled
+
+
+def save_compiled_maze(compiled, folder, stats, hashes): 
+  """
+  Saves the compiled arrays of a map to <maze_cache_file>, along with the 
+  manifest of the source files they were compiled from. The archive is 
+  written to a temporary file first, so that servers starting at the same 
+  time never read a half-written archive. 
+  """
+  manifest = {"version": MAZE_CACHE_VERSION, 
+              "folder": os.path.abspath(folder), 
+              "sources": MAZE_SOURCES, 
+              "stats": stats, 
+              "hashes": hashes}
+  cache_folder = os.path.dirname(os.path.abspath(maze_cache_file))
+  try: 
+    os.makedirs(cache_folder, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(suffix=".npz", dir=cache_folder)
+    os.close(fd)
+    os.chmod(temp_file, 0o644)
+    numpy.savez(temp_file, manifest=numpy.array(json.dumps(manifest)), 
+                **compiled)
+    os.replace(temp_file, maze_cache_file)
+  except OSError as e: 
+    print (f"Could not save the compiled maze to {maze_cache_file}: {e}")
+
+
+def file_sha256(curr_file): 
+  with open(curr_file, "rb") as f: 
+    return hashlib.sha256(f.read()).hexdigest()
+
+
 class Maze: 
   def __init__(self, maze_name): 
     # READING IN THE BASIC META INFORMATION ABOUT THE MAP
@@ -33,176 +357,118 @@ class Maze:
     # e.g., "planning to stay at home all day and never go out of her home"
     self.special_constraint = meta_info["special_constraint"]
 
-    # READING IN SPECIAL BLOCKS
-    # Special blocks are those that are colored in the Tiled map. 
-
-    # Here is an example row for the arena block file: 
-    # e.g., "25335, Double Studio, Studio, Common Room"
-    # And here is another example row for the game object block file: 
-    # e.g, "25331, Double Studio, Studio, Bedroom 2, Painting"
-
-    # Notice that the first element here is the color marker digit from the 
-    # Tiled export. Then we basically have the block path: 
-    # World, Sector, Arena, Game Object -- again, these paths need to be 
-    # unique within an instance of Reverie. 
-    blocks_folder = f"{env_matrix}/special_blocks"
-
-    _wb = blocks_folder + "/world_blocks.csv"
-    wb_rows = read_file_to_list(_wb, header=False)
-    wb = wb_rows[0][-1]
-   
-    _sb = blocks_folder + "/sector_blocks.csv"
-    sb_rows = read_file_to_list(_sb, header=False)
-    sb_dict = dict()
-    for i in sb_rows: sb_dict[i[0]] = i[-1]
-    
-    _ab = blocks_folder + "/arena_blocks.csv"
-    ab_rows = read_file_to_list(_ab, header=False)
-    ab_dict = dict()
-    for i in ab_rows: ab_dict[i[0]] = i[-1]
-    
-    _gob = blocks_folder + "/game_object_blocks.csv"
-    gob_rows = read_file_to_list(_gob, header=False)
-    gob_dict = dict()
-    for i in gob_rows: gob_dict[i[0]] = i[-1]
-    
-    _slb = blocks_folder + "/spawning_location_blocks.csv"
-    slb_rows = read_file_to_list(_slb, header=False)
-    slb_dict = dict()
-    for i in slb_rows: slb_dict[i[0]] = i[-1]
-
-    # [SECTION 3] Reading in the matrices 
-    # This is your typical two dimensional matrices. It's made up of 0s and 
-    # the number that represents the color block from the blocks folder. 
-    maze_folder = f"{env_matrix}/maze"
-
-    _cm = maze_folder + "/collision_maze.csv"
-    collision_maze_raw = read_file_to_list(_cm, header=False)[0]
-    _sm = maze_folder + "/sector_maze.csv"
-    sector_maze_raw = read_file_to_list(_sm, header=False)[0]
-    _am = maze_folder + "/arena_maze.csv"
-    arena_maze_raw = read_file_to_list(_am, header=False)[0]
-    _gom = maze_folder + "/game_object_maze.csv"
-    game_object_maze_raw = read_file_to_list(_gom, header=False)[0]
-    _slm = maze_folder + "/spawning_location_maze.csv"
-    spawning_location_maze_raw = read_file_to_list(_slm, header=False)[0]
-
-    # Loading the maze. The mazes are taken directly from the json exports of
-    # Tiled maps. They should be in csv format. 
-    # Importantly, they are "not" in a 2-d matrix format -- they are single 
-    # row matrices with the length of width x height of the maze. So we need
-    # to convert here. 
-    # We can do this all at once since the dimension of all these matrices are
-    # identical (e.g., 70 x 40).
+    # LOADING THE MAZE
+    # The special blocks and the maze matrices are parsed by compile_maze, 
+    # or loaded from the compiled maze if it is up to date. 
+    compiled = load_compiled_maze(env_matrix)
+
+    # <collision_maze> is the raw collision maze, in rows of strings, for the
+    # path finder. 
     # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
     # 25309 is the collision bar number right now.
-    self.collision_maze = []
-    sector_maze = []
-    arena_maze = []
-    game_object_maze = []
-    spawning_location_maze = []
-    for i in range(0, len(collision_maze_raw), meta_info["maze_width"]): 
-      tw = meta_info["maze_width"]
-      self.collision_maze += [collision_maze_raw[i:i+tw]]
-      sector_maze += [sector_maze_raw[i:i+tw]]
-      arena_maze += [arena_maze_raw[i:i+tw]]
-      game_object_maze += [game_object_maze_raw[i:i+tw]]
-      spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
-
-    # Once we are done loading in the maze, we now set up self.tiles. This is
-    # a matrix accessed by row:col where each access point is a dictionary
-    # that contains all the things that are taking place in that tile. 
-    # More specifically, it contains information about its "world," "sector,"
-    # "arena," "game_object," "spawning_location," as well as whether it is a
-    # collision block, and a set of all events taking place in it. 
-    # e.g., self.tiles[32][59] = {'world': 'double studio', 
+    self.collision_maze = compiled["collision_maze"].tolist()
+    # <collision_grid> holds the same collision blocks in the form that the 
+    # path finder searches, so that it is not rebuilt for every path. 
+    self.collision_grid = CollisionGrid(compiled["collision_maze"], 
+                                        collision_block_id)
+    # <distance_fields> caches the distance fields of the addresses. 
+    self.distance_fields = DistanceFields(self.collision_grid, 
+                                          distance_field_budget * 2**20)
+    # <path_cache> caches the paths the personas have found lately. 
+    self.path_cache = PathCache(self.collision_grid, path_cache_size)
+    # <path_hierarchy> is built by get_path_hierarchy when it is first 
+    # needed. 
+    self.path_hierarchy = None
+    # <path_reservations> is the <ReservationTable> of the personas' paths 
+    # if <cooperative_paths> is set, and None otherwise. 
+    self.path_reservations = None
+    if cooperative_paths: 
+      self.path_reservations = ReservationTable()
+
+    # Once we are done loading in the maze, we now set up the tile grid. 
+    # Rather than keeping a dictionary per tile, every tile attribute is a 
+    # (maze_height, maze_width) numpy array indexed by [row][col], i.e., 
+    # [y][x]: 
+    # <world_ids>, <sector_ids>, <arena_ids>, <game_object_ids> and 
+    # <spawning_location_ids> hold the ids of the tile's names in 
+    # <world_names>, <sector_names>, ... Id 0 is always "" (the tile is not 
+    # part of any sector, arena, ...), and a name has the same id wherever 
+    # it appears. 
+    # <collision> is True for the tiles that are collision blocks. 
+    # <events> holds the set of all events taking place in a tile, for the 
+    # tiles that have any, keyed by the (x, y) tile coordinate. 
+    # access_tile() still gives the familiar dictionary view of a tile: 
+    # e.g., access_tile((59, 32)) = {'world': 'double studio', 
     #            'sector': '', 'arena': '', 'game_object': '', 
     #            'spawning_location': '', 'collision': False, 'events': set()}
-    # e.g., self.tiles[9][58] = {'world': 'double studio', 
+    # e.g., access_tile((58, 9)) = {'world': 'double studio', 
     #         'sector': 'double studio', 'arena': 'bedroom 2', 
     #         'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
     #         'collision': False,
     #         'events': {('double studio:double studio:bedroom 2:bed',
     #                    None, None)}} 
-    self.tiles = []
-    for i in range(self.maze_height): 
-      row = []
-      for j in range(self.maze_width):
-        tile_details = dict()
-        tile_details["world"] = wb
-        
-        tile_details["sector"] = ""
-        if sector_maze[i][j] in sb_dict: 
-          tile_details["sector"] = sb_dict[sector_maze[i][j]]
-        
-        tile_details["arena"] = ""
-        if arena_maze[i][j] in ab_dict: 
-          tile_details["arena"] = ab_dict[arena_maze[i][j]]
-        
-        tile_details["game_object"] = ""
-        if game_object_maze[i][j] in gob_dict: 
-          tile_details["game_object"] = gob_dict[game_object_maze[i][j]]
-        
-        tile_details["spawning_location"] = ""
-        if spawning_location_maze[i][j] in slb_dict: 
-          tile_details["spawning_location"] = slb_dict[spawning_location_maze[i][j]]
-        
-        tile_details["collision"] = False
-        if self.collision_maze[i][j] != "0": 
-          tile_details["collision"] = True
-
-        tile_details["events"] = set()
-        
-        row += [tile_details]
-      self.tiles += [row]
-    # Each game object occupies an event in the tile. We are setting up the 
-    # default event value here. 
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        if self.tiles[i][j]["game_object"]:
-          object_name = ":".join([self.tiles[i][j]["world"], 
-                                  self.tiles[i][j]["sector"], 
-                                  self.tiles[i][j]["arena"], 
-                                  self.tiles[i][j]["game_object"]])
-          go_event = (object_name, None, None, None)
-          self.tiles[i][j]["events"].add(go_event)
+    shape = (self.maze_height, self.maze_width)
+    self.world_names = compiled["world_names"].tolist()
+    self.world_ids = numpy.ones(shape, dtype=numpy.int32)
+    self.sector_names = compiled["sector_names"].tolist()
+    self.sector_ids = compiled["sector_ids"]
+    self.arena_names = compiled["arena_names"].tolist()
+    self.arena_ids = compiled["arena_ids"]
+    self.game_object_names = compiled["game_object_names"].tolist()
+    self.game_object_ids = compiled["game_object_ids"]
+    self.spawning_location_names = (compiled["spawning_location_names"]
+                                    .tolist())
+    self.spawning_location_ids = compiled["spawning_location_ids"]
+    self.collision = compiled["collision"]
+    # <tile_name_ids> numbers the distinct combinations of world, sector, 
+    # arena and game object names, whose dictionaries are in <tile_names>. 
+    self.tile_name_ids = compiled["tile_name_ids"]
+    self.tile_names = []
+    for w, s, a, g in compiled["tile_name_combinations"].tolist(): 
+      self.tile_names += [{"world": self.world_names[w], 
+                           "sector": self.sector_names[s], 
+                           "arena": self.arena_names[a], 
+                           "game_object": self.game_object_names[g]}]
+    self.events = dict()
+    # The events are also indexed the other way around, so that finding 
+    # where an event or a subject is takes constant time: 
+    # <event_tiles> maps every event to the set of tiles it is in, and 
+    # <subject_tiles> maps every subject (the first element of the event, 
+    # e.g., "Isabella Rodriguez" or "the Ville:Hobbs Cafe:cafe:piano") to 
+    # {tile: set of the subject's events in that tile}. 
+    # All of them are kept in sync by add_event_from_tile and the remove 
+    # functions below, which are the only way to change the events. 
+    self.event_tiles = dict()
+    self.subject_tiles = dict()
+    # <event_cells> buckets the tiles that have events by their arena and by
+    # the EVENT_CELL_SIZE grid cell they are in: 
+    # {(world id, sector id, arena id, cell x, cell y): set of tiles}. This 
+    # is what lets perception look only at the events of its own arena 
+    # instead of at every tile within the vision radius. 
+    self.event_cells = dict()
+    # <tile_paths> caches the string addresses of get_tile_path. 
+    self.tile_paths = dict()
 
     # Reverse tile access. 
     # <self.address_tiles> -- given a string address, we return a set of all 
     # tile coordinates belonging to that address (this is opposite of  
-    # self.tiles that give you the string address given a coordinate). This is
-    # an optimization component for finding paths for the personas' movement. 
+    # access_tile that give you the string address given a coordinate). This
+    # is an optimization component for finding paths for the personas' 
+    # movement. 
     # self.address_tiles['<spawn_loc>bedroom-2-a'] == {(58, 9)}
     # self.address_tiles['double studio:recreation:pool table'] 
     #   == {(29, 14), (31, 11), (30, 14), (32, 11), ...}, 
     self.address_tiles = dict()
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        addresses = []
-        if self.tiles[i][j]["sector"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}'
-          addresses += [add]
-        if self.tiles[i][j]["arena"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}'
-          addresses += [add]
-        if self.tiles[i][j]["game_object"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}:'
-          add += f'{self.tiles[i][j]["game_object"]}'
-          addresses += [add]
-        if self.tiles[i][j]["spawning_location"]: 
-          add = f'<spawn_loc>{self.tiles[i][j]["spawning_location"]}'
-          addresses += [add]
-
-        for add in addresses: 
-          if add in self.address_tiles: 
-            self.address_tiles[add].add((j, i))
-          else: 
-            self.address_tiles[add] = set([(j, i)])
+    offsets = compiled["address_offsets"].tolist()
+    coordinates = compiled["address_coordinates"].tolist()
+    for count, add in enumerate(compiled["address_names"].tolist()): 
+      tiles = [tuple(i) for i in coordinates[offsets[count]:offsets[count+1]]]
+      self.address_tiles[add] = set(tiles)
+      if compiled["address_is_game_object"][count]: 
+        # Each game object occupies an event in the tile. We are setting up 
+        # the default event value here. 
+        for tile in tiles: 
+          self.add_event_from_tile((add, None, None, None), tile)
 
 
   def turn_coordinate_to_tile(self, px_coordinate): 
@@ -225,8 +491,10 @@ class Maze:
 
   def access_tile(self, tile): 
     """
-    Returns the tiles details dictionary that is stored in self.tiles of the 
-    designated x, y location. 
+    Returns the tiles details dictionary of the designated x, y location. 
+    The dictionary is assembled from the tile arrays on every call, so 
+    changing it does not change the maze -- the events of a tile have to be
+    changed through add_event_from_tile and friends. 
 
     INPUT
       tile: The tile coordinate of our interest in (x, y) form.
@@ -234,16 +502,35 @@ class Maze:
       The tile detail dictionary for the designated tile. 
     EXAMPLE OUTPUT
       Given (58, 9), 
-      self.tiles[9][58] = {'world': 'double studio', 
-            'sector': 'double studio', 'arena': 'bedroom 2', 
-            'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
-            'collision': False,
-            'events': {('double studio:double studio:bedroom 2:bed',
-                       None, None)}} 
+      {'world': 'double studio', 
+       'sector': 'double studio', 'arena': 'bedroom 2', 
+       'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
+       'collision': False,
+       'events': {('double studio:double studio:bedroom 2:bed',
+                  None, None)}} 
     """
     x = tile[0]
     y = tile[1]
-    return self.tiles[y][x]
+    return {"world": self.world_names[self.world_ids[y, x]], 
+            "sector": self.sector_names[self.sector_ids[y, x]], 
+            "arena": self.arena_names[self.arena_ids[y, x]], 
+            "game_object": self.game_object_names[self.game_object_ids[y, x]],
+            "spawning_location": self.spawning_location_names[
+                                   self.spawning_location_ids[y, x]], 
+            "collision": bool(self.collision[y, x]), 
+            "events": set(self.get_tile_events(tile))}
+
+
+  def get_tile_events(self, tile): 
+    """
+    Returns the events taking place in a tile. The set must not be changed.
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUTPUT
+      The set of the event tuples of the tile (empty if there is none). 
+    """
+    return self.events.get((tile[0], tile[1]), EMPTY_EVENTS)
 
 
   def get_tile_path(self, tile, level): 
@@ -262,27 +549,96 @@ class Maze:
     """
     x = tile[0]
     y = tile[1]
-    tile = self.tiles[y][x]
-
-    path = f"{tile['world']}"
-    if level == "world": 
-      return path
-    else: 
-      path += f":{tile['sector']}"
-    
-    if level == "sector": 
-      return path
-    else: 
-      path += f":{tile['arena']}"
-
-    if level == "arena": 
-      return path
-    else: 
-      path += f":{tile['game_object']}"
-
+    # The address only depends on the ids of the tile, so it is built once 
+    # for every combination of ids. 
+    key = (level, int(self.world_ids[y, x]), int(self.sector_ids[y, x]), 
+           int(self.arena_ids[y, x]), int(self.game_object_ids[y, x]))
+    if key in self.tile_paths: 
+      return self.tile_paths[key]
+
+    path = f"{self.world_names[key[1]]}"
+    if level != "world": 
+      path += f":{self.sector_names[key[2]]}"
+      if level != "sector": 
+        path += f":{self.arena_names[key[3]]}"
+        if level != "arena": 
+          path += f":{self.game_object_names[key[4]]}"
+    self.tile_paths[key] = path
     return path
 
 
+  def get_distance_field(self, address): 
+    """
+    Returns the distance of every tile to the closest tile of an address, 
+    from which path_from_distance_field (path_finder.py) gives the path to 
+    that tile from anywhere. The fields are computed once and cached, as 
+    the personas head to the same few addresses over and over. 
+
+    INPUT: 
+      address: The string address, a key of <address_tiles>. 
+    OUTPUT: 
+      The distance field (see distance_field in path_finder.py). 
+    """
+    return self.distance_fields.get(address, self.address_tiles[address])
+
+
+  def get_address_path(self, tile, address): 
+    """
+    Returns a shortest path from a tile to the closest tile of an address, 
+    from the path cache or else from the distance field of the address (see
+    get_distance_field). 
+
+    INPUT: 
+      tile: The tile coordinate to start from, in (x, y) form. 
+      address: The string address, a key of <address_tiles>. 
+    OUTPUT: 
+      The path as a list of (x, y) tiles, starting with <tile>, or None if 
+      no tile of the address can be reached. The list must not be changed.
+    """
+    return self.path_cache.get(
+      ("address", (tile[0], tile[1]), address), 
+      lambda: path_from_distance_field(self.collision_grid, 
+                                       self.get_distance_field(address), 
+                                       tile))
+
+
+  def get_path_hierarchy(self): 
+    """
+    Returns the <PathHierarchy> of the maze if <hierarchical_paths> is set, 
+    building it the first time, and None otherwise. 
+    """
+    if not hierarchical_paths: 
+      return None
+    if not self.path_hierarchy: 
+      # The clusters of the hierarchy do not cross the borders of the 
+      # arenas, or of the sectors outside of them. 
+      region_ids = numpy.stack([self.world_ids, self.sector_ids, 
+                                self.arena_ids], axis=-1).reshape(-1, 3)
+      regions = numpy.unique(region_ids, axis=0, return_inverse=True)[1]
+      self.path_hierarchy = PathHierarchy(self.collision_grid, 
+                                          regions.reshape(-1).tolist())
+    return self.path_hierarchy
+
+
+  def set_tile_collision(self, tile, collision): 
+    """
+    Makes a tile a collision block, or makes it walkable. The distance 
+    fields, the path hierarchy and the cached paths notice the change 
+    through the version of <collision_grid>. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      collision: Whether the tile is to be a collision block. 
+    OUTPUT: 
+      None
+    """
+    x = tile[0]
+    y = tile[1]
+    self.collision[y, x] = collision
+    self.collision_maze[y][x] = str(collision_block_id) if collision else "0"
+    self.collision_grid.set_blocked(tile, collision)
+
+
   def get_nearby_tiles(self, tile, vision_r): 
     """
     Given the current tile and vision_r, return a list of tiles that are 
@@ -301,6 +657,26 @@ class Maze:
     OUTPUT: 
       nearby_tiles: a list of tiles that are within the radius. 
     """
+    left_end, right_end, top_end, bottom_end = self.get_nearby_bounds(
+                                                             tile, vision_r)
+    nearby_tiles = []
+    for i in range(left_end, right_end): 
+      for j in range(top_end, bottom_end): 
+        nearby_tiles += [(i, j)]
+    return nearby_tiles
+
+
+  def get_nearby_bounds(self, tile, vision_r): 
+    """
+    Returns the bounds of the square that get_nearby_tiles covers. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+    OUTPUT: 
+      (left_end, right_end, top_end, bottom_end), where the right and bottom
+      ends are exclusive. 
+    """
     left_end = 0
     if tile[0] - vision_r > left_end: 
       left_end = tile[0] - vision_r
@@ -317,11 +693,94 @@ class Maze:
     if tile[1] - vision_r > top_end: 
       top_end = tile[1] - vision_r 
 
-    nearby_tiles = []
-    for i in range(left_end, right_end): 
-      for j in range(top_end, bottom_end): 
-        nearby_tiles += [(i, j)]
-    return nearby_tiles
+    return left_end, right_end, top_end, bottom_end
+
+
+  def get_nearby_tile_names(self, tile, vision_r): 
+    """
+    Given the current tile and vision_r, returns the distinct world, sector, 
+    arena and game object names of the tiles that are within the radius 
+    (see get_nearby_tiles), in the order in which get_nearby_tiles lists the
+    tiles. This is what perceiving space needs, without visiting every tile.
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+    OUTPUT: 
+      A list of {"world", "sector", "arena", "game_object"} dictionaries, 
+      which must not be changed. 
+    """
+    left_end, right_end, top_end, bottom_end = self.get_nearby_bounds(
+                                                             tile, vision_r)
+    # get_nearby_tiles goes column by column, hence the transpose. 
+    name_ids = (self.tile_name_ids[top_end:bottom_end, left_end:right_end]
+                .T.reshape(-1).tolist())
+    return [self.tile_names[i] for i in dict.fromkeys(name_ids)]
+
+
+  def get_event_cell(self, tile): 
+    """
+    Returns the key of the <event_cells> bucket of a tile. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUTPUT: 
+      (world id, sector id, arena id, cell x, cell y)
+    """
+    x = tile[0]
+    y = tile[1]
+    return (int(self.world_ids[y, x]), int(self.sector_ids[y, x]), 
+            int(self.arena_ids[y, x]), 
+            x // EVENT_CELL_SIZE, y // EVENT_CELL_SIZE)
+
+
+  def get_nearby_events(self, tile, vision_r): 
+    """
+    Given the current tile and vision_r, returns the events that take place
+    within the radius (see get_nearby_tiles) and in the same arena as the 
+    tile, ordered by their distance. An event that is in several of these 
+    tiles is listed once, with the distance of the first of its tiles in 
+    the order of get_nearby_tiles, and events at the same distance keep 
+    that order too. Only the <event_cells> buckets of 
+    the arena that overlap the radius are looked at, so this costs about as
+    much as there are events nearby, not as there are tiles. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+    OUTPUT: 
+      A list of [distance, event]. 
+    EXAMPLE OUTPUT
+      [[0.0, ('Isabella Rodriguez', 'is', 'cafe', 'serving coffee')], 
+       [1.0, ('the Ville:Hobbs Cafe:cafe:counter', None, None, None)], ...]
+    """
+    left_end, right_end, top_end, bottom_end = self.get_nearby_bounds(
+                                                             tile, vision_r)
+    if left_end >= right_end or top_end >= bottom_end: 
+      return []
+    arena = self.get_event_cell(tile)[:3]
+
+    event_tiles = []
+    for cell_x in range(left_end // EVENT_CELL_SIZE, 
+                        (right_end - 1) // EVENT_CELL_SIZE + 1): 
+      for cell_y in range(top_end // EVENT_CELL_SIZE, 
+                          (bottom_end - 1) // EVENT_CELL_SIZE + 1): 
+        for i in self.event_cells.get(arena + (cell_x, cell_y), ()): 
+          if left_end <= i[0] < right_end and top_end <= i[1] < bottom_end: 
+            event_tiles += [i]
+    # get_nearby_tiles goes column by column. 
+    event_tiles.sort()
+
+    nearby_events = []
+    seen_events = set()
+    for i in event_tiles: 
+      dist = math.dist(i, (tile[0], tile[1]))
+      for event in self.events[i]: 
+        if event not in seen_events: 
+          nearby_events += [[dist, event]]
+          seen_events.add(event)
+    nearby_events.sort(key=lambda i: i[0])
+    return nearby_events
 
 
   def add_event_from_tile(self, curr_event, tile): 
@@ -336,7 +795,13 @@ class Maze:
     OUPUT: 
       None
     """
-    self.tiles[tile[1]][tile[0]]["events"].add(curr_event)
+    tile = (tile[0], tile[1])
+    if tile not in self.events: 
+      self.event_cells.setdefault(self.get_event_cell(tile), set()).add(tile)
+    self.events.setdefault(tile, set()).add(curr_event)
+    self.event_tiles.setdefault(curr_event, set()).add(tile)
+    (self.subject_tiles.setdefault(curr_event[0], dict())
+                       .setdefault(tile, set()).add(curr_event))
 
 
   def remove_event_from_tile(self, curr_event, tile):
@@ -351,19 +816,32 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
+    tile = (tile[0], tile[1])
+    if tile not in self.event_tiles.get(curr_event, EMPTY_EVENTS): 
+      return
+
+    self.events[tile].remove(curr_event)
+    if not self.events[tile]: 
+      del self.events[tile]
+      cell = self.get_event_cell(tile)
+      self.event_cells[cell].remove(tile)
+      if not self.event_cells[cell]: 
+        del self.event_cells[cell]
+    self.event_tiles[curr_event].remove(tile)
+    if not self.event_tiles[curr_event]: 
+      del self.event_tiles[curr_event]
+    subject_tiles = self.subject_tiles[curr_event[0]]
+    subject_tiles[tile].remove(curr_event)
+    if not subject_tiles[tile]: 
+      del subject_tiles[tile]
+      if not subject_tiles: 
+        del self.subject_tiles[curr_event[0]]
 
 
   def turn_event_from_tile_idle(self, curr_event, tile):
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-        new_event = (event[0], None, None, None)
-        self.tiles[tile[1]][tile[0]]["events"].add(new_event)
+    if (tile[0], tile[1]) in self.event_tiles.get(curr_event, EMPTY_EVENTS): 
+      self.remove_event_from_tile(curr_event, tile)
+      self.add_event_from_tile((curr_event[0], None, None, None), tile)
 
 
   def remove_subject_events_from_tile(self, subject, tile):
@@ -376,41 +854,50 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event[0] == subject:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    subject_events = self.subject_tiles.get(subject, dict()).get(
+                                                      (tile[0], tile[1]))
+    for event in list(subject_events or []): 
+      self.remove_event_from_tile(event, tile)
 
 
+  def get_event_tiles(self, curr_event): 
+    """
+    Returns the tiles where an event takes place. The set must not be 
+    changed. 
 
+    INPUT: 
+      curr_event: The event triple. 
+    OUPUT: 
+      The set of (x, y) tiles (empty if the event is nowhere). 
+    """
+    return self.event_tiles.get(curr_event, EMPTY_EVENTS)
 
 
+  def get_subject_tiles(self, subject): 
+    """
+    Returns the tiles where a subject has events, e.g., where a persona is.
 
+    INPUT: 
+      subject: "Isabella Rodriguez"
+    OUPUT: 
+      The (x, y) tiles, as the keys of a dictionary that must not be changed.
+    """
+    return self.subject_tiles.get(subject, dict()).keys()
 
 
+  def tile_has_subject(self, tile, subjects): 
+    """
+    Returns whether any of <subjects> has an event in a tile, e.g., whether
+    a tile is occupied by a persona. This only looks at the few events of 
+    the tile, however many subjects there are. 
 
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      subjects: A set of subjects, e.g., the names of the personas. 
+    OUPUT: 
+      True or False. 
+    """
+    for event in self.events.get((tile[0], tile[1]), EMPTY_EVENTS): 
+      if event[0] in subjects: 
+        return True
+    return False
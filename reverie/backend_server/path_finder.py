@@ -5,8 +5,13 @@ File: path_finder.py
 Description: Implements various path finding functions for generative agents.
 Some of the functions are defunct. 
 """
+import array
+import collections
+
 import numpy as np
 
+from tracer import tracer, traced
+
 def print_maze(maze):
   for row in maze:
     for item in row:
@@ -161,20 +166,380 @@ def path_finder_v2(a, start, end, collision_block_char, verbose=False):
   return the_path
 
 
+class CollisionGrid: 
+  """
+  The collision blocks of a maze in the form the path finding functions 
+  below search, built once per maze rather than on every call: <blocked> is
+  a flat list of <width> * <height> booleans in row-major order, so that 
+  tile (x, y) is blocked[y * width + x]. 
+  """
+  def __init__(self, collision_maze, collision_block_char): 
+    # <collision_maze> is the raw collision maze, in rows of strings (a list
+    # of lists or a 2-d numpy array), and a tile is blocked if it is 
+    # <collision_block_char>. 
+    # <version> is increased whenever a tile is blocked or unblocked, so that
+    # whatever is computed from the grid can tell that it is out of date. 
+    blocked = np.asarray(collision_maze) == str(collision_block_char)
+    self.height, self.width = blocked.shape
+    self.blocked = blocked.reshape(-1).tolist()
+    self.version = 0
+
+
+  def in_bounds(self, tile): 
+    return 0 <= tile[0] < self.width and 0 <= tile[1] < self.height
+
+
+  def set_blocked(self, tile, blocked): 
+    """
+    Blocks or unblocks a tile. 
+
+    INPUT
+      tile: The (x, y) tile. 
+      blocked: Whether the tile is to be a collision block. 
+    OUTPUT
+      None
+    """
+    i = tile[1] * self.width + tile[0]
+    if self.blocked[i] != bool(blocked): 
+      self.blocked[i] = bool(blocked)
+      self.version += 1
+
+
+@traced("path_finder", "path")
+def find_closest_path(grid, start, targets, max_distance=None): 
+  """
+  Finds which of <targets> is the closest to <start>, and a shortest path to
+  it that does not step on any collision block, moving up, down, left or 
+  right, in a single search. 
+
+  This is a breadth-first search that labels the tiles with their distance
+  from <start>, one distance at a time, until a target is labeled, and then 
+  walks back from that target. For a single target, it finds the same paths
+  as path_finder_v2, which rescanned the whole maze for every distance and 
+  gave up after 150 of them, but it visits every tile at most once and has 
+  no such limit. 
+
+  INPUT
+    grid: The <CollisionGrid> of the maze. 
+    start: The (x, y) tile to start from. It may itself be blocked. 
+    targets: The (x, y) tiles to go to. Of the targets at the same 
+             distance, the one that comes first is taken. 
+    max_distance: If given, the search gives up on the targets that are 
+                  farther than this from <start>. 
+  OUTPUT
+    (target, path): the closest target that can be reached (an element of 
+    <targets>) and the path to it as a list of (x, y) tiles, starting with 
+    <start> and ending with the target, or (None, None) if none of the 
+    targets can be reached from <start>. 
+  EXAMPLE OUTPUT
+    ((57, 12), [(58, 9), (58, 10), (57, 10), (57, 11), (57, 12)])
+  """
+  width = grid.width
+  size = width * grid.height
+  blocked = grid.blocked
+  # <target_order> maps the tiles of the targets to their positions in 
+  # <targets>. 
+  targets = list(targets)
+  target_order = dict()
+  for count, tile in enumerate(targets): 
+    if grid.in_bounds(tile): 
+      target_order.setdefault(tile[1] * width + tile[0], count)
+  if not grid.in_bounds(start) or not target_order: 
+    tracer.add("unreachable")
+    return None, None
+  start_i = start[1] * width + start[0]
+
+  # <dist> is the distance of every tile from <start>, or -1 if it has not 
+  # been reached yet. <frontier> holds the tiles at distance <k>, and 
+  # <reached> the targets among them. 
+  dist = [-1] * size
+  dist[start_i] = 0
+  frontier = [start_i]
+  reached = [start_i] if start_i in target_order else []
+  k = 0
+  while not reached and frontier and k != max_distance: 
+    k += 1
+    next_frontier = []
+    for i in frontier: 
+      x = i % width
+      for j in (i - width, i - 1 if x > 0 else -1, 
+                i + width, i + 1 if x < width - 1 else -1): 
+        if 0 <= j < size and dist[j] < 0 and not blocked[j]: 
+          dist[j] = k
+          next_frontier += [j]
+          if j in target_order: 
+            reached += [j]
+    frontier = next_frontier
+  if not reached: 
+    tracer.add("unreachable")
+    return None, None
+  end_i = min(reached, key=lambda i: target_order[i])
+
+  # We walk back from the target, always to a neighbor that is one step 
+  # closer to <start>, trying the neighbors in the same order as 
+  # path_finder_v2. 
+  i = end_i
+  the_path = [(end_i % width, end_i // width)]
+  for k in range(dist[end_i] - 1, -1, -1): 
+    x = i % width
+    if i >= width and dist[i - width] == k: 
+      i -= width
+    elif x > 0 and dist[i - 1] == k: 
+      i -= 1
+    elif i + width < size and dist[i + width] == k: 
+      i += width
+    else: 
+      i += 1
+    the_path += [(i % width, i // width)]
+  the_path.reverse()
+  return targets[target_order[end_i]], the_path
+
+
+def find_path(grid, start, end): 
+  """
+  Finds a shortest path from <start> to <end> (see find_closest_path). 
+
+  INPUT
+    grid: The <CollisionGrid> of the maze. 
+    start: The (x, y) tile to start from. 
+    end: The (x, y) tile to go to. 
+  OUTPUT
+    The path as a list of (x, y) tiles, starting with <start> and ending 
+    with <end>, or None if <end> cannot be reached from <start>. 
+  EXAMPLE OUTPUT
+    [(58, 9), (58, 10), (57, 10), ...]
+  """
+  return find_closest_path(grid, start, [end])[1]
+
+
+def distance_field(grid, targets): 
+  """
+  Computes the distance of every tile to the closest of <targets> with a 
+  breadth-first search that starts from all of them at once. 
+
+  Collision blocks are labeled with their distance as well, but the search
+  does not go through them, so a persona standing on a collision block can 
+  still find its way out, as with find_path. Targets that are collision 
+  blocks cannot be reached. 
+
+  INPUT
+    grid: The <CollisionGrid> of the maze. 
+    targets: The (x, y) tiles to compute the distances to. 
+  OUTPUT
+    The distances as an array of <width> * <height> ints in row-major order,
+    with -1 for the tiles from which no target can be reached. 
+  """
+  width = grid.width
+  size = width * grid.height
+  blocked = grid.blocked
+  field = array.array("i", [-1]) * size
+  frontier = []
+  for tile in targets: 
+    i = tile[1] * width + tile[0]
+    if grid.in_bounds(tile) and not blocked[i] and field[i] < 0: 
+      field[i] = 0
+      frontier += [i]
+  k = 0
+  while frontier: 
+    k += 1
+    next_frontier = []
+    for i in frontier: 
+      x = i % width
+      for j in (i - width, i - 1 if x > 0 else -1, 
+                i + width, i + 1 if x < width - 1 else -1): 
+        if 0 <= j < size and field[j] < 0: 
+          field[j] = k
+          if not blocked[j]: 
+            next_frontier += [j]
+    frontier = next_frontier
+  return field
+
+
+@traced("path_finder", "path")
+def path_from_distance_field(grid, field, start): 
+  """
+  Finds a shortest path from <start> to the closest target of a distance 
+  field by walking down the field, one step closer at every tile. 
+
+  INPUT
+    grid: The <CollisionGrid> of the maze. 
+    field: The distance field of the targets (see distance_field). 
+    start: The (x, y) tile to start from. 
+  OUTPUT
+    The path as a list of (x, y) tiles, starting with <start> and ending 
+    with the target, or None if no target can be reached from <start>. 
+  """
+  if not grid.in_bounds(start): 
+    return None
+  width = grid.width
+  size = width * grid.height
+  blocked = grid.blocked
+  i = start[1] * width + start[0]
+  if field[i] < 0: 
+    return None
+
+  the_path = [(start[0], start[1])]
+  for k in range(field[i] - 1, -1, -1): 
+    x = i % width
+    for j in (i - width, i - 1 if x > 0 else -1, 
+              i + width, i + 1 if x < width - 1 else -1): 
+      if 0 <= j < size and field[j] == k and not blocked[j]: 
+        i = j
+        break
+    the_path += [(i % width, i // width)]
+  return the_path
+
+
+class DistanceFields: 
+  """
+  The distance fields (see distance_field) of the destinations that have 
+  been looked up, e.g., the addresses of maze.address_tiles, kept under a 
+  memory budget. When the budget is exceeded, the fields that were used 
+  least recently are dropped, and computed again when they are needed. 
+  All the fields are dropped when the collision grid changes. 
+  """
+  def __init__(self, grid, budget): 
+    # <grid> is the <CollisionGrid> the fields are computed on, and <budget>
+    # the number of bytes the fields may take. 
+    # <fields> maps every key to its field, from the least to the most 
+    # recently used, and <version> is the version of <grid> they are for. 
+    self.grid = grid
+    self.budget = budget
+    self.fields = collections.OrderedDict()
+    self.size = 0
+    self.version = grid.version
+
+
+  def get(self, key, targets): 
+    """
+    Returns the distance field of a destination, computing it if it is not
+    cached. 
+
+    INPUT
+      key: The key of the destination, e.g., its string address. 
+      targets: The (x, y) tiles of the destination. 
+    OUTPUT
+      The distance field. 
+    """
+    if self.version != self.grid.version: 
+      self.clear()
+      self.version = self.grid.version
+    if key in self.fields: 
+      self.fields.move_to_end(key)
+      tracer.add("distance_field_hits")
+      return self.fields[key]
+
+    field = distance_field(self.grid, targets)
+    self.fields[key] = field
+    self.size += field.itemsize * len(field)
+    while self.size > self.budget and len(self.fields) > 1: 
+      _, dropped = self.fields.popitem(last=False)
+      self.size -= dropped.itemsize * len(dropped)
+    return field
+
+
+  def clear(self): 
+    self.fields.clear()
+    self.size = 0
+
+
+class PathCache: 
+  """
+  The paths that have been found lately, since the personas walk the same 
+  routes over and over (e.g., from home to Hobbs Cafe every day). The paths
+  are keyed by their start, their targets and the version of the collision
+  grid, so that a path is never used after the grid has changed, and when 
+  the cache holds <size> paths, the one used least recently is dropped. 
+  The cached paths must not be changed. 
+  """
+  def __init__(self, grid, size): 
+    # <grid> is the <CollisionGrid> the paths are on, and <size> the number 
+    # of paths to keep. 
+    # <paths> maps every key to its result, from the least to the most 
+    # recently used. <hits> and <misses> count the lookups. 
+    self.grid = grid
+    self.size = size
+    self.paths = collections.OrderedDict()
+    self.version = grid.version
+    self.hits = 0
+    self.misses = 0
+
+
+  def get(self, key, find): 
+    """
+    Returns the cached result for <key>, or finds and caches it. 
+
+    INPUT
+      key: A tuple that identifies the search, e.g., ("closest", start, 
+           targets). The version of the collision grid is added to it. 
+      find: A function that does the search and returns its result. 
+    OUTPUT
+      The result of the search. 
+    """
+    if self.version != self.grid.version: 
+      # The paths of an older version are of no use anymore. 
+      self.paths.clear()
+      self.version = self.grid.version
+    key = key + (self.version,)
+    if key in self.paths: 
+      self.paths.move_to_end(key)
+      self.hits += 1
+      tracer.add("path_cache_hits")
+      return self.paths[key]
+
+    self.misses += 1
+    tracer.add("path_cache_misses")
+    result = find()
+    if self.size > 0: 
+      self.paths[key] = result
+      if len(self.paths) > self.size: 
+        self.paths.popitem(last=False)
+    return result
+
+
+  def find_closest_path(self, start, targets): 
+    """
+    find_closest_path on the grid of the cache, with the result cached. 
+    """
+    key = ("closest", (start[0], start[1]), 
+           tuple((tile[0], tile[1]) for tile in targets))
+    return self.get(key, lambda: find_closest_path(self.grid, start, targets))
+
+
+  def find_path(self, start, end): 
+    """
+    find_path on the grid of the cache, with the result cached. 
+    """
+    return self.find_closest_path(start, [end])[1]
+
+
+  def metrics(self): 
+    """
+    Returns the number of hits and misses of the cache, its hit rate and the
+    number of paths it holds. 
+    """
+    lookups = self.hits + self.misses
+    return {"hits": self.hits, 
+            "misses": self.misses, 
+            "hit_rate": self.hits / lookups if lookups else 0, 
+            "paths": len(self.paths)}
+
+
 def path_finder(maze, start, end, collision_block_char, verbose=False):
-  # EMERGENCY PATCH
-  start = (start[1], start[0])
-  end = (end[1], end[0])
-  # END EMERGENCY PATCH
-
-  path = path_finder_v2(maze, start, end, collision_block_char, verbose)
-
-  new_path = []
-  for i in path: 
-    new_path += [(i[1], i[0])]
-  path = new_path
-  
-  return path
+  """
+  Finds a shortest path from <start> to <end> in a raw collision maze (see 
+  find_path). The collision grid is built anew on every call, so the 
+  simulation calls find_path with the <collision_grid> of its Maze instead.
+
+  INPUT
+    maze: The raw collision maze, in rows of strings. 
+    start: The (x, y) tile to start from. 
+    end: The (x, y) tile to go to. 
+    collision_block_char: The collision block marker. 
+  OUTPUT
+    The path as a list of (x, y) tiles, or None if <end> cannot be reached.
+  """
+  return find_path(CollisionGrid(maze, collision_block_char), start, end)
 
 
 def closest_coordinate(curr_coordinate, target_coordinates): 
@@ -225,7 +590,7 @@ def path_finder_3(maze, start, end, collision_block_char, verbose=False):
   # end => persona_b
 
   curr_path = path_finder(maze, start, end, collision_block_char, verbose=False)
-  if len(curr_path) <= 2: 
+  if not curr_path or len(curr_path) <= 2: 
     return []
   else: 
     a_path = curr_path[:int(len(curr_path)/2)]
@@ -0,0 +1,395 @@
+"""
+File: path_hierarchy.py
+Description: Hierarchical path finding, in the manner of HPA*, for maps that
+are much larger than the Ville, where searching the whole tile grid for
+every action of every persona does not scale. It is used instead of the
+tile-level search of path_finder.py when <hierarchical_paths> is set in
+utils.py (see Maze.get_path_hierarchy).
+
+The walkable tiles are split into clusters: the connected parts of every
+arena (or of every sector, for the tiles that are not in an arena) within
+blocks of CLUSTER_SIZE x CLUSTER_SIZE tiles. Where two clusters touch, every
+straight run of touching tiles is an entrance, and the pair of tiles in the
+middle of the entrance (or at both of its ends, if it is long) is a
+transition. The tiles of the transitions are the nodes of the abstract
+graph: the two tiles of a transition are one step apart, and the nodes of a
+cluster are as far apart as the shortest path between them inside the
+cluster.
+
+A route is planned on the abstract graph first: from the start tile to the
+nodes of its cluster, through the graph, and from the nodes of the targets'
+clusters to the targets. The route is a list of waypoints, and only its
+first segments are refined into tiles (see refine_route); the rest are
+refined as the persona walks. The routes are shortest paths through the
+transitions, which are close to, but not always, the shortest paths.
+
+The paths within clusters are searched when they are first needed and then
+kept, until the collision grid changes (see CollisionGrid.version), at
+which point the whole hierarchy is built anew.
+"""
+import heapq
+import itertools
+
+from path_finder import find_closest_path
+
+# <CLUSTER_SIZE> is the width and height, in tiles, of the blocks that the
+# clusters are confined to.
+CLUSTER_SIZE = 24
+# <LONG_ENTRANCE> is the length from which an entrance gets a transition at
+# both of its ends rather than one in its middle.
+LONG_ENTRANCE = 6
+# <NEAR_DISTANCE> is the distance within which a target is near enough to
+# search for at tile level right away, which costs little and avoids the
+# detours through the transitions that routes over short distances would
+# take.
+NEAR_DISTANCE = CLUSTER_SIZE
+# <REFINED_SEGMENTS> is the number of route segments refine_route turns into
+# tiles at a time.
+REFINED_SEGMENTS = 3
+
+
+class PathHierarchy:
+  def __init__(self, grid, regions):
+    # <grid> is the <CollisionGrid> of the maze, and <regions> a flat list
+    # with the same layout that numbers the (world, sector, arena) of every
+    # tile.
+    self.grid = grid
+    self.regions = regions
+    self.build()
+
+
+  def build(self):
+    """
+    Splits the walkable tiles into clusters and finds the transitions
+    between them.
+
+    INPUT
+      None
+    OUTPUT
+      None
+    """
+    # <version> is the version of the collision grid the hierarchy is for.
+    # <clusters> is the cluster of every tile, or -1 for the collision
+    # blocks, and <cluster_nodes> the set of the nodes of every cluster.
+    # <links> maps every node to the nodes one step away in other clusters.
+    # <trees> caches, for the nodes that have been searched from, the
+    # distance of the tiles of their cluster to them and the next tile on
+    # the way (see search_cluster), and <edges> their edges (see
+    # get_edges).
+    self.version = self.grid.version
+    width = self.grid.width
+    height = self.grid.height
+    size = width * height
+    blocked = self.grid.blocked
+    regions = self.regions
+
+    clusters = [-1] * size
+    count = 0
+    for i in range(size):
+      if clusters[i] >= 0 or blocked[i]:
+        continue
+      key = (regions[i], (i % width) // CLUSTER_SIZE,
+             (i // width) // CLUSTER_SIZE)
+      clusters[i] = count
+      frontier = [i]
+      while frontier:
+        next_frontier = []
+        for j in frontier:
+          x = j % width
+          for k in (j - width, j - 1 if x > 0 else -1,
+                    j + width, j + 1 if x < width - 1 else -1):
+            if (0 <= k < size and clusters[k] < 0 and not blocked[k]
+                and (regions[k], (k % width) // CLUSTER_SIZE,
+                     (k // width) // CLUSTER_SIZE) == key):
+              clusters[k] = count
+              next_frontier += [k]
+        frontier = next_frontier
+      count += 1
+    self.clusters = clusters
+    self.cluster_nodes = [set() for _ in range(count)]
+    self.links = dict()
+    self.trees = dict()
+    self.edges = dict()
+
+    # The entrances between horizontal neighbors run down the columns, and
+    # those between vertical neighbors along the rows.
+    for x in range(width - 1):
+      self.add_entrances([(y * width + x, y * width + x + 1)
+                          for y in range(height)])
+    for y in range(height - 1):
+      self.add_entrances([(y * width + x, (y + 1) * width + x)
+                          for x in range(width)])
+
+
+  def add_entrances(self, pairs):
+    """
+    Adds the transitions of the entrances along a line of neighboring tile
+    pairs.
+
+    INPUT
+      pairs: The (a, b) pairs of neighboring flat tile indices, in the order
+             of the line.
+    OUTPUT
+      None
+    """
+    clusters = self.clusters
+    run = []
+    for a, b in pairs + [(None, None)]:
+      if (run and (a is None or clusters[a] != clusters[run[0][0]]
+                   or clusters[b] != clusters[run[0][1]])):
+        if len(run) >= LONG_ENTRANCE:
+          transitions = [run[0], run[-1]]
+        else:
+          transitions = [run[len(run) // 2]]
+        for i, j in transitions:
+          self.links.setdefault(i, set()).add(j)
+          self.links.setdefault(j, set()).add(i)
+          self.cluster_nodes[clusters[i]].add(i)
+          self.cluster_nodes[clusters[j]].add(j)
+        run = []
+      if (a is not None and clusters[a] >= 0 and clusters[b] >= 0
+          and clusters[a] != clusters[b]):
+        run += [(a, b)]
+
+
+  def search_cluster(self, sources):
+    """
+    Searches the cluster of <sources> breadth-first from all of them at
+    once, without leaving the cluster.
+
+    INPUT
+      sources: Flat tile indices in the same cluster.
+    OUTPUT
+      (dist, parent): the distance of the tiles of the cluster that can be
+      reached to the closest source, and the next tile on the way there
+      (None for the sources).
+    """
+    width = self.grid.width
+    size = len(self.clusters)
+    clusters = self.clusters
+    cluster = clusters[sources[0]]
+    dist = dict.fromkeys(sources, 0)
+    parent = dict.fromkeys(sources)
+    frontier = list(dist)
+    k = 0
+    while frontier:
+      k += 1
+      next_frontier = []
+      for i in frontier:
+        x = i % width
+        for j in (i - width, i - 1 if x > 0 else -1,
+                  i + width, i + 1 if x < width - 1 else -1):
+          if 0 <= j < size and j not in dist and clusters[j] == cluster:
+            dist[j] = k
+            parent[j] = i
+            next_frontier += [j]
+      frontier = next_frontier
+    return dist, parent
+
+
+  def get_tree(self, node):
+    if node not in self.trees:
+      self.trees[node] = self.search_cluster([node])
+    return self.trees[node]
+
+
+  def get_edges(self, node):
+    """
+    Returns the edges of a node of the abstract graph as a list of (other
+    node, distance): one step to the nodes it is linked to, and the
+    distance inside the cluster to the other nodes of its cluster.
+    """
+    if node not in self.edges:
+      dist, _ = self.get_tree(node)
+      self.edges[node] = ([(other, 1) for other in self.links[node]]
+                          + [(other, dist[other])
+                             for other in self.cluster_nodes[
+                                            self.clusters[node]]
+                             if other in dist and other != node])
+    return self.edges[node]
+
+
+  def find_route(self, start, targets):
+    """
+    Plans a route from <start> to the closest of <targets> on the abstract
+    graph.
+
+    INPUT
+      start: The (x, y) tile to start from.
+      targets: The (x, y) tiles to go to.
+    OUTPUT
+      (target, route): the target the route leads to (an element of
+      <targets>) and the route as a list of (x, y) waypoints, starting with
+      <start> and ending with the target, or (None, None) if none of the
+      targets can be reached.
+    """
+    if self.version != self.grid.version:
+      self.build()
+    grid = self.grid
+    width = grid.width
+    clusters = self.clusters
+    targets = list(targets)
+    s = start[1] * width + start[0]
+    if not grid.in_bounds(start) or clusters[s] < 0:
+      # A persona standing on a collision block has no cluster, so we search
+      # its way out at tile level. A path is a route as well.
+      return find_closest_path(grid, start, targets)
+    for tile in targets:
+      if abs(tile[0] - start[0]) + abs(tile[1] - start[1]) <= NEAR_DISTANCE:
+        target, path = find_closest_path(grid, start, targets, NEAR_DISTANCE)
+        if path:
+          return target, path
+        break
+
+    # <target_tiles> maps the flat indices of the targets to the targets,
+    # and <goal_trees> holds the search from the targets of every cluster.
+    target_tiles = dict()
+    for tile in targets:
+      i = tile[1] * width + tile[0]
+      if grid.in_bounds(tile) and clusters[i] >= 0:
+        target_tiles.setdefault(i, tile)
+    if not target_tiles:
+      return None, None
+    goal_sources = dict()
+    for i in target_tiles:
+      goal_sources.setdefault(clusters[i], []).append(i)
+    goal_trees = dict()
+    for cluster, sources in goal_sources.items():
+      goal_trees[cluster] = self.search_cluster(sources)
+
+    # This is an A* search, with the distance along the axes to the closest
+    # target as the estimate of the rest of the way. The heap holds 
+    # (estimate, order, cost, node, previous node, target) entries, where a 
+    # None node is the goal, reached through <target>. <best> holds the 
+    # lowest cost a node has been pushed with, and <previous> the previous 
+    # node of the nodes that have been popped. 
+    target_xy = [(i % width, i // width) for i in target_tiles]
+    def estimate(i): 
+      x = i % width
+      y = i // width
+      return min(abs(x - tx) + abs(y - ty) for tx, ty in target_xy)
+
+    order = itertools.count()
+    heap = []
+    best = dict()
+    start_dist, _ = self.search_cluster([s])
+    for node in self.cluster_nodes[clusters[s]]:
+      if node in start_dist:
+        best[node] = start_dist[node]
+        heap += [(start_dist[node] + estimate(node), next(order), 
+                  start_dist[node], node, s, None)]
+    for i in goal_sources.get(clusters[s], []):
+      if i in start_dist:
+        heap += [(start_dist[i], next(order), start_dist[i], None, s, i)]
+    heapq.heapify(heap)
+
+    previous = dict()
+    while heap:
+      _, _, cost, node, via, target = heapq.heappop(heap)
+      if node is None:
+        route = [target]
+        while via != s:
+          route += [via]
+          via = previous[via]
+        route += [s]
+        route.reverse()
+        return (target_tiles[target],
+                [(i % width, i // width) for i in route])
+      if node in previous:
+        continue
+      previous[node] = via
+
+      cluster = clusters[node]
+      if cluster in goal_trees and node in goal_trees[cluster][0]:
+        goal_dist, goal_parent = goal_trees[cluster]
+        target = node
+        while goal_parent[target] is not None:
+          target = goal_parent[target]
+        heapq.heappush(heap, (cost + goal_dist[node], next(order), 
+                              cost + goal_dist[node], None, node, target))
+      for other, other_cost in self.get_edges(node): 
+        other_cost += cost
+        if other_cost < best.get(other, other_cost + 1): 
+          best[other] = other_cost
+          heapq.heappush(heap, (other_cost + estimate(other), next(order),
+                                other_cost, other, node, None))
+    return None, None
+
+
+  def refine_segment(self, a, b):
+    """
+    Returns the tiles of the shortest path inside a cluster from <a> to <b>
+    (flat tile indices), without <a>, or None if there is none, e.g.,
+    because the collision grid has changed since the route was planned.
+    """
+    width = self.grid.width
+    if a == b:
+      return []
+    if ((abs(a - b) == width or (abs(a - b) == 1 and a // width == b // width))
+        and not self.grid.blocked[b]):
+      return [b]
+    clusters = self.clusters
+    if clusters[a] < 0 or clusters[a] != clusters[b]:
+      return None
+    if b in self.links or b in self.trees:
+      # The tree of <b> leads from <a> straight to <b>.
+      dist, parent = self.get_tree(b)
+      if a not in dist:
+        return None
+      tiles = []
+      while parent[a] is not None:
+        a = parent[a]
+        tiles += [a]
+      return tiles
+    if a in self.links:
+      dist, parent = self.get_tree(a)
+    else:
+      dist, parent = self.search_cluster([a])
+    if b not in dist:
+      return None
+    tiles = []
+    while b != a:
+      tiles += [b]
+      b = parent[b]
+    tiles.reverse()
+    return tiles
+
+
+  def refine_route(self, route):
+    """
+    Turns the first REFINED_SEGMENTS segments of a route into tiles. If a
+    segment cannot be refined anymore because the collision grid has
+    changed, the route is planned again from its first waypoint.
+
+    INPUT
+      route: The route as a list of (x, y) waypoints (see find_route).
+    OUTPUT
+      (path, route): the path as a list of (x, y) tiles, starting with the
+      first waypoint, and the rest of the route, starting with the last tile
+      of <path> (an empty list if the whole route has been refined). The
+      path is just the first waypoint if the end of the route cannot be
+      reached anymore.
+    """
+    if self.version != self.grid.version:
+      self.build()
+    width = self.grid.width
+    waypoints = [tile[1] * width + tile[0] for tile in route]
+    path = [waypoints[0]]
+    count = 0
+    while count < REFINED_SEGMENTS and count + 1 < len(waypoints):
+      tiles = self.refine_segment(waypoints[count], waypoints[count + 1])
+      if tiles is None:
+        start = (path[-1] % width, path[-1] // width)
+        _, new_route = self.find_route(start, [route[-1]])
+        if not new_route:
+          return ([(i % width, i // width) for i in path], [])
+        rest_path, rest = self.refine_route(new_route)
+        return ([(i % width, i // width) for i in path] + rest_path[1:],
+                rest)
+      path += tiles
+      count += 1
+
+    rest = [tuple(tile) for tile in route[count:]]
+    if len(rest) < 2:
+      rest = []
+    return [(i % width, i // width) for i in path], rest
@@ -0,0 +1,219 @@
+"""
+File: path_reservations.py
+Description: Cooperative path planning for many personas, in the manner of
+cooperative A*. Normally, every persona plans its path as if it were alone
+on the map, so with many personas the paths keep running into each other.
+When <cooperative_paths> is set in utils.py, the maze keeps a
+ReservationTable of the tile every persona will be on at every step of its
+planned path, and of the tile it stops on at the end. The new paths of a
+step are planned one after another, in the fixed order in which the
+personas execute, each around the reservations of the paths planned before
+it: a persona may take a detour or wait a step to let another one pass,
+and neither ends up on a tile another persona will be on at the same step,
+nor swaps tiles with another persona.
+
+A persona is said to be on the tiles of its path at the steps it gets
+there: the persona that is on path[0] when it executes at step <step> is on
+path[1] after that step, on path[2] after <step> + 1, and so on.
+"""
+import heapq
+import itertools
+
+from path_finder import distance_field
+from tracer import tracer
+
+# <COOPERATIVE_SLACK> is the number of steps a cooperative path may be longer
+# than the persona's shortest path. If no path within that many steps avoids
+# the other personas, the shortest path is taken as it is.
+COOPERATIVE_SLACK = 10
+
+
+class ReservationTable:
+  def __init__(self):
+    # <step> is the current step of the simulation (see set_step).
+    # <reserved> maps every reserved (x, y) tile to {step: persona name},
+    # and <parked> maps the tiles the personas stop on to (persona name,
+    # the step from which the persona is there).
+    # <persona_cells> is the list of the (tile, step) reservations of every
+    # persona, and <step_tiles> the list of the tiles reserved at every
+    # step, so that they can be dropped.
+    self.step = 0
+    self.reserved = dict()
+    self.parked = dict()
+    self.persona_cells = dict()
+    self.step_tiles = dict()
+
+
+  def set_step(self, step):
+    """
+    Moves the table on to <step>, dropping the reservations of the steps
+    that are over.
+
+    INPUT
+      step: The current step of the simulation.
+    OUTPUT
+      None
+    """
+    self.step = step
+    for past_step in [i for i in self.step_tiles if i < step - 1]:
+      for tile in self.step_tiles.pop(past_step):
+        tile_steps = self.reserved.get(tile)
+        if tile_steps and tile_steps.pop(past_step, None) is not None:
+          if not tile_steps:
+            del self.reserved[tile]
+
+
+  def release(self, persona_name):
+    """
+    Drops all the reservations of a persona.
+    """
+    for tile, step in self.persona_cells.pop(persona_name, []):
+      tile_steps = self.reserved.get(tile)
+      if tile_steps and tile_steps.get(step) == persona_name:
+        del tile_steps[step]
+        if not tile_steps:
+          del self.reserved[tile]
+    for tile in [i for i, (name, _) in self.parked.items()
+                 if name == persona_name]:
+      del self.parked[tile]
+
+
+  def reserve(self, persona_name, path):
+    """
+    Reserves the tiles of a path, planned at the current step, for a
+    persona, and the last tile for as long as the persona stays there.
+
+    INPUT
+      persona_name: The name of the persona.
+      path: The path as a list of (x, y) tiles, starting with the persona's
+            current tile.
+    OUTPUT
+      None
+    """
+    cells = []
+    for count, tile in enumerate(path[1:]):
+      tile = (tile[0], tile[1])
+      step = self.step + count
+      self.reserved.setdefault(tile, dict())[step] = persona_name
+      self.step_tiles.setdefault(step, []).append(tile)
+      cells += [(tile, step)]
+    self.persona_cells[persona_name] = cells
+    end = (path[-1][0], path[-1][1])
+    self.parked[end] = (persona_name, self.step + len(path) - 2)
+
+
+  def get_persona(self, tile, step):
+    """
+    Returns the name of the persona that is on a tile at a step according
+    to the reservations, or None.
+    """
+    name = self.reserved.get(tile, dict()).get(step)
+    if name is None and tile in self.parked and step >= self.parked[tile][1]:
+      name = self.parked[tile][0]
+    return name
+
+
+  def can_stop(self, persona_name, tile, step):
+    """
+    Returns whether a persona can stop on a tile from a step on, i.e.,
+    whether no other persona will be there from then on.
+    """
+    if tile in self.parked and self.parked[tile][0] != persona_name:
+      return False
+    for other_step, name in self.reserved.get(tile, dict()).items():
+      if other_step >= step and name != persona_name:
+        return False
+    return True
+
+
+  def find_path(self, grid, persona_name, start, end, max_length):
+    """
+    Finds a path from <start> to <end> that avoids the reservations of the
+    other personas, with an A* search over (tile, step) pairs in which the
+    persona can move to a neighboring tile or wait where it is at every
+    step. The distances to <end> that ignore the other personas are the
+    estimate of the rest of the way.
+
+    INPUT
+      grid: The <CollisionGrid> of the maze.
+      persona_name: The name of the persona.
+      start: The (x, y) tile the persona is on.
+      end: The (x, y) tile to go to.
+      max_length: The largest number of steps the path may take.
+    OUTPUT
+      The path as a list of (x, y) tiles, starting with <start> and ending
+      with <end>, in which a tile is repeated for every step the persona
+      waits, or None if there is no such path.
+    """
+    width = grid.width
+    size = width * grid.height
+    blocked = grid.blocked
+    field = distance_field(grid, [end])
+    start_i = start[1] * width + start[0]
+    end_i = end[1] * width + end[0]
+    if field[start_i] < 0 or field[start_i] > max_length:
+      return None
+
+    # The heap holds (estimate, -steps, order, tile) entries, and <parent>
+    # the previous (tile, steps) of every (tile, steps) reached so far.
+    order = itertools.count()
+    heap = [(field[start_i], 0, next(order), start_i)]
+    parent = {(start_i, 0): None}
+    while heap:
+      _, steps, _, i = heapq.heappop(heap)
+      steps = -steps
+      if i == end_i and self.can_stop(persona_name, end, self.step + steps - 1):
+        path = []
+        state = (i, steps)
+        while state:
+          path += [(state[0] % width, state[0] // width)]
+          state = parent[state]
+        path.reverse()
+        return path
+
+      step = self.step + steps
+      x = i % width
+      for j in (i, i - width, i - 1 if x > 0 else -1,
+                i + width, i + 1 if x < width - 1 else -1):
+        if (j < 0 or j >= size or (j != i and blocked[j]) or field[j] < 0
+            or steps + 1 + field[j] > max_length
+            or (j, steps + 1) in parent):
+          continue
+        tile = (j % width, j // width)
+        other = self.get_persona(tile, step)
+        if other is not None and other != persona_name:
+          continue
+        # Two personas cannot swap their tiles either.
+        other = self.get_persona(tile, step - 1)
+        if (j != i and other is not None and other != persona_name
+            and self.get_persona((x, i // width), step) == other):
+          continue
+        parent[(j, steps + 1)] = (i, steps)
+        heapq.heappush(heap, (steps + 1 + field[j], -(steps + 1),
+                              next(order), j))
+    return None
+
+
+  def plan_path(self, grid, persona_name, path):
+    """
+    Replaces the path a persona planned on its own with one to the same
+    tile that avoids the other personas, if there is one that is at most
+    COOPERATIVE_SLACK steps longer, and reserves it.
+
+    INPUT
+      grid: The <CollisionGrid> of the maze.
+      persona_name: The name of the persona.
+      path: The shortest path as a list of (x, y) tiles, starting with the
+            persona's current tile.
+    OUTPUT
+      The path to take.
+    """
+    self.release(persona_name)
+    cooperative_path = self.find_path(grid, persona_name, path[0], path[-1],
+                                      len(path) - 1 + COOPERATIVE_SLACK)
+    if cooperative_path:
+      path = cooperative_path
+    else:
+      tracer.add("path_conflicts")
+    self.reserve(persona_name, path)
+    return path
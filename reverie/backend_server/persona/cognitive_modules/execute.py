@@ -41,6 +41,15 @@ def execute(persona, maze, personas, plan):
     # <target_tiles> is a list of tile coordinates where the persona may go 
     # to execute the current action. The goal is to pick one of them.
     target_tiles = None
+    # <path> is the path to the chosen target tile, once we have it. 
+    path = None
+    persona_name_set = set(personas.keys())
+    # On maps much larger than the Ville, the maze has a path hierarchy, 
+    # which plans the path over the transitions between the arenas and 
+    # sectors first, and leaves most of it in <planned_route> to be turned 
+    # into tiles as the persona walks. 
+    path_hierarchy = maze.get_path_hierarchy()
+    persona.scratch.planned_route = []
 
     print ('aldhfoaf/????')
     print (plan)
@@ -49,25 +58,16 @@ def execute(persona, maze, personas, plan):
       # Executing persona-persona interaction.
       target_p_tile = (personas[plan.split("<persona>")[-1].strip()]
                        .scratch.curr_tile)
-      potential_path = path_finder(maze.collision_maze, 
-                                   persona.scratch.curr_tile, 
-                                   target_p_tile, 
-                                   collision_block_id)
-      if len(potential_path) <= 2: 
-        target_tiles = [potential_path[0]]
+      potential_path = maze.path_cache.find_path(persona.scratch.curr_tile, 
+                                                 target_p_tile)
+      if not potential_path or len(potential_path) <= 2: 
+        # We are already next to the other persona (or cannot reach them), 
+        # so we stay where we are. 
+        path = [persona.scratch.curr_tile]
       else: 
-        potential_1 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)], 
-                                collision_block_id)
-        potential_2 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)+1], 
-                                collision_block_id)
-        if len(potential_1) <= len(potential_2): 
-          target_tiles = [potential_path[int(len(potential_path)/2)]]
-        else: 
-          target_tiles = [potential_path[int(len(potential_path)/2+1)]]
+        # We meet halfway. The first half of the path to the other persona 
+        # is a shortest path to its midpoint, so we need not search again.
+        path = potential_path[:int(len(potential_path)/2)+1]
     
     elif "<waiting>" in plan: 
       # Executing interaction where the persona has decided to wait before 
@@ -80,7 +80,7 @@ def execute(persona, maze, personas, plan):
       # Executing a random location action.
       plan = ":".join(plan.split(":")[:-1])
       target_tiles = maze.address_tiles[plan]
-      target_tiles = random.sample(list(target_tiles), 1)
+      target_tiles = persona.rng.sample(list(target_tiles), 1)
 
     else: 
       # This is our default execution. We simply take the persona to the
@@ -92,53 +92,65 @@ def execute(persona, maze, personas, plan):
         maze.address_tiles["Johnson Park:park:park garden"] #ERRORRRRRRR
       else: 
         target_tiles = maze.address_tiles[plan]
-
-    # There are sometimes more than one tile returned from this (e.g., a tabe
-    # may stretch many coordinates). So, we sample a few here. And from that 
-    # random sample, we will take the closest ones. 
-    if len(target_tiles) < 4: 
-      target_tiles = random.sample(list(target_tiles), len(target_tiles))
-    else:
-      target_tiles = random.sample(list(target_tiles), 4)
-    # If possible, we want personas to occupy different tiles when they are 
-    # headed to the same location on the maze. It is ok if they end up on the 
-    # same time, but we try to lower that probability. 
-    # We take care of that overlap here.  
-    persona_name_set = set(personas.keys())
-    new_target_tiles = []
-    for i in target_tiles: 
-      curr_event_set = maze.access_tile(i)["events"]
-      pass_curr_tile = False
-      for j in curr_event_set: 
-        if j[0] in persona_name_set: 
-          pass_curr_tile = True
-      if not pass_curr_tile: 
-        new_target_tiles += [i]
-    if len(new_target_tiles) == 0: 
-      new_target_tiles = target_tiles
-    target_tiles = new_target_tiles
-
-    # Now that we've identified the target tile, we find the shortest path to
-    # one of the target tiles. 
-    curr_tile = persona.scratch.curr_tile
-    collision_maze = maze.collision_maze
-    closest_target_tile = None
-    path = None
-    for i in target_tiles: 
-      # path_finder takes a collision_mze and the curr_tile coordinate as 
-      # an input, and returns a list of coordinate tuples that becomes the
-      # path. 
+        # Most of the time, the persona simply heads to the closest tile of 
+        # the address. The distance field of the address, which the maze 
+        # caches, gives us the path to it right away, unless another persona
+        # is already there. (Maps with a path hierarchy are too large to 
+        # keep distance fields of.) 
+        if not path_hierarchy: 
+          path = maze.get_address_path(persona.scratch.curr_tile, plan)
+          if path and maze.tile_has_subject(path[-1], persona_name_set): 
+            path = None
+
+    if path is None: 
+      # There are sometimes more than one tile returned from this (e.g., a tabe
+      # may stretch many coordinates). So, we sample a few here. And from that 
+      # random sample, we will take the closest ones. 
+      if len(target_tiles) < 4: 
+        target_tiles = persona.rng.sample(list(target_tiles), len(target_tiles))
+      else:
+        target_tiles = persona.rng.sample(list(target_tiles), 4)
+      # If possible, we want personas to occupy different tiles when they are 
+      # headed to the same location on the maze. It is ok if they end up on the 
+      # same time, but we try to lower that probability. 
+      # We take care of that overlap here.  
+      new_target_tiles = []
+      for i in target_tiles: 
+        if not maze.tile_has_subject(i, persona_name_set): 
+          new_target_tiles += [i]
+      if len(new_target_tiles) == 0: 
+        new_target_tiles = target_tiles
+      target_tiles = new_target_tiles
+
+      # Now that we've identified the target tiles, we find the shortest 
+      # path to the closest of them. find_closest_path takes the curr_tile 
+      # coordinate and the target tiles as an input, and returns the closest
+      # target tile that can be reached and a list of coordinate tuples that
+      # becomes the path (from the path cache of the maze if it has been 
+      # found lately). 
       # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
-      curr_path = path_finder(maze.collision_maze, 
-                              curr_tile, 
-                              i, 
-                              collision_block_id)
-      if not closest_target_tile: 
-        closest_target_tile = i
-        path = curr_path
-      elif len(curr_path) < len(path): 
-        closest_target_tile = i
-        path = curr_path
+      if path_hierarchy: 
+        closest_target_tile, route = path_hierarchy.find_route(
+                                       persona.scratch.curr_tile, target_tiles)
+        if route: 
+          path, persona.scratch.planned_route = (path_hierarchy
+                                                 .refine_route(route))
+      else: 
+        closest_target_tile, path = maze.path_cache.find_closest_path(
+                                      persona.scratch.curr_tile, target_tiles)
+      # If none of the target tiles can be reached, we stay where we are. 
+      if path is None: 
+        path = [persona.scratch.curr_tile]
+
+    # With cooperative paths, the persona goes around the paths the other 
+    # personas have planned (a path hierarchy leaves most of the path 
+    # unknown, so there is nothing to reserve then). 
+    if maze.path_reservations: 
+      if persona.scratch.planned_route: 
+        maze.path_reservations.release(persona.name)
+      else: 
+        path = maze.path_reservations.plan_path(maze.collision_grid, 
+                                                persona.name, path)
 
     # Actually setting the <planned_path> and <act_path_set>. We cut the 
     # first element in the planned_path because it includes the curr_tile. 
@@ -151,6 +163,13 @@ def execute(persona, maze, personas, plan):
   if persona.scratch.planned_path: 
     ret = persona.scratch.planned_path[0]
     persona.scratch.planned_path = persona.scratch.planned_path[1:]
+  # We turn the next segments of the route into tiles as soon as the tiles
+  # run out, so that <planned_path> is only empty once we have arrived. 
+  if not persona.scratch.planned_path and persona.scratch.planned_route: 
+    path, persona.scratch.planned_route = (maze.get_path_hierarchy()
+                                           .refine_route(persona.scratch
+                                                         .planned_route))
+    persona.scratch.planned_path = path[1:]
 
   description = f"{persona.scratch.act_description}"
   description += f" @ {persona.scratch.act_address}"
@@ -7,11 +7,11 @@ Description: This defines the "Perceive" module for generative agents.
 import sys
 sys.path.append('../../')
 
-from operator import itemgetter
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
 from persona.prompt_template.run_gpt_prompt import *
 from persona.prompt_template.embedding import get_embedding
+from tracer import tracer
 
 def generate_poig_score(persona, event_type, description): 
   if "is idle" in description: 
@@ -42,15 +42,12 @@ def perceive(persona, maze):
     ret_events: a list of <ConceptNode> that are perceived and new. 
   """
   # PERCEIVE SPACE
-  # We get the nearby tiles given our current tile and the persona's vision
-  # radius. 
-  nearby_tiles = maze.get_nearby_tiles(persona.scratch.curr_tile, 
-                                       persona.scratch.vision_r)
-
-  # We then store the perceived space. Note that the s_mem of the persona is
-  # in the form of a tree constructed using dictionaries. 
-  for i in nearby_tiles: 
-    i = maze.access_tile(i)
+  # We store the space within the persona's vision radius. Note that the 
+  # s_mem of the persona is in the form of a tree constructed using 
+  # dictionaries. Tiles with the same names add nothing new, so we only go 
+  # through the distinct ones. 
+  for i in maze.get_nearby_tile_names(persona.scratch.curr_tile, 
+                                      persona.scratch.vision_r): 
     if i["world"]: 
       if (i["world"] not in persona.s_mem.tree): 
         persona.s_mem.tree[i["world"]] = {}
@@ -70,35 +67,16 @@ def perceive(persona, maze):
 
   # PERCEIVE EVENTS. 
   # We will perceive events that take place in the same arena as the
-  # persona's current arena. 
-  curr_arena_path = maze.get_tile_path(persona.scratch.curr_tile, "arena")
-  # We do not perceive the same event twice (this can happen if an object is
-  # extended across multiple tiles).
-  percept_events_set = set()
-  # We will order our percept based on the distance, with the closest ones
-  # getting priorities. 
-  percept_events_list = []
-  # First, we put all events that are occuring in the nearby tiles into the
-  # percept_events_list
-  for tile in nearby_tiles: 
-    tile_details = maze.access_tile(tile)
-    if tile_details["events"]: 
-      if maze.get_tile_path(tile, "arena") == curr_arena_path:  
-        # This calculates the distance between the persona's current tile, 
-        # and the target tile.
-        dist = math.dist([tile[0], tile[1]], 
-                         [persona.scratch.curr_tile[0], 
-                          persona.scratch.curr_tile[1]])
-        # Add any relevant events to our temp set/list with the distant info. 
-        for event in tile_details["events"]: 
-          if event not in percept_events_set: 
-            percept_events_list += [[dist, event]]
-            percept_events_set.add(event)
-
-  # We sort, and perceive only persona.scratch.att_bandwidth of the closest
+  # persona's current arena, within its vision radius. The maze hands them 
+  # to us ordered by their distance to the persona, with the closest ones 
+  # getting priorities, and without duplicates (the same event can take 
+  # place on several tiles if an object is extended across multiple tiles).
+  percept_events_list = maze.get_nearby_events(persona.scratch.curr_tile, 
+                                               persona.scratch.vision_r)
+
+  # We perceive only persona.scratch.att_bandwidth of the closest
   # events. If the bandwidth is larger, then it means the persona can perceive
   # more elements within a small area. 
-  percept_events_list = sorted(percept_events_list, key=itemgetter(0))
   perceived_events = []
   for dist, event in percept_events_list[:persona.scratch.att_bandwidth]: 
     perceived_events += [event]
@@ -141,6 +119,7 @@ def perceive(persona, maze):
                                               .strip())
       if desc_embedding_in in persona.a_mem.embeddings: 
         event_embedding = persona.a_mem.embeddings[desc_embedding_in]
+        tracer.add("embedding_cache_hits")
       else: 
         event_embedding = get_embedding(desc_embedding_in)
       event_embedding_pair = (desc_embedding_in, event_embedding)
@@ -158,6 +137,7 @@ def perceive(persona, maze):
         if persona.scratch.act_description in persona.a_mem.embeddings: 
           chat_embedding = persona.a_mem.embeddings[
                              persona.scratch.act_description]
+          tracer.add("embedding_cache_hits")
         else: 
           chat_embedding = get_embedding(persona.scratch
                                                 .act_description)
@@ -598,7 +598,7 @@ def _choose_retrieved(persona, retrieved):
         and curr_event.subject != persona.name): 
       priority += [rel_ctx]
   if priority: 
-    return random.choice(priority)
+    return persona.rng.choice(priority)
 
   # Skip idle. 
   for event_desc, rel_ctx in retrieved.items(): 
@@ -606,7 +606,7 @@ def _choose_retrieved(persona, retrieved):
     if "is idle" not in event_desc: 
       priority += [rel_ctx]
   if priority: 
-    return random.choice(priority)
+    return persona.rng.choice(priority)
   return None
 
 
@@ -25,8 +25,10 @@ sys.path.append('../../')
 
 from global_methods import *
 from persona.prompt_template.gpt_structure import *
-from persona.prompt_template.embedding import get_embedding
+from persona.prompt_template.embedding import get_embedding, get_embeddings
+from tracer import traced
 
+import numpy
 from numpy import dot
 from numpy.linalg import norm
 
@@ -205,20 +207,111 @@ def extract_relevance(persona, nodes, focal_pt):
   """
   focal_embedding = get_embedding(focal_pt)
 
+  # The cosine similarities of all the nodes come out of a single product
+  # with the normalized embedding matrix of the associative memory.
+  relevance = persona.a_mem.get_relevance(nodes, focal_embedding).tolist()
   relevance_out = dict()
   for count, node in enumerate(nodes): 
-    node_embedding = persona.a_mem.embeddings[node.embedding_key]
-    relevance_out[node.node_id] = cos_sim(node_embedding, focal_embedding)
+    relevance_out[node.node_id] = relevance[count]
 
   return relevance_out
 
 
+def normalize_floats(values, target_min, target_max): 
+  """
+  The numpy counterpart of normalize_dict_floats: scales every row of
+  <values> to the range from target_min to target_max.
+
+  INPUT: 
+    values: A 2-D numpy array of floats.
+    target_min: Integer or float. The minimum of every scaled row.
+    target_max: Integer or float. The maximum of every scaled row.
+  OUTPUT: 
+    A new 2-D numpy array with the scaled rows. A row whose values are all
+    the same is set to the middle of the range, like in
+    normalize_dict_floats.
+  """
+  min_val = values.min(axis=1, keepdims=True)
+  range_val = values.max(axis=1, keepdims=True) - min_val
+  scaled = ((values - min_val) * (target_max - target_min) 
+            / numpy.where(range_val == 0, 1, range_val) + target_min)
+  return numpy.where(range_val == 0, (target_max - target_min)/2, scaled)
+
+
+def top_indices(scores, x): 
+  """
+  Returns the indices of the <x> highest scores, from the highest to the
+  lowest. Like top_highest_x_values, equal scores keep their order, but only
+  the top <x> are sorted (with numpy.argpartition).
+
+  INPUT: 
+    scores: A 1-D numpy array of floats.
+    x: Integer. The number of indices to return.
+  OUTPUT: 
+    A list of the indices of the top <x> scores.
+  """
+  if x >= len(scores): 
+    return numpy.argsort(-scores, kind="stable").tolist()
+  if x <= 0: 
+    return []
+  threshold = scores[numpy.argpartition(-scores, x - 1)[x - 1]]
+  above = numpy.flatnonzero(scores > threshold)
+  tied = numpy.flatnonzero(scores == threshold)[:x - len(above)]
+  top = numpy.concatenate([above, tied])
+  return top[numpy.argsort(-scores[top], kind="stable")].tolist()
+
+
+def extract_scores(persona, nodes, relevance): 
+  """
+  Blends the recency, importance and relevance of a list of nodes that are
+  in a chronological order into their final retrieval scores, for one or
+  more focal points at once.
+
+  INPUT: 
+    persona: Current persona whose memory we are retrieving. 
+    nodes: A list of Node object in a chronological order. 
+    relevance: A 2-D numpy array with the relevance of every node (column)
+               to every focal point (row).
+  OUTPUT: 
+    A 2-D numpy array with the score of every node for every focal point.
+  """
+  # Calculating the component arrays and normalizing them. Recency and
+  # importance are the same for every focal point.
+  if not nodes: 
+    return numpy.zeros((len(relevance), 0))
+  recency = persona.scratch.recency_decay ** numpy.arange(1, len(nodes) + 1)
+  recency = normalize_floats(recency[None, :], 0, 1)
+  importance = numpy.array([node.poignancy for node in nodes], dtype=float)
+  importance = normalize_floats(importance[None, :], 0, 1)
+  relevance = normalize_floats(relevance.astype(float), 0, 1)
+
+  # Computing the final scores that combines the component values. 
+  # Note to self: test out different weights. [1, 1, 1] tends to work
+  # decently, but in the future, these weights should likely be learned, 
+  # perhaps through an RL-like process.
+  # gw = [1, 1, 1]
+  # gw = [1, 2, 1]
+  gw = [0.5, 3, 2]
+  return (persona.scratch.recency_w*recency*gw[0] 
+          + persona.scratch.relevance_w*relevance*gw[1] 
+          + persona.scratch.importance_w*importance*gw[2])
+
+
+@traced("new_retrieve", "retrieve")
 def new_retrieve(persona, focal_points, n_count=30): 
   """
   Given the current persona and focal points (focal points are events or 
   thoughts for which we are retrieving), we retrieve a set of nodes for each
   of the focal points and return a dictionary. 
 
+  All the focal points are retrieved in one batch: the candidate nodes and
+  their recency and importance are collected once, the focal points are
+  embedded together, and their relevance to every node is a single
+  matrix-matrix product (see AssociativeMemory.get_relevances). If the
+  memory has an embedding index (see embedding_index.py), the scores of
+  each focal point are only blended over its shortlist of the most
+  relevant nodes instead.
+
   INPUT: 
     persona: The current persona object whose memory we are retrieving. 
     focal_points: A list of focal points (string description of the events or
@@ -234,68 +327,42 @@ def new_retrieve(persona, focal_points, n_count=30):
   """
   # <retrieved> is the main dictionary that we are returning
   retrieved = dict() 
-  for focal_pt in focal_points: 
-    # Getting all nodes from the agent's memory (both thoughts and events) and
-    # sorting them by the datetime of creation.
+  focal_points = list(dict.fromkeys(focal_points))
+  if not focal_points: 
+    return retrieved
+  focal_embeddings = get_embeddings(focal_points)
+
+  shortlists = persona.a_mem.get_shortlists(focal_embeddings)
+  if shortlists is None: 
+    # Getting all nodes from the agent's memory (both thoughts and events)
+    # and sorting them by the datetime of creation.
     # You could also imagine getting the raw conversation, but for now. 
     nodes = [[i.last_accessed, i]
               for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
               if "idle" not in i.embedding_key]
     nodes = sorted(nodes, key=lambda x: x[0])
     nodes = [i for created, i in nodes]
-
-    # Calculating the component dictionaries and normalizing them.
-    recency_out = extract_recency(persona, nodes)
-    recency_out = normalize_dict_floats(recency_out, 0, 1)
-    importance_out = extract_importance(persona, nodes)
-    importance_out = normalize_dict_floats(importance_out, 0, 1)  
-    relevance_out = extract_relevance(persona, nodes, focal_pt)
-    relevance_out = normalize_dict_floats(relevance_out, 0, 1)
-
-    # Computing the final scores that combines the component values. 
-    # Note to self: test out different weights. [1, 1, 1] tends to work
-    # decently, but in the future, these weights should likely be learned, 
-    # perhaps through an RL-like process.
-    # gw = [1, 1, 1]
-    # gw = [1, 2, 1]
-    gw = [0.5, 3, 2]
-    master_out = dict()
-    for key in recency_out.keys(): 
-      master_out[key] = (persona.scratch.recency_w*recency_out[key]*gw[0] 
-                     + persona.scratch.relevance_w*relevance_out[key]*gw[1] 
-                     + persona.scratch.importance_w*importance_out[key]*gw[2])
-
-    master_out = top_highest_x_values(master_out, len(master_out.keys()))
-    for key, val in master_out.items(): 
-      print (persona.a_mem.id_to_node[key].embedding_key, val)
-      print (persona.scratch.recency_w*recency_out[key]*1, 
-             persona.scratch.relevance_w*relevance_out[key]*1, 
-             persona.scratch.importance_w*importance_out[key]*1)
-
-    # Extracting the highest x values.
-    # <master_out> has the key of node.id and value of float. Once we get the 
-    # highest x values, we want to translate the node.id into nodes and return
-    # the list of nodes.
-    master_out = top_highest_x_values(master_out, n_count)
-    master_nodes = [persona.a_mem.id_to_node[key] 
-                    for key in list(master_out.keys())]
-
+    master_out = extract_scores(
+                   persona, nodes, 
+                   persona.a_mem.get_relevances(nodes, focal_embeddings))
+
+    # Extracting the highest x values of every focal point, and translating
+    # them into nodes.
+    for count, focal_pt in enumerate(focal_points): 
+      retrieved[focal_pt] = [nodes[i] 
+                             for i in top_indices(master_out[count], n_count)]
+  else: 
+    for count, focal_pt in enumerate(focal_points): 
+      nodes = sorted(shortlists[count], key=lambda x: x.last_accessed)
+      master_out = extract_scores(
+                     persona, nodes, 
+                     persona.a_mem.get_relevances(
+                       nodes, focal_embeddings[count:count + 1]))
+      retrieved[focal_pt] = [nodes[i] 
+                             for i in top_indices(master_out[0], n_count)]
+
+  for master_nodes in retrieved.values(): 
     for n in master_nodes: 
       n.last_accessed = persona.scratch.curr_time
-      
-    retrieved[focal_pt] = master_nodes
 
   return retrieved
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -13,7 +13,26 @@ sys.path.append('../../')
 import json
 import datetime
 
+import numpy
+
 from global_methods import *
+from persona.memory_structures.embedding_index import *
+from persona.memory_structures.memory_store import *
+from utils import *
+
+# <memory_index> makes the memories of INDEX_MIN_ROWS nodes or more keep an
+# approximate nearest-neighbour index of their embeddings, so that
+# new_retrieve only blends the scores of a shortlist of the
+# <memory_index_shortlist> most relevant nodes (see embedding_index.py).
+# <memory_index_probes> is the number of clusters of the index that are
+# searched: more probes find more of the truly most relevant nodes, and take
+# longer.
+memory_index = globals().get("memory_index", False)
+memory_index_probes = globals().get("memory_index_probes", 8)
+memory_index_shortlist = globals().get("memory_index_shortlist", 500)
+# <memory_format> is the format that memories are saved in: "columnar" (see
+# memory_store.py) or "json". Memories in either format can be loaded.
+memory_format = globals().get("memory_format", "columnar")
 
 
 class ConceptNode: 
@@ -62,6 +81,45 @@ class AssociativeMemory:
     self.kw_strength_event = dict()
     self.kw_strength_thought = dict()
 
+    # <embedding_matrix> holds the L2-normalized embedding of every node as
+    # a float32 row, so that the relevance of all the nodes to a focal point
+    # is a single matrix-vector product (see get_relevance). The row of a
+    # node is its node_count - 1, and only the first <embedding_rows> rows
+    # are in use; the rest is room to grow into. A memory loaded from the
+    # columnar format starts out with a read-only memory-mapped matrix, which
+    # is copied into memory once a node is added. <embedding_norms> holds the
+    # norm of every row before it was normalized.
+    self.embedding_matrix = None
+    self.embedding_norms = None
+    self.embedding_rows = 0
+    # <embedding_index> is the <EmbeddingIndex> of <embedding_matrix>, if
+    # <memory_index> is set and the memory is large enough. It is loaded or
+    # built after all the saved nodes are added.
+    self.embedding_index = None
+    self.indexing = False
+
+    if is_columnar(f_saved): 
+      self.load_columns(f_saved)
+    else: 
+      self.load_json(f_saved)
+
+    if memory_index: 
+      self.embedding_index = EmbeddingIndex.load(
+                               f_saved + "/embedding_index.npz")
+      if (self.embedding_index 
+          and (self.embedding_index.rows != self.embedding_rows
+               or self.embedding_index.centroids.shape[1] 
+                  != self.embedding_matrix.shape[1])): 
+        self.embedding_index = None
+      self.indexing = True
+      self.update_embedding_index()
+
+
+  def load_json(self, f_saved): 
+    """
+    Loads a memory saved in the json format, replaying every node through
+    add_event, add_thought or add_chat.
+    """
     self.embeddings = json.load(open(f_saved + "/embeddings.json"))
 
     nodes_load = json.load(open(f_saved + "/nodes.json"))
@@ -108,8 +166,98 @@ class AssociativeMemory:
     if kw_strength_load["kw_strength_thought"]: 
       self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
 
+
+  def load_columns(self, f_saved): 
+    """
+    Loads a memory saved in the columnar format (see memory_store.py). The
+    nodes and keyword postings are restored as they were saved, without
+    replaying the nodes, and the embeddings are memory-mapped.
+    """
+    table, text, matrix, postings = read_columns(f_saved)
+    types = table["type"].tolist()
+    type_counts = table["type_count"].tolist()
+    depths = table["depth"].tolist()
+    created = table["created"].tolist()
+    expirations = table["expiration"].tolist()
+
+    seqs = {"event": self.seq_event, 
+            "thought": self.seq_thought, 
+            "chat": self.seq_chat}
+    embedding_keys = []
+    for row, (s, p, o, description, embedding_key, 
+              poignancy, keywords, filling) in enumerate(text): 
+      node_type = NODE_TYPES[types[row]]
+      expiration = None
+      if expirations[row] != NO_EXPIRATION: 
+        expiration = from_seconds(expirations[row])
+      if embedding_key is None: 
+        embedding_key = description
+      node = ConceptNode(f"node_{row + 1}", row + 1, type_counts[row], 
+                         node_type, depths[row], 
+                         from_seconds(created[row]), expiration, 
+                         s, p, o, 
+                         description, embedding_key, poignancy, 
+                         set(keywords), filling)
+      self.id_to_node[node.node_id] = node
+      seqs[node_type] += [node]
+      embedding_keys += [embedding_key]
+    for seq in seqs.values(): 
+      seq.reverse()
+
+    self.kw_to_event = {kw: [self.id_to_node[f"node_{i}"] for i in counts]
+                        for kw, counts in postings["kw_to_event"].items()}
+    self.kw_to_thought = {kw: [self.id_to_node[f"node_{i}"] for i in counts]
+                          for kw, counts in postings["kw_to_thought"].items()}
+    self.kw_to_chat = {kw: [self.id_to_node[f"node_{i}"] for i in counts]
+                       for kw, counts in postings["kw_to_chat"].items()}
+    self.kw_strength_event = postings["kw_strength_event"]
+    self.kw_strength_thought = postings["kw_strength_thought"]
+
+    self.embedding_matrix = matrix
+    self.embedding_norms = table["embedding_norm"].copy()
+    self.embedding_rows = len(table)
+    self.embeddings = EmbeddingMap(embedding_keys, matrix, 
+                                   self.embedding_norms)
+
     
   def save(self, out_json): 
+    """
+    Saves the memory to the folder <out_json> in the format of
+    <memory_format>, and removes the files of the other format from it.
+    """
+    if memory_format == "columnar": 
+      self.save_columns(out_json)
+      remove_files(out_json, "json")
+    else: 
+      self.save_json(out_json)
+      remove_files(out_json, "columnar")
+
+    if self.embedding_index: 
+      self.embedding_index.save(out_json+"/embedding_index.npz")
+
+
+  def save_columns(self, out_json): 
+    """
+    Saves the memory in the columnar format (see memory_store.py).
+    """
+    nodes = [self.id_to_node[f"node_{count}"] 
+             for count in range(1, len(self.id_to_node) + 1)]
+    postings = dict()
+    for kw_type, kw_to_nodes in [("kw_to_event", self.kw_to_event), 
+                                 ("kw_to_thought", self.kw_to_thought), 
+                                 ("kw_to_chat", self.kw_to_chat)]: 
+      postings[kw_type] = {kw: [node.node_count for node in kw_nodes]
+                           for kw, kw_nodes in kw_to_nodes.items()}
+    postings["kw_strength_event"] = self.kw_strength_event
+    postings["kw_strength_thought"] = self.kw_strength_thought
+    write_columns(out_json, nodes, self.embedding_matrix, 
+                  self.embedding_norms, postings)
+
+
+  def save_json(self, out_json): 
+    """
+    Saves the memory in the json format.
+    """
     r = dict()
     for count in range(len(self.id_to_node.keys()), 0, -1): 
       node_id = f"node_{str(count)}"
@@ -147,7 +295,7 @@ class AssociativeMemory:
       json.dump(r, outfile)
 
     with open(out_json+"/embeddings.json", "w") as outfile:
-      json.dump(self.embeddings, outfile)
+      json.dump(dict(self.embeddings), outfile)
 
 
   def add_event(self, created, expiration, s, p, o, 
@@ -192,6 +340,7 @@ class AssociativeMemory:
           self.kw_strength_event[kw] = 1
 
     self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.add_embedding_row(embedding_pair[1], self.is_retrievable(node))
 
     return node
 
@@ -236,6 +385,7 @@ class AssociativeMemory:
           self.kw_strength_thought[kw] = 1
 
     self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.add_embedding_row(embedding_pair[1], self.is_retrievable(node))
 
     return node
 
@@ -267,10 +417,159 @@ class AssociativeMemory:
     self.id_to_node[node_id] = node 
 
     self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    self.add_embedding_row(embedding_pair[1], self.is_retrievable(node))
         
     return node
 
 
+  def is_retrievable(self, node): 
+    """
+    Returns whether new_retrieve scores a node: the events and thoughts are,
+    except for the idle ones.
+    """
+    return node.type != "chat" and "idle" not in node.embedding_key
+
+
+  def add_embedding_row(self, embedding, retrievable): 
+    """
+    Appends the normalized embedding of a new node to <embedding_matrix>,
+    doubling the matrix whenever it is full.
+
+    INPUT
+      embedding: The embedding of the node, as a list of floats.
+      retrievable: Whether new_retrieve scores the node (see 
+                   is_retrievable), i.e., whether it is indexed.
+    OUTPUT
+      None
+    """
+    vector = numpy.asarray(embedding, dtype=numpy.float32).ravel()
+    if (self.embedding_matrix is not None 
+        and vector.shape[0] != self.embedding_matrix.shape[1]): 
+      raise ValueError(f"The embedding has {vector.shape[0]} dimensions, "
+                       f"but the memory's embeddings have "
+                       f"{self.embedding_matrix.shape[1]}")
+    if self.embedding_matrix is None: 
+      self.embedding_matrix = numpy.zeros((64, vector.shape[0]), 
+                                          dtype=numpy.float32)
+      self.embedding_norms = numpy.zeros(64, dtype=numpy.float32)
+    elif self.embedding_rows == self.embedding_matrix.shape[0]: 
+      matrix = numpy.zeros((max(64, 2 * self.embedding_rows), 
+                            self.embedding_matrix.shape[1]), 
+                           dtype=numpy.float32)
+      matrix[:self.embedding_rows] = self.embedding_matrix
+      self.embedding_matrix = matrix
+      norms = numpy.zeros(matrix.shape[0], dtype=numpy.float32)
+      norms[:self.embedding_rows] = self.embedding_norms
+      self.embedding_norms = norms
+
+    vector_norm = numpy.linalg.norm(vector)
+    if vector_norm > 0: 
+      vector = vector / vector_norm
+    self.embedding_matrix[self.embedding_rows] = vector
+    self.embedding_norms[self.embedding_rows] = vector_norm
+    self.embedding_rows += 1
+    if self.indexing: 
+      self.update_embedding_index(retrievable)
+
+
+  def update_embedding_index(self, retrievable=False): 
+    """
+    Adds the last row of <embedding_matrix> to <embedding_index> if it is
+    retrievable, or builds the index anew once the memory has grown large
+    enough for one, or RETRAIN_GROWTH times larger than the index was
+    trained on.
+    """
+    rows = self.embedding_rows
+    if rows < INDEX_MIN_ROWS: 
+      return
+    if (self.embedding_index is None 
+        or rows >= RETRAIN_GROWTH * self.embedding_index.trained_rows): 
+      retrievable_rows = [node.node_count - 1
+                          for node in self.seq_event + self.seq_thought
+                          if self.is_retrievable(node)]
+      if not retrievable_rows: 
+        return
+      self.embedding_index = EmbeddingIndex.build(
+                               self.embedding_matrix[:rows], 
+                               numpy.array(retrievable_rows, dtype=numpy.intp))
+    elif self.embedding_index.rows < rows: 
+      self.embedding_index.add(rows - 1, self.embedding_matrix[rows - 1]
+                                         if retrievable else None)
+
+
+  def get_relevance(self, nodes, embedding): 
+    """
+    Returns the cosine similarity of the embeddings of <nodes> to
+    <embedding>, computed over <embedding_matrix> at once.
+
+    INPUT
+      nodes: A list of <ConceptNode>s of this memory.
+      embedding: The embedding of the focal point, as a list of floats.
+    OUTPUT
+      A float32 numpy array with the similarity of every node, in the order
+      of <nodes>.
+    """
+    return self.get_relevances(nodes, [embedding])[0]
+
+
+  def get_relevances(self, nodes, embeddings): 
+    """
+    Returns the cosine similarity of the embeddings of <nodes> to each of
+    <embeddings>, computed with a single matrix-matrix product.
+
+    INPUT
+      nodes: A list of <ConceptNode>s of this memory.
+      embeddings: A list of the embeddings of the focal points.
+    OUTPUT
+      A float32 numpy array with a row for every focal point and a column
+      for every node, in the order of <nodes>.
+    """
+    if not nodes: 
+      return numpy.zeros((len(embeddings), 0), dtype=numpy.float32)
+    vectors = numpy.asarray(embeddings, dtype=numpy.float32)
+    vectors = vectors.reshape(len(embeddings), -1)
+    vector_norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / numpy.where(vector_norms > 0, vector_norms, 1)
+    rows = numpy.fromiter((node.node_count - 1 for node in nodes), 
+                          dtype=numpy.intp, count=len(nodes))
+    if 4 * len(nodes) < self.embedding_rows: 
+      # A few nodes (e.g., a shortlist) are cheaper to gather first.
+      return vectors @ self.embedding_matrix[rows].T
+    similarity = vectors @ self.embedding_matrix[:self.embedding_rows].T
+    return similarity[:, rows]
+
+
+  def get_shortlists(self, embeddings): 
+    """
+    Returns the shortlists of the retrievable nodes (see is_retrievable)
+    that are the most relevant to each of <embeddings>, according to
+    <embedding_index>, or None if the memory has no index.
+
+    INPUT
+      embeddings: A list of the embeddings of the focal points.
+    OUTPUT
+      A list with the shortlist of every focal point: a list of at most
+      <memory_index_shortlist> <ConceptNode>s.
+    """
+    if self.embedding_index is None: 
+      return None
+    vectors = numpy.asarray(embeddings, dtype=numpy.float32)
+    vectors = vectors.reshape(len(embeddings), -1)
+    vector_norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / numpy.where(vector_norms > 0, vector_norms, 1)
+
+    shortlists = []
+    candidates = self.embedding_index.search(vectors, memory_index_probes)
+    for vector, rows in zip(vectors, candidates): 
+      if len(rows) > memory_index_shortlist: 
+        similarity = self.embedding_matrix[rows] @ vector
+        top = numpy.argpartition(-similarity, memory_index_shortlist - 1)
+        rows = rows[top[:memory_index_shortlist]]
+      shortlists += [[self.id_to_node[f"node_{row + 1}"] 
+                      for row in rows.tolist()]]
+    return shortlists
+
+
   def get_summarized_latest_events(self, retention): 
     ret_set = set()
     for e_node in self.seq_event[:retention]: 
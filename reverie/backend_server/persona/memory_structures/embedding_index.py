@@ -0,0 +1,156 @@
+"""
+File: embedding_index.py
+Description: An approximate nearest-neighbour index of the embeddings of an
+associative memory, in the manner of an IVF-flat index. Personas that run
+for weeks of simulated time have tens of thousands of nodes, and scoring
+the relevance of every one of them for every retrieval becomes the bulk of
+the work. When <memory_index> is set in utils.py, the memory keeps an
+EmbeddingIndex once it has INDEX_MIN_ROWS embeddings, and new_retrieve
+blends the recency, importance and relevance of a shortlist of the most
+relevant nodes only (see AssociativeMemory.get_shortlists).
+
+The normalized embeddings are clustered with spherical k-means, and every
+embedding is listed under its closest centroid. A search compares the query
+with the centroids, and only the embeddings listed under the <probes>
+closest centroids are candidates; more probes find more of the true
+nearest neighbours, at the cost of scanning more embeddings. New embeddings
+are added to the list of their closest centroid as they come, and the
+centroids are trained anew whenever the number of embeddings has grown
+RETRAIN_GROWTH times since they were last trained.
+"""
+from array import array
+
+import numpy
+
+# <INDEX_MIN_ROWS> is the number of embeddings from which a memory is
+# indexed; smaller memories are scored exhaustively, which is fast enough.
+INDEX_MIN_ROWS = 2048
+# <RETRAIN_GROWTH> is how many times the number of embeddings grows before
+# the centroids are trained anew.
+RETRAIN_GROWTH = 4
+# <KMEANS_ITERATIONS> is the number of k-means iterations of a training, and
+# <KMEANS_SAMPLE> the number of embeddings sampled per centroid for it.
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE = 32
+
+
+class EmbeddingIndex:
+  def __init__(self, centroids, lists, rows, trained_rows):
+    # <centroids> is the float32 matrix of the normalized centroids, one per
+    # row, and <lists> the rows of the embeddings listed under every
+    # centroid, as an array('i') per centroid.
+    # <rows> is the number of rows of the embedding matrix that the index
+    # is up to date with (not all of them are listed), and <trained_rows>
+    # the number of rows when the centroids were trained.
+    self.centroids = centroids
+    self.lists = lists
+    self.rows = rows
+    self.trained_rows = trained_rows
+
+
+  @classmethod
+  def build(cls, matrix, rows, seed=0):
+    """
+    Trains the centroids on a sample of the embeddings of <rows> and lists
+    each of them under its closest centroid.
+
+    INPUT
+      matrix: The float32 matrix of the normalized embeddings, one per row.
+      rows: A numpy array of the rows of <matrix> to list.
+      seed: The seed of the sample and of the initial centroids.
+    OUTPUT
+      The <EmbeddingIndex>.
+    """
+    count = min(len(rows), max(16, int(numpy.sqrt(len(rows)))))
+    rng = numpy.random.default_rng(seed)
+    sample = matrix[rng.choice(rows, min(len(rows), count * KMEANS_SAMPLE),
+                               replace=False)]
+    centroids = sample[rng.choice(sample.shape[0], count, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+      closest = numpy.argmax(sample @ centroids.T, axis=1)
+      sums = numpy.zeros_like(centroids)
+      numpy.add.at(sums, closest, sample)
+      sum_norms = numpy.linalg.norm(sums, axis=1, keepdims=True)
+      # A centroid that no embedding is closest to stays where it is.
+      centroids = numpy.where(sum_norms > 0,
+                              sums / numpy.where(sum_norms > 0, sum_norms, 1),
+                              centroids).astype(numpy.float32)
+
+    index = cls(centroids, [array("i") for _ in range(count)],
+                matrix.shape[0], matrix.shape[0])
+    for start in range(0, len(rows), 4096):
+      chunk = rows[start:start + 4096]
+      closest = numpy.argmax(matrix[chunk] @ centroids.T, axis=1)
+      for row, centroid in zip(chunk.tolist(), closest.tolist()):
+        index.lists[centroid].append(row)
+    return index
+
+
+  def add(self, row, vector):
+    """
+    Lists a new embedding under its closest centroid.
+
+    INPUT
+      row: The row of the embedding in the memory's embedding matrix.
+      vector: The normalized embedding, or None if the row is not to be
+              listed.
+    OUTPUT
+      None
+    """
+    if vector is not None:
+      self.lists[int(numpy.argmax(self.centroids @ vector))].append(row)
+    self.rows = row + 1
+
+
+  def search(self, vectors, probes):
+    """
+    Returns the candidate neighbours of every query: the rows listed under
+    the <probes> centroids closest to it.
+
+    INPUT
+      vectors: The float32 matrix of the normalized queries, one per row.
+      probes: The number of centroids to probe per query.
+    OUTPUT
+      A list with the numpy array of the candidate rows of every query.
+    """
+    probes = min(probes, len(self.lists))
+    scores = vectors @ self.centroids.T
+    candidates = []
+    for query_scores in scores:
+      closest = numpy.argpartition(-query_scores, probes - 1)[:probes]
+      candidates += [numpy.concatenate(
+                       [numpy.frombuffer(self.lists[i], dtype=numpy.int32)
+                        for i in closest.tolist()])]
+    return candidates
+
+
+  def save(self, file):
+    """
+    Saves the index to an .npz file.
+    """
+    sizes = numpy.array([len(i) for i in self.lists], dtype=numpy.int64)
+    rows = numpy.concatenate(
+             [numpy.frombuffer(i, dtype=numpy.int32) for i in self.lists])
+    with open(file, "wb") as outfile:
+      numpy.savez(outfile, centroids=self.centroids, sizes=sizes, rows=rows,
+                  matrix_rows=self.rows, trained_rows=self.trained_rows)
+
+
+  @classmethod
+  def load(cls, file):
+    """
+    Loads an index saved by save, or returns None if <file> is missing or
+    unreadable.
+    """
+    try:
+      with numpy.load(file) as data:
+        centroids = data["centroids"]
+        offsets = numpy.concatenate([[0], numpy.cumsum(data["sizes"])])
+        rows = data["rows"].astype(numpy.int32)
+        matrix_rows = int(data["matrix_rows"])
+        trained_rows = int(data["trained_rows"])
+    except (OSError, KeyError, ValueError):
+      return None
+    lists = [array("i", rows[offsets[i]:offsets[i + 1]].tobytes())
+             for i in range(len(offsets) - 1)]
+    return cls(centroids, lists, matrix_rows, trained_rows)
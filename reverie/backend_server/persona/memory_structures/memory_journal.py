@@ -0,0 +1,286 @@
+"""
+File: memory_journal.py
+Description: An append-only journal of the changes to the memory of a
+persona since its last full save.
+
+Originally, every save rewrote the whole bootstrap_memory folder of every
+persona: the spatial memory, all of the associative memory and the scratch,
+even if only a few nodes had been added since the last save. With the
+journal, a save (see Persona.save) only appends one record to
+bootstrap_memory/memory_journal.log, holding:
+  nodes   -- the nodes that were added to the associative memory since the
+             last save, with their embeddings;
+  scratch -- the entries of the scratch whose values have changed;
+  spatial -- the tree of the spatial memory, if it has changed.
+When the persona is loaded, the records are replayed over the saved
+("snapshot") memory. Once the journal has grown to <memory_journal_limit>
+bytes, or on a full save, the memory is saved in full and the journal is
+emptied; this is a compaction.
+
+Each record is a RECORD_HEADER (the length and CRC-32 of the payload)
+followed by the compact JSON of the changes, and is flushed to the disk
+before the save returns. A record that was cut short by a crash fails its
+check and is dropped with everything after it, so the memory is loaded as of
+the last complete save. A compaction writes the new snapshot to a
+COMPACTION_FOLDER first and marks it complete before moving its files into
+place, and a compaction that was interrupted is finished (or discarded, if
+it was not complete) the next time the persona is loaded.
+"""
+import base64
+import datetime
+import json
+import os
+import shutil
+import zlib
+
+import numpy
+
+from utils import *
+from persona.memory_structures.memory_store import (JOURNAL_FILE,
+                                                    RECORD_HEADER,
+                                                    read_journal)
+
+# <memory_journal> makes Persona.save(compact=False) append the changes to
+# the journal instead of saving the whole memory, and <memory_journal_limit>
+# is the size of the journal, in bytes, from which it is compacted.
+memory_journal = globals().get("memory_journal", True)
+memory_journal_limit = globals().get("memory_journal_limit", 64 * 2**20)
+
+COMPACTION_FOLDER = "compaction"
+# <COMPLETE_FILE> marks a complete compaction; it lists the files of the new
+# snapshot, relative to the bootstrap_memory folder.
+COMPLETE_FILE = "complete.json"
+
+
+def to_json(value):
+  """
+  Returns <value> as it is after a round trip through JSON (e.g., with its
+  tuples turned into lists), so that it can be compared with a saved value.
+  """
+  return json.loads(json.dumps(value))
+
+
+def node_record(a_mem, node):
+  """
+  Returns the record of a node of the associative memory <a_mem>.
+  """
+  row = node.node_count - 1
+  embedding = (a_mem.embedding_matrix[row]
+               * a_mem.embedding_norms[row]).astype(numpy.float32)
+  expiration = None
+  if node.expiration:
+    expiration = node.expiration.strftime('%Y-%m-%d %H:%M:%S')
+  return {"node_count": node.node_count,
+          "type": node.type,
+          "created": node.created.strftime('%Y-%m-%d %H:%M:%S'),
+          "expiration": expiration,
+          "subject": node.subject,
+          "predicate": node.predicate,
+          "object": node.object,
+          "description": node.description,
+          "embedding_key": node.embedding_key,
+          "poignancy": node.poignancy,
+          "keywords": list(node.keywords),
+          "filling": node.filling,
+          "embedding": base64.b64encode(embedding.tobytes()).decode()}
+
+
+def add_node(a_mem, record):
+  """
+  Adds the node of <record> to the associative memory <a_mem>.
+  """
+  created = datetime.datetime.strptime(record["created"], '%Y-%m-%d %H:%M:%S')
+  expiration = None
+  if record["expiration"]:
+    expiration = datetime.datetime.strptime(record["expiration"],
+                                            '%Y-%m-%d %H:%M:%S')
+  embedding = numpy.frombuffer(base64.b64decode(record["embedding"]),
+                               dtype=numpy.float32)
+  add = {"event": a_mem.add_event,
+         "thought": a_mem.add_thought,
+         "chat": a_mem.add_chat}[record["type"]]
+  node = add(created, expiration,
+             record["subject"], record["predicate"], record["object"],
+             record["description"], set(record["keywords"]),
+             record["poignancy"],
+             (record["embedding_key"], embedding.tolist()),
+             record["filling"])
+  # add_event cleans up the description of new events, which the saved
+  # description already is.
+  node.description = record["description"]
+
+
+class MemoryJournal:
+  def __init__(self, folder):
+    # <folder> is the bootstrap_memory folder of the persona.
+    # <node_count>, <scratch> and <spatial> are the number of nodes, the
+    # state of the scratch and the JSON of the spatial memory as of the last
+    # save, which the next record holds the changes to.
+    self.folder = folder
+    self.file = f"{folder}/{JOURNAL_FILE}"
+    self.node_count = 0
+    self.scratch = None
+    self.spatial = None
+
+
+  def recover(self):
+    """
+    Finishes a compaction that was complete when it was interrupted, and
+    discards one that was not. Called before the memory is loaded.
+    """
+    compaction = f"{self.folder}/{COMPACTION_FOLDER}"
+    if not os.path.isdir(compaction):
+      return
+    if os.path.exists(f"{compaction}/{COMPLETE_FILE}"):
+      self.finish_compaction()
+    else:
+      shutil.rmtree(compaction)
+
+
+  def read(self):
+    """
+    Returns the records of the journal, up to the first one that is
+    incomplete or corrupt. The journal is cut off before that one, so that
+    new records follow the complete ones.
+    """
+    records, length = read_journal(self.folder)
+    if os.path.exists(self.file) and length < os.path.getsize(self.file):
+      with open(self.file, "r+b") as journal_file:
+        journal_file.truncate(length)
+    return records
+
+
+  def replay(self, persona):
+    """
+    Replays the journal over the memory that <persona> has just loaded from
+    <folder>, and remembers the state of the memory as of the last save.
+    """
+    scratch_file = f"{self.folder}/scratch.json"
+    scratch = None
+    if os.path.exists(scratch_file):
+      with open(scratch_file) as json_file:
+        scratch = json.load(json_file)
+    scratch_changed = False
+
+    for record in self.read():
+      for node in record.get("nodes", []):
+        if node["node_count"] <= len(persona.a_mem.id_to_node):
+          continue
+        if node["node_count"] != len(persona.a_mem.id_to_node) + 1:
+          raise ValueError(f"{self.file} skips the nodes before "
+                           f"node_{node['node_count']}")
+        add_node(persona.a_mem, node)
+      if "scratch" in record:
+        scratch = dict(scratch or {}, **record["scratch"])
+        scratch_changed = True
+      if "spatial" in record:
+        persona.s_mem.tree = record["spatial"]
+
+    if scratch_changed:
+      persona.scratch.load_state(scratch)
+    self.node_count = len(persona.a_mem.id_to_node)
+    self.scratch = scratch
+    self.spatial = json.dumps(persona.s_mem.tree)
+
+
+  def append(self, persona):
+    """
+    Appends the changes to the memory of <persona> since the last save to
+    the journal.
+
+    INPUT
+      persona: The <Persona> whose memory this journal holds.
+    OUTPUT
+      The size of the journal, in bytes.
+    """
+    record = dict()
+    a_mem = persona.a_mem
+    if len(a_mem.id_to_node) > self.node_count:
+      record["nodes"] = [node_record(a_mem, a_mem.id_to_node[f"node_{i}"])
+                         for i in range(self.node_count + 1,
+                                        len(a_mem.id_to_node) + 1)]
+    scratch = to_json(persona.scratch.state())
+    scratch_changes = {key: value for key, value in scratch.items()
+                       if (self.scratch is None or key not in self.scratch
+                           or self.scratch[key] != value)}
+    if scratch_changes:
+      record["scratch"] = scratch_changes
+    spatial = json.dumps(persona.s_mem.tree)
+    if spatial != self.spatial:
+      record["spatial"] = persona.s_mem.tree
+
+    if record:
+      payload = json.dumps(record).encode()
+      with open(self.file, "ab") as journal_file:
+        journal_file.write(RECORD_HEADER.pack(len(payload),
+                                              zlib.crc32(payload)))
+        journal_file.write(payload)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    self.node_count = len(a_mem.id_to_node)
+    self.scratch = scratch
+    self.spatial = spatial
+    if not os.path.exists(self.file):
+      return 0
+    return os.path.getsize(self.file)
+
+
+  def compact(self, persona):
+    """
+    Saves the whole memory of <persona> to <folder>, and empties the
+    journal.
+
+    INPUT
+      persona: The <Persona> whose memory this journal holds.
+    OUTPUT
+      None
+    """
+    compaction = f"{self.folder}/{COMPACTION_FOLDER}"
+    if os.path.isdir(compaction):
+      shutil.rmtree(compaction)
+    os.makedirs(f"{compaction}/associative_memory")
+    persona.save_snapshot(compaction)
+
+    files = []
+    for root, dirs, names in os.walk(compaction):
+      for name in names:
+        with open(f"{root}/{name}", "rb") as snapshot_file:
+          os.fsync(snapshot_file.fileno())
+        files += [os.path.relpath(f"{root}/{name}", compaction)
+                    .replace(os.sep, "/")]
+    with open(f"{compaction}/{COMPLETE_FILE}.tmp", "w") as outfile:
+      json.dump(sorted(files), outfile)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    os.replace(f"{compaction}/{COMPLETE_FILE}.tmp",
+               f"{compaction}/{COMPLETE_FILE}")
+    self.finish_compaction()
+
+    self.node_count = len(persona.a_mem.id_to_node)
+    self.scratch = to_json(persona.scratch.state())
+    self.spatial = json.dumps(persona.s_mem.tree)
+
+
+  def finish_compaction(self):
+    """
+    Moves the files of a complete compaction into place, removes the files
+    of the associative memory that are not part of the new snapshot (e.g.,
+    those of the other format), and empties the journal.
+    """
+    compaction = f"{self.folder}/{COMPACTION_FOLDER}"
+    with open(f"{compaction}/{COMPLETE_FILE}") as json_file:
+      files = json.load(json_file)
+    for file in files:
+      if os.path.exists(f"{compaction}/{file}"):
+        os.makedirs(os.path.dirname(f"{self.folder}/{file}"), exist_ok=True)
+        os.replace(f"{compaction}/{file}", f"{self.folder}/{file}")
+
+    a_mem_folder = f"{self.folder}/associative_memory"
+    if os.path.isdir(a_mem_folder):
+      for name in os.listdir(a_mem_folder):
+        if f"associative_memory/{name}" not in files:
+          os.remove(f"{a_mem_folder}/{name}")
+
+    if os.path.exists(self.file):
+      os.remove(self.file)
+    shutil.rmtree(compaction)
@@ -9,16 +9,19 @@ the term we used internally back in 2022, taking from our Social Simulacra
 paper.
 """
 import math
+import os
 import sys
 import datetime
 import random
 sys.path.append('../')
 
 from global_methods import *
+from tracer import traced
 
 from persona.memory_structures.spatial_memory import *
 from persona.memory_structures.associative_memory import *
 from persona.memory_structures.scratch import *
+from persona.memory_structures.memory_journal import *
 
 from persona.cognitive_modules.perceive import *
 from persona.cognitive_modules.retrieve import *
@@ -27,6 +30,10 @@ from persona.cognitive_modules.reflect import *
 from persona.cognitive_modules.execute import *
 from persona.cognitive_modules.converse import *
 
+def persona_trace_args(persona, *args): 
+  return {"persona": persona.name}
+
+
 class Persona: 
   def __init__(self, name, folder_mem_saved=False):
     # PERSONA BASE STATE 
@@ -37,6 +44,12 @@ class Persona:
     # PERSONA MEMORY 
     # If there is already memory in folder_mem_saved, we load that. Otherwise,
     # we create new memory instances. 
+    # <journal> holds the changes to the memory since it was last saved in 
+    # full, which are replayed over the saved memory (see memory_journal.py).
+    self.journal = None
+    if memory_journal and folder_mem_saved: 
+      self.journal = MemoryJournal(f"{folder_mem_saved}/bootstrap_memory")
+      self.journal.recover()
     # <s_mem> is the persona's spatial memory. 
     f_s_mem_saved = f"{folder_mem_saved}/bootstrap_memory/spatial_memory.json"
     self.s_mem = MemoryTree(f_s_mem_saved)
@@ -46,17 +59,44 @@ class Persona:
     # <scratch> is the persona's scratch (short term memory) space. 
     scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
     self.scratch = Scratch(scratch_saved)
+    if self.journal: 
+      self.journal.replay(self)
+
+    # <rng> is the persona's own random number generator. The cognitive 
+    # modules draw from it instead of the global <random> module so that the
+    # server can seed every persona independently at each step, which keeps
+    # the simulation reproducible even when the personas think concurrently.
+    self.rng = random.Random()
 
 
-  def save(self, save_folder): 
+  def save(self, save_folder, compact=True): 
     """
     Save persona's current state (i.e., memory). 
 
+    Unless <compact> is set, only the changes since the last save are 
+    appended to the journal, when <save_folder> is the folder the persona 
+    was loaded from. The memory is saved in full (and the journal emptied) 
+    otherwise, or once the journal has grown to <memory_journal_limit>.
+
     INPUT: 
       save_folder: The folder where we wil be saving our persona's state. 
+      compact: Whether to save the memory in full. 
     OUTPUT: 
       None
     """
+    if (self.journal 
+        and os.path.abspath(save_folder) 
+            == os.path.abspath(self.journal.folder)): 
+      if compact or self.journal.append(self) >= memory_journal_limit: 
+        self.journal.compact(self)
+      return
+    self.save_snapshot(save_folder)
+
+
+  def save_snapshot(self, save_folder): 
+    """
+    Save persona's whole memory to <save_folder>, without the journal. 
+    """
     # Spatial memory contains a tree in a json format. 
     # e.g., {"double studio": 
     #         {"double studio": 
@@ -78,6 +118,7 @@ class Persona:
     self.scratch.save(f_scratch)
 
 
+  @traced("perceive", "persona", persona_trace_args)
   def perceive(self, maze):
     """
     This function takes the current maze, and returns events that are 
@@ -107,6 +148,7 @@ class Persona:
     return perceive(self, maze)
 
 
+  @traced("retrieve", "persona", persona_trace_args)
   def retrieve(self, perceived):
     """
     This function takes the events that are perceived by the persona as input
@@ -123,6 +165,7 @@ class Persona:
     return retrieve(self, perceived)
 
 
+  @traced("plan", "persona", persona_trace_args)
   def plan(self, maze, personas, new_day, retrieved):
     """
     Main cognitive function of the chain. It takes the retrieved memory and 
@@ -148,6 +191,7 @@ class Persona:
     return plan(self, maze, personas, new_day, retrieved)
 
 
+  @traced("execute", "persona", persona_trace_args)
   def execute(self, maze, personas, plan):
     """
     This function takes the agent's current plan and outputs a concrete 
@@ -170,6 +214,7 @@ class Persona:
     return execute(self, maze, personas, plan)
 
 
+  @traced("reflect", "persona", persona_trace_args)
   def reflect(self):
     """
     Reviews the persona's memory and create new thoughts based on it. 
@@ -182,24 +227,17 @@ class Persona:
     reflect(self)
 
 
-  def move(self, maze, personas, curr_tile, curr_time):
+  def update_curr_state(self, curr_tile, curr_time): 
     """
-    This is the main cognitive function where our main sequence is called. 
+    Updates the persona's scratch with the current tile and time. This is the
+    first thing that happens in every move. 
 
     INPUT: 
-      maze: The Maze class of the current world. 
-      personas: A dictionary that contains all persona names as keys, and the 
-                Persona instance as values. 
       curr_tile: A tuple that designates the persona's current tile location 
                  in (row, col) form. e.g., (58, 39)
       curr_time: datetime instance that indicates the game's current time. 
     OUTPUT: 
-      execution: A triple set that contains the following components: 
-        <next_tile> is a x,y coordinate. e.g., (58, 9)
-        <pronunciatio> is an emoji.
-        <description> is a string description of the movement. e.g., 
-        writing her next novel (editing her novel) 
-        @ double studio:double studio:common room:sofa
+      new_day: False, "First day" or "New day" (see plan()). 
     """
     # Updating persona's scratch memory with <curr_tile>. 
     self.scratch.curr_tile = curr_tile
@@ -215,6 +253,30 @@ class Persona:
           != curr_time.strftime('%A %B %d')):
       new_day = "New day"
     self.scratch.curr_time = curr_time
+    return new_day
+
+
+  @traced("move", "persona", persona_trace_args)
+  def move(self, maze, personas, curr_tile, curr_time):
+    """
+    This is the main cognitive function where our main sequence is called. 
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      personas: A dictionary that contains all persona names as keys, and the 
+                Persona instance as values. 
+      curr_tile: A tuple that designates the persona's current tile location 
+                 in (row, col) form. e.g., (58, 39)
+      curr_time: datetime instance that indicates the game's current time. 
+    OUTPUT: 
+      execution: A triple set that contains the following components: 
+        <next_tile> is a x,y coordinate. e.g., (58, 9)
+        <pronunciatio> is an emoji.
+        <description> is a string description of the movement. e.g., 
+        writing her next novel (editing her novel) 
+        @ double studio:double studio:common room:sofa
+    """
+    new_day = self.update_curr_state(curr_tile, curr_time)
 
     # Main cognitive sequence begins here. 
     perceived = self.perceive(maze)
@@ -16,6 +16,7 @@
 
 import os
 import re
+import threading
 import traceback
 
 from typing import Any, Dict, List, Union, Optional, TypeVar
@@ -24,7 +25,6 @@ from enum import Enum, auto
 from asyncio import get_event_loop
 from termcolor import colored
 from termcolor._types import Color
-from langchain_openai import ChatOpenAI
 from langchain.schema import BaseMessage, AIMessage, HumanMessage
 from langchain.prompts.example_selector import SemanticSimilarityExampleSelector
 from langchain_core.runnables import chain, Runnable, RunnableLambda
@@ -38,6 +38,8 @@ from langchain.globals import set_llm_cache
 from langchain.cache import SQLiteCache
 
 import utils as config
+from tracer import traced
+from persona.prompt_template.backends import chat_model
 from persona.prompt_template.SimplifiedPedanticOutputParser import SimplifiedPydanticOutputParser
 from persona.prompt_template.embedding import LocalEmbeddings
 from persona.common import deindent
@@ -66,20 +68,13 @@ class ModelAlias(Enum):
   strong = 'inference_model_strong'
   superstrong = 'inference_model_superstrong'
 
-def model(alias: ModelAlias, prompt_config: Dict[str, Union[str, float]]):
-  return ChatOpenAI(
-    cache=None,
+def model(alias: ModelAlias, prompt_config: Dict[str, Union[str, float]], strategy: Optional['InferenceStrategy'] = None, context: Optional[Dict[str, Any]] = None):
+  return chat_model(
+    getattr(config, alias.value),
+    prompt_config,
     base_url=config.openai_api_base if alias != ModelAlias.superstrong else None,
-    openai_api_key=config.openai_api_key,
-    model=getattr(config, alias.value),
-    temperature=prompt_config.get("temperature", 0.5),
-    max_tokens=prompt_config.get("max_tokens", 500),
-    # top_k=prompt_config.get("top_k"),
-    # top_p=prompt_config.get("top_p"),
-    # min_p=prompt_config.get("min_p"),
-    # frequency_penalty=prompt_config.get("frequency_penalty"),
-    # presence_penalty=prompt_config.get("presence_penalty"),
-    # stop_sequences=prompt_config.get("stop"),
+    strategy=strategy,
+    context=context,
   )
 
 def announcer(name):
@@ -116,19 +111,10 @@ def add_system_prompt(prompt):
   return ChatPromptValue(messages=[system_prompt] + prompt.messages)
 
 def inline_semantic_function(function_name: str, prompt_config: Dict[str, Any], prompt: str, use_openai=False):
-  model = ChatOpenAI(
-    cache=None,
+  model = chat_model(
+    config.inference_model_superstrong if use_openai else config.inference_model_strong,
+    prompt_config,
     base_url=config.openai_api_base if not use_openai else None,
-    openai_api_key=config.openai_api_key,
-    model=config.inference_model_superstrong if use_openai else config.inference_model_strong,
-    temperature=prompt_config.get("temperature", 0.5),
-    max_tokens=prompt_config.get("max_tokens", 500),
-    # top_k=prompt_config.get("top_k", 0),
-    # top_p=prompt_config.get("top_p", 0.95),
-    # min_p=prompt_config.get("min_p", 0.05),
-    # frequency_penalty=prompt_config.get("frequency_penalty", 0),
-    # presence_penalty=prompt_config.get("presence_penalty", 0),
-    # stop_sequences=prompt_config.get("stop", None),
   )
   chain = (
     announcer("LEGACY_" + function_name) |
@@ -192,12 +178,15 @@ class InferenceStrategy:
   prompt: Optional[str] = None
   example_prompt: Optional[str] = ""
   config: Dict[str, Any] = {}
-  context: Dict[str, Any] = {}
   examples: List[Dict[str, Any]] = []
   example_count: int = 3
   example_selector: BaseExampleSelector = NoExampleSelector()
 
   def __init__(self):
+    # The strategies are singletons that may be called from several persona
+    # threads at once, so each thread keeps its own context.
+    self.local = threading.local()
+
     @chain
     def prepare_context(args: List):
       self.context = self.prepare_context(*args)
@@ -241,7 +230,7 @@ class InferenceStrategy:
           inference_chain=(
             ColorEcho('light_blue') |
             add_system_prompt |
-            model(ModelAlias.strong, self.config) |
+            model(ModelAlias.strong, self.config, self, context) |
             ColorEcho('cyan')
           ),
           output_parser_chain=(
@@ -253,6 +242,14 @@ class InferenceStrategy:
       ).invoke(context))
     )
 
+  @property
+  def context(self) -> Dict[str, Any]:
+    return getattr(self.local, 'context', {})
+
+  @context.setter
+  def context(self, context: Dict[str, Any]):
+    self.local.context = context
+
   def prepare_context(self, *args: ArgsType) -> Dict[str, str]:
     return {}
   
@@ -265,5 +262,6 @@ class InferenceStrategy:
   def fallback(self, *args: ArgsType) -> ReturnType:
     raise ValueError("LLM output didn't pass validation with no fallback function defined.")
   
+  @traced(lambda self, *args: self.__class__.__name__, "llm")
   def __call__(self, *args: ArgsType) -> ReturnType:
     return self.chain.invoke(args)
@@ -0,0 +1,386 @@
+"""
+ Copyright 2024 Igor Novikov
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""
+Registry of the inference (chat model) and embedding backends.
+
+The backend is picked by the `inference_backend` and `embedding_backend`
+settings in utils.py:
+
+  * "openai" -- an OpenAI-compatible chat server (the default).
+  * "fake" -- a deterministic stand-in that needs neither a server nor the
+    network. Its answers are synthesized from the output_type of the calling
+    InferenceStrategy, so that they pass its validation. The latency of each
+    answer is set by `fake_inference_latency`: a number of seconds, or one
+    of ("uniform", low, high), ("normal", mean, sd), ("lognormal", mu, sigma).
+
+For embeddings, "local" (HuggingFace) and "openai" are registered by
+embedding.py, and "fake" embeds text as a sum of hashed token vectors. A
+backend may also register a function that embeds a list of texts in one
+call (see embedding_batch_backend); the others embed batches text by text.
+"""
+
+import hashlib
+import json
+import random
+import re
+import time
+import datetime
+import numpy
+
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+from langchain_openai import ChatOpenAI
+from langchain.schema import AIMessage, BaseMessage
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.pydantic_v1 import ValidationError
+
+import utils as config
+from tracer import trace_callbacks
+from cassette import cassette
+
+inference_backends: Dict[str, Callable[..., BaseChatModel]] = {}
+embedding_backends: Dict[str, Callable[[str], List[float]]] = {}
+embedding_batch_backends: Dict[str, Callable[[List[str]], List[List[float]]]] = {}
+
+def inference_backend(name: str):
+  def register(factory: Callable[..., BaseChatModel]):
+    inference_backends[name] = factory
+    return factory
+  return register
+
+def embedding_backend(name: str):
+  def register(embed: Callable[[str], List[float]]):
+    embedding_backends[name] = embed
+    return embed
+  return register
+
+def embedding_batch_backend(name: str):
+  def register(embed: Callable[[List[str]], List[List[float]]]):
+    embedding_batch_backends[name] = embed
+    return embed
+  return register
+
+def chat_model(model_name: str, prompt_config: Dict[str, Any], base_url: Optional[str] = None, strategy: Any = None, context: Optional[Dict[str, Any]] = None) -> BaseChatModel:
+  """
+  Creates the chat model of the configured inference backend.
+
+  Args:
+    model_name: The name of the model to use.
+    prompt_config: The temperature, max_tokens etc. of the prompt.
+    base_url: The URL of the OpenAI-compatible server, if not the default one.
+    strategy: The InferenceStrategy making the call, if any.
+    context: The context of the InferenceStrategy call.
+  Returns:
+    The chat model.
+  """
+  if cassette.mode == 'replay':
+    return cassette.chat_model(None, model_name, prompt_config, trace_callbacks())
+  factory = inference_backends[getattr(config, 'inference_backend', 'openai')]
+  model = factory(
+    model_name=model_name,
+    prompt_config=prompt_config,
+    base_url=base_url,
+    strategy=strategy,
+    context=context,
+    callbacks=trace_callbacks(),
+  )
+  if cassette.mode == 'record':
+    return cassette.chat_model(model, model_name, prompt_config, trace_callbacks())
+  return model
+
+def get_embedding_backend() -> Callable[[str], List[float]]:
+  default = 'local' if config.embedding_is_local else 'openai'
+  return cassette.embedding(embedding_backends[getattr(config, 'embedding_backend', default)])
+
+def get_embedding_batch_backend() -> Callable[[List[str]], List[List[float]]]:
+  default = 'local' if config.embedding_is_local else 'openai'
+  name = getattr(config, 'embedding_backend', default)
+  if name in embedding_batch_backends:
+    return cassette.embeddings(embedding_batch_backends[name])
+  embed = embedding_backends[name]
+  return cassette.embeddings(lambda texts: [embed(text) for text in texts])
+
+@inference_backend('openai')
+def openai_chat_model(model_name, prompt_config, base_url, callbacks, **kwargs):
+  return ChatOpenAI(
+    cache=None,
+    base_url=base_url,
+    openai_api_key=config.openai_api_key,
+    model=model_name,
+    temperature=prompt_config.get("temperature", 0.5),
+    max_tokens=prompt_config.get("max_tokens", 500),
+    callbacks=callbacks,
+    # top_k=prompt_config.get("top_k"),
+    # top_p=prompt_config.get("top_p"),
+    # min_p=prompt_config.get("min_p"),
+    # frequency_penalty=prompt_config.get("frequency_penalty"),
+    # presence_penalty=prompt_config.get("presence_penalty"),
+    # stop_sequences=prompt_config.get("stop"),
+  )
+
+# ============================================================================
+# ############################ [FAKE INFERENCE] ##############################
+# ============================================================================
+
+FAKE_PHRASES = [
+  "idle",
+  "reading a book",
+  "taking a short break",
+  "tidying up",
+  "having a snack",
+  "checking the schedule",
+  "taking a walk",
+  "writing some notes",
+]
+
+FAKE_EMOJIS = ["🙂", "📚", "🍳", "💤", "☕", "🚶", "✏️", "🎨", "🧹", "🎵"]
+
+def seeded_random(text: str) -> random.Random:
+  return random.Random(hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+def sample_latency(latency: Any, rng: random.Random) -> float:
+  if not latency:
+    return 0
+  if isinstance(latency, (int, float)):
+    return latency
+  kind, a, b = latency
+  if kind == "uniform":
+    return rng.uniform(a, b)
+  elif kind == "normal":
+    return max(0, rng.gauss(a, b))
+  elif kind == "lognormal":
+    return rng.lognormvariate(a, b)
+  raise ValueError(f"Unknown latency distribution: {kind}")
+
+def rotated(values: List[Any], rng: random.Random) -> List[Any]:
+  if not values:
+    return []
+  offset = rng.randrange(len(values))
+  return values[offset:] + values[:offset]
+
+def find_clock(context: Dict[str, Any]) -> datetime.datetime:
+  """
+  The first time of the day mentioned in the context (e.g., the wake up hour
+  of the daily plan), or 8 am.
+  """
+  for value in context.values():
+    if isinstance(value, str):
+      match = re.fullmatch(r'\s*(\d?\d):(\d\d)\s*([ap]m)?\s*', value, re.IGNORECASE)
+      if match:
+        hour = int(match.group(1)) % 12 if match.group(3) else int(match.group(1))
+        if match.group(3) and match.group(3).lower() == 'pm':
+          hour += 12
+        return datetime.datetime(2000, 1, 1, hour, int(match.group(2)))
+  return datetime.datetime(2000, 1, 1, 8)
+
+def string_candidates(name: str, schema: Dict, context: Dict[str, Any], rng: random.Random) -> List[str]:
+  """
+  Candidate values of a string field, the most plausible first: values from
+  the context whose key matches the field name (e.g., "all_sectors" for
+  "sector"), then generic phrases, then the other short context values.
+  """
+  description = schema.get('description', '')
+  if 'emoji' in name.lower() or 'emoji' in description.lower():
+    return rotated(FAKE_EMOJIS, rng)
+
+  matched, others = [], []
+  for key, value in context.items():
+    if key.endswith('_json') or key in ['format_instructions', 'examples', 'example_prompt']:
+      continue
+    if isinstance(value, list) and key.endswith(f"{name}s"):
+      matched += rotated([i for i in value if isinstance(i, str)], rng)
+    elif isinstance(value, str) and key.startswith(name):
+      matched += [value]
+    elif isinstance(value, str) and len(value) < 100:
+      others += [value]
+  return matched + rotated(FAKE_PHRASES, rng) + others
+
+def field_candidates(name: str, schema: Dict, definitions: Dict, context: Dict[str, Any], rng: random.Random, index: int = 0) -> List[Any]:
+  """
+  Candidate values of a field described by its JSON schema. Lists of objects
+  get their time fields laid out one after another (see array_candidates).
+  """
+  if '$ref' in schema:
+    schema = definitions[schema['$ref'].split('/')[-1]]
+  field_type = schema.get('type')
+
+  if field_type == 'string' and schema.get('format') == 'time':
+    clock = find_clock(context)
+    return [clock.strftime("%H:%M"), clock.strftime("%I:%M %p").lower()]
+  elif field_type == 'string':
+    return string_candidates(name, schema, context, rng)
+  elif field_type == 'integer':
+    if name in ['i', 'index']:
+      return [index + 1]
+    return rotated([5, 10, 15, 20, 30], rng)
+  elif field_type == 'number':
+    return rotated([0.5, 1.0, 2.0, 5.0], rng)
+  elif field_type == 'boolean':
+    return rotated([True, False], rng)
+  elif field_type == 'array':
+    return array_candidates(name, schema, definitions, context, rng)
+  elif field_type == 'object':
+    return [{
+      key: field_candidates(key, value, definitions, context, rng, index)[0]
+      for key, value in schema.get('properties', {}).items()
+      if key in schema.get('required', [])
+    }]
+  return [None]
+
+def array_candidates(name: str, schema: Dict, definitions: Dict, context: Dict[str, Any], rng: random.Random) -> List[List[Any]]:
+  item_schema = schema['items']
+  if '$ref' in item_schema:
+    item_schema = definitions[item_schema['$ref'].split('/')[-1]]
+  count = max(schema.get('minItems', 1), rng.randint(3, 8))
+
+  if item_schema.get('type') != 'object':
+    return [[
+      field_candidates(name, item_schema, definitions, context, rng, i)[i % 2]
+      for i in range(count)
+    ]]
+
+  # Time fields are laid out along a clock, so that every item starts when
+  # the previous one ends and the whole list fits in the rest of the day.
+  clock = find_clock(context)
+  slot = max(30, ((22 - clock.hour) * 60 // count) // 30 * 30)
+  candidates = []
+  for time_format in ["%I:%M %p", "%H:%M"]:
+    items = []
+    item_clock = clock
+    for i in range(count):
+      item = {}
+      seen_time = False
+      for key, value in item_schema.get('properties', {}).items():
+        if key not in item_schema.get('required', []):
+          continue
+        if value.get('format') == 'time':
+          if seen_time:
+            item_clock += datetime.timedelta(minutes=slot)
+          item[key] = item_clock.strftime(time_format).lower()
+          seen_time = True
+        else:
+          item[key] = field_candidates(key, value, definitions, context, rng, i)[0]
+      items += [item]
+    candidates += [items]
+  return candidates
+
+def fake_structured_response(strategy: Any, context: Dict[str, Any], rng: random.Random) -> str:
+  """
+  Synthesizes a JSON answer that passes the validation and postprocessing of
+  <strategy>. Every field starts with its most plausible candidate; the
+  fields that fail validation move on to their next candidate until the
+  whole answer is valid.
+  """
+  schema = strategy.output_type.schema()
+  definitions = schema.get('definitions', {})
+  names = [name for name in schema['properties'] if name != 'context']
+  candidates = {
+    name: ([None] if name not in schema.get('required', []) else []) +
+          field_candidates(name, schema['properties'][name], definitions, context, rng)
+    for name in names
+  }
+  positions = {name: 0 for name in names}
+
+  for _ in range(50):
+    answer = {
+      name: candidates[name][positions[name]]
+      for name in names
+      if candidates[name][positions[name]] is not None
+    }
+    try:
+      strategy.postprocess(strategy.output_type.parse_obj(dict(answer, context=context)))
+      break
+    except ValidationError as errors:
+      failed = set(error['loc'][0] for error in errors.errors()) & set(names)
+    except Exception:
+      failed = set()
+    for name in (failed or names):
+      positions[name] = (positions[name] + 1) % len(candidates[name])
+  return json.dumps(answer, ensure_ascii=False)
+
+def fake_legacy_response(prompt: str, rng: random.Random) -> str:
+  """
+  The answer to a legacy (GPT-3 style) prompt. Prompts that come with an
+  example output get the example back, which is what their validators
+  expect. The others get a generic answer, and fall back to their fail-safe
+  response if it does not validate.
+  """
+  match = re.search(r'Example output json:\n(\{.*\})\s*$', prompt, re.DOTALL)
+  if match:
+    return match.group(1)
+  if re.search(r'yes or no', prompt, re.IGNORECASE):
+    return rng.choice(["yes", "no"])
+  return rng.choice(FAKE_PHRASES)
+
+class FakeChatModel(BaseChatModel):
+  strategy: Any = None
+  context: Optional[Dict[str, Any]] = None
+  latency: Any = 0
+
+  @property
+  def _llm_type(self) -> str:
+    return "fake"
+
+  def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+    prompt = '\n'.join(str(message.content) for message in messages)
+    rng = seeded_random(prompt)
+    time.sleep(sample_latency(self.latency, rng))
+
+    if self.strategy is not None:
+      content = fake_structured_response(self.strategy, self.context or {}, rng)
+    else:
+      content = fake_legacy_response(prompt, rng)
+
+    token_usage = {
+      "prompt_tokens": len(prompt.split()),
+      "completion_tokens": len(content.split()),
+    }
+    token_usage["total_tokens"] = token_usage["prompt_tokens"] + token_usage["completion_tokens"]
+    return ChatResult(
+      generations=[ChatGeneration(message=AIMessage(content=content))],
+      llm_output={"token_usage": token_usage},
+    )
+
+@inference_backend('fake')
+def fake_chat_model(strategy, context, callbacks, **kwargs):
+  return FakeChatModel(
+    strategy=strategy,
+    context=context,
+    latency=getattr(config, 'fake_inference_latency', 0),
+    callbacks=callbacks,
+  )
+
+# ============================================================================
+# ############################ [FAKE EMBEDDING] ##############################
+# ============================================================================
+
+@lru_cache(maxsize=100000)
+def fake_token_vector(token: str) -> numpy.ndarray:
+  digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+  dim = getattr(config, 'fake_embedding_dim', 768)
+  return numpy.random.default_rng(int.from_bytes(digest, 'little')).standard_normal(dim)
+
+@embedding_backend('fake')
+def get_fake_embedding(text: str) -> List[float]:
+  """
+  Embeds the text as the normalized sum of the hashed vectors of its words,
+  so that texts sharing words are similar, like with a real embedding.
+  """
+  tokens = re.findall(r'\w+', text.lower()) or [text]
+  vector = numpy.sum([fake_token_vector(token) for token in tokens], axis=0)
+  return (vector / numpy.linalg.norm(vector)).tolist()
@@ -15,14 +15,19 @@
  """
 
 import openai
+import numpy
+import threading
 from typing import List
-from transformers import AutoModel
 from langchain_core.embeddings import Embeddings
 
 from utils import *
+from tracer import traced
+from persona.prompt_template.backends import embedding_backend, embedding_batch_backend, get_embedding_backend, get_embedding_batch_backend
 
 embedding_model_instances = {}
+embedding_model_lock = threading.Lock()
 
+@embedding_backend('openai')
 def get_openai_embedding(text, model=embedding_model):
   text = text.replace("\n", " ")
   if not text: 
@@ -30,20 +35,34 @@ def get_openai_embedding(text, model=embedding_model):
   return openai.Embedding.create(
           input=[text], model=model)['data'][0]['embedding']
 
+@embedding_batch_backend('openai')
+def get_openai_embeddings(texts, model=embedding_model):
+  texts = [text.replace("\n", " ") or "this is blank" for text in texts]
+  data = openai.Embedding.create(input=texts, model=model)['data']
+  return [i['embedding'] for i in sorted(data, key=lambda i: i['index'])]
+
+def get_local_model(model):
+  from transformers import AutoModel
+  with embedding_model_lock:
+    if model not in embedding_model_instances:
+      embedding_model_instances[model] = AutoModel.from_pretrained(model, trust_remote_code=True) # trust_remote_code is needed to use the encode method
+  return embedding_model_instances[model]
+
+@embedding_backend('local')
 def get_local_embedding(text, model=embedding_model):
-  if model not in embedding_model_instances:
-    embedding_model_instances[model] = AutoModel.from_pretrained(model, trust_remote_code=True) # trust_remote_code is needed to use the encode method
-  embeddings = embedding_model_instances[model].encode([text])
+  embeddings = get_local_model(model).encode([text])
   return embeddings[0]
 
-if embedding_is_local:
-  get_embedding = get_local_embedding
-else:
-  get_embedding = get_openai_embedding
+@embedding_batch_backend('local')
+def get_local_embeddings(texts, model=embedding_model):
+  return list(get_local_model(model).encode(texts))
+
+get_embedding = traced("get_embedding", "embedding")(get_embedding_backend())
+get_embeddings = traced("get_embeddings", "embedding")(get_embedding_batch_backend())
 
 class LocalEmbeddings(Embeddings):
   def embed_documents(self, texts: List[str]) -> List[List[float]]:
     return [self.embed_query(item) for item in texts]
 
   def embed_query(self, text: str) -> List[float]:
-    return get_embedding(text).tolist()
+    return numpy.asarray(get_embedding(text)).tolist()
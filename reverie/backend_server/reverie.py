@@ -28,12 +28,19 @@ import os
 import shutil
 import traceback
 import asyncio
+import random
+
+from concurrent.futures import ThreadPoolExecutor
 
 from selenium import webdriver
 
 from global_methods import *
 from utils import *
 from maze import *
+from step_channel import *
+from step_log import StepLog, read_step
+from tracer import tracer, trace_enabled
+from cassette import cassette
 from persona.persona import *
 
 ##############################################################################
@@ -54,16 +61,32 @@ class ReverieServer:
     # <sim_code> indicates our current simulation. The first step here is to 
     # copy everything that's in <fork_sim_code>, but edit its 
     # reverie/meta/json's fork variable. 
+    # With <layered_forks> (the default), the environment and movement 
+    # history of <fork_sim_code> is not copied: the new simulation only 
+    # writes its own steps, and reads the steps up to <fork_step> from the 
+    # simulation it was forked from (see step_log.py). Forking then only 
+    # copies the meta file and the personas. Note that the simulations a 
+    # layered fork was forked from must then be kept around. 
     self.sim_code = sim_code
     sim_folder = f"{fs_storage}/{self.sim_code}"
-    copyanything(fork_folder, sim_folder)
+    layered_forks = globals().get('layered_forks', True)
+    if layered_forks: 
+      copyanything(fork_folder, sim_folder, 
+                   skip=["environment", "movement", "trace"])
+    else: 
+      copyanything(fork_folder, sim_folder)
 
     with open(f"{sim_folder}/reverie/meta.json") as json_file:  
       reverie_meta = json.load(json_file)
 
     with open(f"{sim_folder}/reverie/meta.json", "w") as outfile: 
       reverie_meta["fork_sim_code"] = fork_sim_code
+      if layered_forks: 
+        reverie_meta["fork_step"] = reverie_meta["step"]
       outfile.write(json.dumps(reverie_meta, indent=2))
+    # <fork_step> is the last step this simulation reads from the simulation
+    # it was forked from, or None if it holds all of its steps itself. 
+    self.fork_step = reverie_meta.get("fork_step")
 
     # LOADING REVERIE'S GLOBAL VARIABLES
     # The start datetime of the Reverie: 
@@ -120,8 +143,7 @@ class ReverieServer:
     # self.persona_convo = dict()
 
     # Loading in all personas. 
-    init_env_file = f"{sim_folder}/environment/{str(self.step)}.json"
-    init_env = json.load(open(init_env_file))
+    init_env = read_step(sim_folder, "environment", self.step)
     for persona_name in reverie_meta['persona_names']: 
       persona_folder = f"{sim_folder}/personas/{persona_name}"
       p_x = init_env[persona_name]["x"]
@@ -130,13 +152,31 @@ class ReverieServer:
 
       self.personas[persona_name] = curr_persona
       self.personas_tile[persona_name] = (p_x, p_y)
-      self.maze.tiles[p_y][p_x]["events"].add(curr_persona.scratch
-                                              .get_curr_event_and_desc())
+      self.maze.add_event_from_tile(curr_persona.scratch
+                                    .get_curr_event_and_desc(), (p_x, p_y))
 
     # REVERIE SETTINGS PARAMETERS:  
     # <server_sleep> denotes the amount of time that our while loop rests each
     # cycle; this is to not kill our machine. 
     self.server_sleep = 0.1
+    # <concurrent_personas> is the number of personas whose cognition may run
+    # at the same time. It should match the number of in-flight requests the
+    # inference backend can serve. 1 means the personas move one after 
+    # another, exactly like the original Reverie. 
+    self.concurrent_personas = 1
+    if 'concurrent_personas' in globals(): 
+      self.concurrent_personas = max(1, int(globals()['concurrent_personas']))
+    # <random_seed> is the base seed from which every persona's random number
+    # generator is re-seeded at each step. It is kept in the meta file so 
+    # that forks of this simulation continue with the same seed. 
+    if 'random_seed' in globals(): 
+      self.random_seed = globals()['random_seed']
+    else: 
+      self.random_seed = reverie_meta.get("random_seed", 
+                                          random.randrange(2**32))
+    # When a cassette is recorded (or replayed), the seed is recorded (or 
+    # replayed) with the LLM calls. See cassette.py. 
+    self.random_seed = cassette.seed("random_seed", self.random_seed)
 
     # SIGNALING THE FRONTEND SERVER: 
     # curr_sim_code.json contains the current simulation code, and
@@ -154,14 +194,79 @@ class ReverieServer:
     with open(f"{fs_temp_storage}/curr_step.json", "w") as outfile: 
       outfile.write(json.dumps(curr_step, indent=2))
 
+    # <step_channel> is the socket through which the frontend pushes the 
+    # environment and receives the movements of every step. Without it, the 
+    # two servers fall back to exchanging the environment and movement 
+    # files. 
+    # <step_audit_log> determines whether the environment and movement files
+    # are still written when the channel is used. They are needed to resume 
+    # (fork) this simulation later and to replay it. 
+    # <step_logs> are the append-only logs that hold the environment and 
+    # movement "files" of every step (see step_log.py). 
+    self.step_channel = None
+    self.step_audit_log = True
+    if 'step_audit_log' in globals(): 
+      self.step_audit_log = globals()['step_audit_log']
+    self.step_logs = {"environment": StepLog(f"{sim_folder}/environment"), 
+                      "movement": StepLog(f"{sim_folder}/movement")}
+    # TRACING: 
+    # When <trace_enabled> is set, the trace of the cognitive stages of every
+    # step goes to the trace folder of the simulation (see tracer.py). 
+    if trace_enabled: 
+      tracer.open(f"{fs_storage}/{self.sim_code}/trace")
+
+    # <headless> determines whether "run" advances the simulation without 
+    # the frontend. The server then moves the personas to the tiles they 
+    # chose itself, and runs the steps back to back. 
+    self.headless = globals().get('headless', False)
+    # <next_tiles> holds the tile each persona asked to move to in the last
+    # step, which is where a headless step puts them. 
+    self.next_tiles = dict()
+    # <skip_quiet_steps> determines whether a headless run jumps over the 
+    # steps in which no persona would do anything but wait (e.g., sleep). 
+    self.skip_quiet_steps = globals().get('skip_quiet_steps', True)
+    # <autosave_steps> is the number of steps after which "run" saves the 
+    # simulation, 0 for never. The memory of the personas is then only 
+    # appended to their journals (see memory_journal.py), so that this is 
+    # cheap enough to do as often as every step. 
+    self.autosave_steps = globals().get('autosave_steps', 0)
+    # A headless server never talks to a frontend, so it opens no channel 
+    # unless <step_channel> asks for one, and leaves the channel file of the
+    # frontend alone. 
+    step_channel_file = f"{fs_temp_storage}/step_channel.json"
+    if globals().get('step_channel', not self.headless): 
+      self.step_channel = StepChannel(self.sim_code, step_channel_file, 
+                                      port=globals().get('step_channel_port', 
+                                                         0))
+    elif not self.headless and os.path.exists(step_channel_file): 
+      os.remove(step_channel_file)
+
+
+  def close(self): 
+    """
+    Closes the step channel and the step logs of the server. Whoever creates
+    a ReverieServer closes it once they are done with it. 
+
+    INPUT
+      None
+    OUTPUT 
+      None
+    """
+    if self.step_channel: 
+      self.step_channel.close()
+      self.step_channel = None
+    for step_log in self.step_logs.values(): 
+      step_log.close()
+
 
-  def save(self): 
+  def save(self, compact=True): 
     """
     Save all Reverie progress -- this includes Reverie's global state as well
     as all the personas.  
 
     INPUT
-      None
+      compact: Whether to save the memory of the personas in full, rather 
+               than appending the changes to their journals. 
     OUTPUT 
       None
       * Saves all relevant data to the designated memory directory
@@ -172,20 +277,26 @@ class ReverieServer:
     # Save Reverie meta information.
     reverie_meta = dict() 
     reverie_meta["fork_sim_code"] = self.fork_sim_code
+    if self.fork_step is not None: 
+      reverie_meta["fork_step"] = self.fork_step
     reverie_meta["start_date"] = self.start_time.strftime("%B %d, %Y")
     reverie_meta["curr_time"] = self.curr_time.strftime("%B %d, %Y, %H:%M:%S")
     reverie_meta["sec_per_step"] = self.sec_per_step
     reverie_meta["maze_name"] = self.maze.maze_name
     reverie_meta["persona_names"] = list(self.personas.keys())
     reverie_meta["step"] = self.step
+    reverie_meta["random_seed"] = self.random_seed
     reverie_meta_f = f"{sim_folder}/reverie/meta.json"
-    with open(reverie_meta_f, "w") as outfile: 
+    with open(reverie_meta_f + ".tmp", "w") as outfile: 
       outfile.write(json.dumps(reverie_meta, indent=2))
+    os.replace(reverie_meta_f + ".tmp", reverie_meta_f)
+    if cassette.mode == "record": 
+      cassette.save_index()
 
     # Save the personas.
     for persona_name, persona in self.personas.items(): 
       save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
-      persona.save(save_folder)
+      persona.save(save_folder, compact)
 
 
   def start_path_tester_server(self): 
@@ -277,7 +388,7 @@ class ReverieServer:
       time.sleep(self.server_sleep * 10)
 
 
-  def start_server(self, int_counter): 
+  def start_server(self, int_counter, headless=None): 
     """
     The main backend server of Reverie. 
     This function retrieves the environment file from the frontend to 
@@ -287,12 +398,11 @@ class ReverieServer:
     INPUT
       int_counter: Integer value for the number of steps left for us to take
                    in this iteration. 
+      headless: Whether to run without the frontend. Defaults to the 
+                <headless> setting. 
     OUTPUT 
       None
     """
-    # <sim_folder> points to the current simulation folder.
-    sim_folder = f"{fs_storage}/{self.sim_code}"
-
     # When a persona arrives at a game object, we give a unique event
     # to that object. 
     # e.g., ('double studio[...]:bed', 'is', 'unmade', 'unmade')
@@ -303,116 +413,415 @@ class ReverieServer:
     # <game_obj_cleanup> is used for that. 
     game_obj_cleanup = dict()
 
+    if headless is None: 
+      headless = self.headless
+    # <autosave_step> is the step at which the simulation was last saved. 
+    autosave_step = self.step
+
     # The main while loop of Reverie. 
     while (True): 
       # Done with this iteration if <int_counter> reaches 0. 
       if int_counter == 0: 
         break
 
-      # <curr_env_file> file is the file that our frontend outputs. When the
-      # frontend has done its job and moved the personas, then it will put a 
-      # new environment file that matches our step count. That's when we run 
+      # <new_env> is the environment that our frontend outputs. When the
+      # frontend has done its job and moved the personas, then it will push 
+      # a new environment that matches our step count. That's when we run 
       # the content of this for loop. Otherwise, we just wait. 
-      curr_env_file = f"{sim_folder}/environment/{self.step}.json"
-      if check_if_file_exists(curr_env_file):
-        # If we have an environment file, it means we have a new perception
-        # input to our personas. So we first retrieve it.
-        try: 
-          # Try and save block for robustness of the while loop.
-          with open(curr_env_file) as json_file:
-            new_env = json.load(json_file)
-            env_retrieved = True
-        except: 
-          pass
-      
-        if env_retrieved: 
-          # This is where we go through <game_obj_cleanup> to clean up all 
-          # object actions that were used in this cylce. 
-          for key, val in game_obj_cleanup.items(): 
-            # We turn all object actions to their blank form (with None). 
-            self.maze.turn_event_from_tile_idle(key, val)
-          # Then we initialize game_obj_cleanup for this cycle. 
-          game_obj_cleanup = dict()
-
-          # We first move our personas in the backend environment to match 
-          # the frontend environment. 
-          for persona_name, persona in self.personas.items(): 
-            # <curr_tile> is the tile that the persona was at previously. 
-            curr_tile = self.personas_tile[persona_name]
-            # <new_tile> is the tile that the persona will move to right now,
-            # during this cycle. 
-            new_tile = (new_env[persona_name]["x"], 
-                        new_env[persona_name]["y"])
-
-            # We actually move the persona on the backend tile map here. 
-            self.personas_tile[persona_name] = new_tile
-            self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
+      if headless: 
+        new_env = self.headless_environment()
+        if self.step_audit_log: 
+          self.write_environment(new_env)
+      else: 
+        new_env = self.receive_environment()
+      if new_env: 
+        # This is where we go through <game_obj_cleanup> to clean up all 
+        # object actions that were used in this cylce. 
+        for key, val in game_obj_cleanup.items(): 
+          # We turn all object actions to their blank form (with None). 
+          self.maze.turn_event_from_tile_idle(key, val)
+        # Then we initialize game_obj_cleanup for this cycle. 
+        game_obj_cleanup = dict()
+
+        # We first move our personas in the backend environment to match 
+        # the frontend environment. 
+        for persona_name, persona in self.personas.items(): 
+          # <curr_tile> is the tile that the persona was at previously. 
+          curr_tile = self.personas_tile[persona_name]
+          # <new_tile> is the tile that the persona will move to right now,
+          # during this cycle. 
+          new_tile = (new_env[persona_name]["x"], 
+                      new_env[persona_name]["y"])
+
+          # We actually move the persona on the backend tile map here. 
+          self.personas_tile[persona_name] = new_tile
+          self.maze.remove_subject_events_from_tile(persona.name, curr_tile)
+          self.maze.add_event_from_tile(persona.scratch
+                                       .get_curr_event_and_desc(), new_tile)
+
+          # Now, the persona will travel to get to their destination. *Once*
+          # the persona gets there, we activate the object action.
+          if not persona.scratch.planned_path: 
+            # We add that new object action event to the backend tile map. 
+            # At its creation, it is stored in the persona's backend. 
+            game_obj_cleanup[persona.scratch
+                             .get_curr_obj_event_and_desc()] = new_tile
             self.maze.add_event_from_tile(persona.scratch
-                                         .get_curr_event_and_desc(), new_tile)
-
-            # Now, the persona will travel to get to their destination. *Once*
-            # the persona gets there, we activate the object action.
-            if not persona.scratch.planned_path: 
-              # We add that new object action event to the backend tile map. 
-              # At its creation, it is stored in the persona's backend. 
-              game_obj_cleanup[persona.scratch
-                               .get_curr_obj_event_and_desc()] = new_tile
-              self.maze.add_event_from_tile(persona.scratch
-                                     .get_curr_obj_event_and_desc(), new_tile)
-              # We also need to remove the temporary blank action for the 
-              # object that is currently taking the action. 
-              blank = (persona.scratch.get_curr_obj_event_and_desc()[0], 
-                       None, None, None)
-              self.maze.remove_event_from_tile(blank, new_tile)
-
-          # Then we need to actually have each of the personas perceive and
-          # move. The movement for each of the personas comes in the form of
-          # x y coordinates where the persona will move towards. e.g., (50, 34)
-          # This is where the core brains of the personas are invoked. 
-          movements = {"persona": dict(), 
-                       "meta": dict()}
-          for persona_name, persona in self.personas.items(): 
-            # <next_tile> is a x,y coordinate. e.g., (58, 9)
-            # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
-            # <description> is a string description of the movement. e.g., 
-            #   writing her next novel (editing her novel) 
-            #   @ double studio:double studio:common room:sofa
-            next_tile, pronunciatio, description = persona.move(
-              self.maze, self.personas, self.personas_tile[persona_name], 
-              self.curr_time)
-            movements["persona"][persona_name] = {}
-            movements["persona"][persona_name]["movement"] = next_tile
-            movements["persona"][persona_name]["pronunciatio"] = pronunciatio
-            movements["persona"][persona_name]["description"] = description
-            movements["persona"][persona_name]["chat"] = (persona
-                                                          .scratch.chat)
-
-          # Include the meta information about the current stage in the 
-          # movements dictionary. 
-          movements["meta"]["curr_time"] = (self.curr_time 
-                                             .strftime("%B %d, %Y, %H:%M:%S"))
-
-          # We then write the personas' movements to a file that will be sent 
-          # to the frontend server. 
-          # Example json output: 
-          # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
-          #  "persona": {"Klaus Mueller": {"movement": [38, 12]}}, 
-          #  "meta": {curr_time: <datetime>}}
-          curr_move_file = f"{sim_folder}/movement/{self.step}.json"
-          directory = os.path.dirname(curr_move_file)
-          os.makedirs(directory, exist_ok=True)
-          with open(curr_move_file, "w") as outfile: 
-            outfile.write(json.dumps(movements, indent=2))
-
-          # After this cycle, the world takes one step forward, and the 
-          # current time moves by <sec_per_step> amount. 
-          self.step += 1
-          self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
-
-          int_counter -= 1
-          
-      # Sleep so we don't burn our machines. 
-      time.sleep(self.server_sleep)
+                                   .get_curr_obj_event_and_desc(), new_tile)
+            # We also need to remove the temporary blank action for the 
+            # object that is currently taking the action. 
+            blank = (persona.scratch.get_curr_obj_event_and_desc()[0], 
+                     None, None, None)
+            self.maze.remove_event_from_tile(blank, new_tile)
+
+        # Then we need to actually have each of the personas perceive and
+        # move. The movement for each of the personas comes in the form of
+        # x y coordinates where the persona will move towards. e.g., (50, 34)
+        # This is where the core brains of the personas are invoked. 
+        movements = {"persona": dict(), 
+                     "meta": dict()}
+        quiet_state = self.get_quiet_state(self.personas_tile)
+        tracer.step = self.step
+        executions = self.move_personas()
+        if trace_enabled: 
+          tracer.end_step()
+        for persona_name, persona in self.personas.items(): 
+          # <next_tile> is a x,y coordinate. e.g., (58, 9)
+          # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
+          # <description> is a string description of the movement. e.g., 
+          #   writing her next novel (editing her novel) 
+          #   @ double studio:double studio:common room:sofa
+          next_tile, pronunciatio, description = executions[persona_name]
+          self.next_tiles[persona_name] = tuple(next_tile)
+          movements["persona"][persona_name] = {}
+          movements["persona"][persona_name]["movement"] = next_tile
+          movements["persona"][persona_name]["pronunciatio"] = pronunciatio
+          movements["persona"][persona_name]["description"] = description
+          movements["persona"][persona_name]["chat"] = (persona
+                                                        .scratch.chat)
+
+        # Include the meta information about the current stage in the 
+        # movements dictionary. 
+        movements["meta"]["curr_time"] = (self.curr_time 
+                                           .strftime("%B %d, %Y, %H:%M:%S"))
+
+        # We then send the personas' movements to the frontend server. 
+        # Example json output: 
+        # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
+        #  "persona": {"Klaus Mueller": {"movement": [38, 12]}}, 
+        #  "meta": {curr_time: <datetime>}}
+        self.send_movements(movements)
+
+        # After this cycle, the world takes one step forward, and the 
+        # current time moves by <sec_per_step> amount. 
+        self.step += 1
+        self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+
+        int_counter -= 1
+
+        # If nothing happened in this step, the following steps will look 
+        # exactly the same until one of the personas wakes up. We do not need
+        # to think them through. 
+        if (headless and self.skip_quiet_steps and int_counter > 0
+            and quiet_state is not None
+            and quiet_state == self.get_quiet_state(self.next_tiles)): 
+          int_counter -= self.skip_quiet_steps_until_wake_up(movements, 
+                                                              int_counter)
+
+        if (self.autosave_steps 
+            and self.step - autosave_step >= self.autosave_steps): 
+          self.save(compact=False)
+          autosave_step = self.step
+        
+      elif not self.step_channel: 
+        # Sleep so we don't burn our machines. When we have the step channel,
+        # waiting for the environment already did that. 
+        time.sleep(self.server_sleep)
+
+    # A headless run leaves the environment of the step it stopped at behind,
+    # just like the frontend would, so that the simulation can be resumed. 
+    if headless and self.step_audit_log: 
+      self.write_environment(self.headless_environment())
+
+
+  def get_quiet_state(self, personas_tile): 
+    """
+    Summarizes everything about the personas that a step may change in a way
+    that the other personas can perceive or that the following steps depend 
+    on. If the summary before and after a step is the same, the step was 
+    quiet: nobody moved, changed their action, or memorized anything new. 
+
+    INPUT
+      personas_tile: The tile of each persona (persona name -> (x, y)). 
+    OUTPUT 
+      A dictionary that takes the persona's full name as its key. It is None
+      if one of the personas is not idle, e.g., walking somewhere. 
+    """
+    quiet_state = dict()
+    for persona_name, persona in self.personas.items(): 
+      scratch = persona.scratch
+      if (scratch.planned_path or not scratch.act_path_set
+          or not scratch.act_address or "<random>" in scratch.act_address): 
+        return None
+      quiet_state[persona_name] = (tuple(personas_tile[persona_name]), 
+                                   scratch.get_curr_event_and_desc(), 
+                                   scratch.get_curr_obj_event_and_desc(), 
+                                   scratch.act_start_time, 
+                                   scratch.chatting_end_time,
+                                   len(persona.a_mem.seq_event), 
+                                   len(persona.a_mem.seq_thought), 
+                                   len(persona.a_mem.seq_chat))
+    return quiet_state
+
+
+  def get_quiet_step_count(self): 
+    """
+    Counts how many steps, starting from the current one, we can skip after 
+    a quiet step. Since the world does not change during these steps, the 
+    personas only act again when one of them wakes up: 
+      1) The current action of a persona finishes (see act_check_finished,
+         which only compares the time of the day). 
+      2) A persona's conversation is about to end (see reflect). 
+      3) A new day starts, and with it the long term planning. 
+
+    INPUT
+      None
+    OUTPUT 
+      The number of steps to skip. 
+    """
+    sec_per_step = datetime.timedelta(seconds=self.sec_per_step)
+    last_time = self.curr_time - sec_per_step
+    # The first step of the new day may come a bit after midnight. 
+    midnight = datetime.datetime.combine(
+      last_time.date() + datetime.timedelta(days=1), datetime.time())
+    count = math.ceil((midnight - self.curr_time) / sec_per_step)
+
+    # The other wake up triggers need an exact match, so they only count if 
+    # they fall on one of the steps. 
+    wake_up_times = []
+    for persona_name, persona in self.personas.items(): 
+      end_time = persona.scratch.get_act_end_time()
+      if end_time: 
+        end_time = datetime.datetime.combine(self.curr_time.date(), 
+                                             end_time.time())
+        if end_time < self.curr_time: 
+          end_time += datetime.timedelta(days=1)
+        wake_up_times += [end_time]
+      if persona.scratch.chatting_end_time: 
+        wake_up_times += [persona.scratch.chatting_end_time 
+                          - datetime.timedelta(seconds=10)]
+    for wake_up_time in wake_up_times: 
+      if wake_up_time < self.curr_time: 
+        continue
+      if (wake_up_time - self.curr_time) % sec_per_step: 
+        continue
+      count = min(count, (wake_up_time - self.curr_time) // sec_per_step)
+    return max(count, 0)
+
+
+  def skip_quiet_steps_until_wake_up(self, movements, int_counter): 
+    """
+    Skips the steps after a quiet step until one of the personas wakes up 
+    (but no further than <int_counter> steps). The skipped steps end up 
+    exactly as if we had run them: the personas stay where they are and keep
+    doing what they were doing, and the movements are recorded as usual. 
+
+    INPUT
+      movements: The movements of the quiet step. 
+      int_counter: The number of steps left in this run. 
+    OUTPUT 
+      The number of steps skipped. 
+    """
+    count = min(self.get_quiet_step_count(), int_counter)
+    for i in range(count): 
+      # The only thing that changes from one quiet step to the next is that
+      # the personas' chatting buffer counts down. 
+      for persona_name, persona in self.personas.items(): 
+        persona.scratch.curr_time = self.curr_time
+        for p_n in persona.scratch.chatting_with_buffer: 
+          if p_n != persona.scratch.chatting_with: 
+            persona.scratch.chatting_with_buffer[p_n] -= 1
+
+      if self.step_audit_log: 
+        self.write_environment(self.headless_environment())
+      movements["meta"]["curr_time"] = (self.curr_time 
+                                         .strftime("%B %d, %Y, %H:%M:%S"))
+      self.send_movements(movements)
+
+      self.step += 1
+      self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
+    return count
+
+
+  def headless_environment(self): 
+    """
+    Builds the environment of the current step without the frontend, by 
+    moving every persona to the tile it chose in the previous step. 
+
+    INPUT
+      None
+    OUTPUT 
+      The environment dictionary, in the same form the frontend sends it. 
+    """
+    new_env = dict()
+    for persona_name in self.personas: 
+      x, y = self.next_tiles.get(persona_name, 
+                                 self.personas_tile[persona_name])
+      new_env[persona_name] = {"maze": self.maze.maze_name, "x": x, "y": y}
+    return new_env
+
+
+  def write_environment(self, new_env): 
+    """
+    Writes the environment of the current step to its environment file. 
+
+    INPUT
+      new_env: The environment dictionary. 
+    OUTPUT 
+      None
+    """
+    self.step_logs["environment"].append(self.step, new_env)
+
+
+  def receive_environment(self): 
+    """
+    Receives the environment of the current step from the frontend, either 
+    through the step channel or through the environment file. 
+
+    INPUT
+      None
+    OUTPUT 
+      The environment dictionary (persona name -> {"maze", "x", "y"}), or 
+      None if the frontend has not sent it yet. 
+    """
+    if self.step_channel: 
+      # We block on the channel for a while, but still check the environment
+      # file afterwards in case the environment was written by hand (or by a
+      # frontend that does not know about the channel). 
+      new_env = self.step_channel.wait_environment(self.step, 1)
+      if new_env: 
+        if self.step_audit_log: 
+          self.write_environment(new_env)
+        return new_env
+
+    return read_step(f"{fs_storage}/{self.sim_code}", "environment", 
+                     self.step)
+
+
+  def send_movements(self, movements): 
+    """
+    Sends the movements of the current step to the frontend, through the 
+    step channel and/or the movement file. 
+
+    INPUT
+      movements: The movements dictionary computed in start_server.
+    OUTPUT 
+      None
+    """
+    if self.step_channel: 
+      self.step_channel.publish_movement(self.step, movements)
+
+    if not self.step_channel or self.step_audit_log: 
+      self.step_logs["movement"].append(self.step, movements)
+
+
+  def move_personas(self): 
+    """
+    Runs the cognitive sequence of every persona for the current step and 
+    returns their executions. 
+
+    With <concurrent_personas> set to 1, the personas move one after another
+    in the order of self.personas, just like before. Otherwise, the step is
+    split into phases so that the slow, LLM-bound parts of the personas' 
+    cognition run at the same time, while everything that touches shared 
+    state is committed in the deterministic order of self.personas: 
+      1) Concurrently, every persona perceives and retrieves. These only 
+         read the maze and write to the persona's own memory. 
+      2) Concurrently, the personas who did not perceive another persona 
+         plan and reflect. Their plans cannot involve anyone else. 
+      3) One after another, the personas who did perceive another persona 
+         plan and reflect, since they may start a conversation that changes 
+         the other persona's state. 
+      4) One after another, every persona executes its plan. This is where
+         the random target tiles and the occupied tiles are decided. 
+
+    INPUT
+      None
+    OUTPUT 
+      executions: A dictionary that takes the persona's full name as its key
+                  and the execution triple of Persona.move as its value. 
+    """
+    # Every persona draws from its own random number generator, re-seeded 
+    # here so that a step's outcome does not depend on thread scheduling. 
+    for persona_name, persona in self.personas.items(): 
+      persona.rng.seed(cassette.seed(
+        f"{persona_name}:{self.step}", 
+        f"{self.random_seed}:{persona_name}:{self.step}"))
+
+    # The paths planned in this step are reserved from this step on. 
+    if self.maze.path_reservations: 
+      self.maze.path_reservations.set_step(self.step)
+
+    executions = dict()
+    if self.concurrent_personas == 1: 
+      for persona_name, persona in self.personas.items(): 
+        executions[persona_name] = persona.move(
+          self.maze, self.personas, self.personas_tile[persona_name], 
+          self.curr_time)
+      return executions
+
+    def perceive_and_retrieve(persona_name): 
+      persona = self.personas[persona_name]
+      new_day = persona.update_curr_state(self.personas_tile[persona_name], 
+                                          self.curr_time)
+      retrieved = persona.retrieve(persona.perceive(self.maze))
+      return new_day, retrieved
+
+    def plan_and_reflect(persona_name): 
+      persona = self.personas[persona_name]
+      new_day, retrieved = cognition[persona_name]
+      plan = persona.plan(self.maze, self.personas, new_day, retrieved)
+      persona.reflect()
+      return plan
+
+    def perceived_other_persona(persona_name): 
+      _, retrieved = cognition[persona_name]
+      for rel_ctx in retrieved.values(): 
+        subject = rel_ctx["curr_event"].subject
+        if ":" not in subject and subject != persona_name: 
+          return True
+      return False
+
+    persona_names = list(self.personas.keys())
+    with ThreadPoolExecutor(max_workers=self.concurrent_personas, 
+                            initializer=self._init_cognition_thread) as pool: 
+      cognition = dict(zip(persona_names, 
+                           pool.map(perceive_and_retrieve, persona_names)))
+
+      social = [i for i in persona_names if perceived_other_persona(i)]
+      solo = [i for i in persona_names if i not in social]
+      list(pool.map(plan_and_reflect, solo))
+    for persona_name in social: 
+      plan_and_reflect(persona_name)
+
+    # A plan is the persona's <act_address>, which is read again here: a 
+    # social persona may have started a conversation with a solo persona in
+    # phase 3, and thereby changed the solo persona's destination. 
+    for persona_name in persona_names: 
+      persona = self.personas[persona_name]
+      executions[persona_name] = persona.execute(
+        self.maze, self.personas, persona.scratch.act_address)
+    return executions
+
+
+  def _init_cognition_thread(self): 
+    """
+    Makes the server's event loop visible to a cognition worker thread. The 
+    inference strategies look up the server (e.g., for the current time) 
+    through the event loop. 
+    """
+    if hasattr(self, "loop"): 
+      asyncio.set_event_loop(self.loop)
 
 
   async def open_server(self): 
@@ -433,14 +842,19 @@ class ReverieServer:
     # <sim_folder> points to the current simulation folder.
     sim_folder = f"{fs_storage}/{self.sim_code}"
 
-    first_run = True
+    # <startup_commands> are run one after another before we start asking 
+    # for input. <startup_command> can be a single command or a list of them,
+    # e.g., ["run headless 8640", "fin"] for an unattended batch run. 
+    startup_commands = globals().get('startup_command', [])
+    if isinstance(startup_commands, str): 
+      startup_commands = [startup_commands]
+    startup_commands = list(startup_commands)
 
     while True: 
-      if first_run and 'startup_command' in globals():
-          sim_command = globals()['startup_command']
+      if startup_commands:
+          sim_command = startup_commands.pop(0)
       else:
           sim_command = input("Enter option: ")
-      first_run = False
       sim_command = sim_command.strip()
       ret_str = ""
 
@@ -471,10 +885,15 @@ class ReverieServer:
           self.save()
 
         elif sim_command[:3].lower() == "run": 
-          # Runs the number of steps specified in the prompt.
+          # Runs the number of steps specified in the prompt. With "headless",
+          # the steps are run without waiting for the frontend. 
           # Example: run 1000
+          # Example: run headless 1000
           int_count = int(sim_command.split()[-1])
-          rs.start_server(int_count)
+          if "headless" in sim_command.lower().split(): 
+            self.start_server(int_count, headless=True)
+          else: 
+            self.start_server(int_count)
 
         elif ("print persona schedule" 
               in sim_command[:22].lower()): 
@@ -615,6 +1034,7 @@ class ReverieServer:
       self.loop.run_until_complete(self.open_server())
     finally:
       self.loop.close()
+      self.close()
 
 if __name__ == '__main__':
   # rs = ReverieServer("base_the_ville_isabella_maria_klaus", 
@@ -0,0 +1,150 @@
+"""
+File: step_channel.py
+Description: A push-based channel between the backend server (Reverie) and
+the frontend server (Django).
+
+Originally, the two servers talked to each other only through files: the
+frontend wrote storage/<sim_code>/environment/<step>.json and the backend
+polled for it, and then the backend wrote storage/<sim_code>/movement/<step>
+.json and the frontend polled for that. The step channel replaces the polling
+with a small line-based JSON protocol over a local TCP socket. The backend
+listens on the loopback interface and advertises the address in
+temp_storage/step_channel.json. Each connection carries exactly one request
+and one response, each a single line of JSON:
+
+  {"op": "push_environment", "sim_code": ..., "step": ..., "environment": ...}
+  -> {"ok": true}
+  {"op": "pull_movement", "sim_code": ..., "step": ..., "timeout": ...}
+  -> {"ok": true, "movement": <movements or null>}
+
+Pushed environments wake up the waiting backend immediately, and a pull
+blocks until the movement of the requested step is published (or until the
+timeout passes), so neither side sleeps on a timer.
+"""
+import json
+import os
+import socketserver
+import threading
+
+
+class StepChannelHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      return
+    try:
+      request = json.loads(line)
+      response = self.server.channel.handle_request(request)
+    except Exception as e:
+      response = {"ok": False, "error": str(e)}
+    self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class StepChannelServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class StepChannel:
+  def __init__(self, sim_code, address_file, host="127.0.0.1", port=0):
+    """
+    Starts listening for the frontend in a background thread.
+
+    INPUT
+      sim_code: The code of the simulation the backend is running. Requests
+                for other simulations are ignored.
+      address_file: The file where the address of the channel is advertised
+                    to the frontend.
+      host: The interface to listen on.
+      port: The port to listen on. 0 lets the OS pick a free one.
+    OUTPUT
+      None
+    """
+    self.sim_code = sim_code
+    self.address_file = address_file
+
+    # <environments> holds the environments pushed by the frontend that the
+    # backend has not consumed yet, keyed by step.
+    # <movements> holds the movements published by the backend, keyed by
+    # step. Only the most recent ones are kept, in case the frontend asks
+    # for the same step twice (e.g., after a page reload).
+    self.environments = dict()
+    self.movements = dict()
+    self.cond = threading.Condition()
+
+    self.server = StepChannelServer((host, port), StepChannelHandler)
+    self.server.channel = self
+    self.host, self.port = self.server.server_address[:2]
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   daemon=True)
+    self.thread.start()
+
+    with open(self.address_file, "w") as outfile:
+      outfile.write(json.dumps({"sim_code": self.sim_code,
+                                "host": self.host,
+                                "port": self.port}, indent=2))
+
+
+  def handle_request(self, request):
+    if request.get("sim_code") != self.sim_code:
+      return {"ok": False, "error": "unknown sim_code"}
+
+    step = int(request["step"])
+    if request["op"] == "push_environment":
+      with self.cond:
+        self.environments[step] = request["environment"]
+        self.cond.notify_all()
+      return {"ok": True}
+
+    elif request["op"] == "pull_movement":
+      timeout = min(float(request.get("timeout", 0)), 30)
+      with self.cond:
+        self.cond.wait_for(lambda: step in self.movements, timeout)
+        return {"ok": True, "movement": self.movements.get(step)}
+
+    return {"ok": False, "error": f"unknown op {request['op']}"}
+
+
+  def wait_environment(self, step, timeout):
+    """
+    Waits for the frontend to push the environment of <step>.
+
+    INPUT
+      step: The step whose environment we are waiting for.
+      timeout: The maximum number of seconds to wait.
+    OUTPUT
+      The environment dictionary, or None if it did not arrive in time.
+    """
+    with self.cond:
+      self.cond.wait_for(lambda: step in self.environments, timeout)
+      for i in [i for i in self.environments if i < step]:
+        del self.environments[i]
+      return self.environments.pop(step, None)
+
+
+  def publish_movement(self, step, movements):
+    """
+    Hands the movements of <step> over to the frontend, waking up any
+    pending pull for it.
+
+    INPUT
+      step: The step that <movements> were computed for.
+      movements: The movements dictionary, as written to the movement file.
+    OUTPUT
+      None
+    """
+    # We serialize here so that the tuples become lists, exactly as the
+    # frontend would see them in the movement file.
+    movements = json.loads(json.dumps(movements))
+    with self.cond:
+      self.movements[step] = movements
+      for i in [i for i in self.movements if i < step - 1]:
+        del self.movements[i]
+      self.cond.notify_all()
+
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+    if os.path.exists(self.address_file):
+      os.remove(self.address_file)
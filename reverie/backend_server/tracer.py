@@ -0,0 +1,217 @@
+"""
+File: tracer.py
+Description: Optional instrumentation of the simulation. When <trace_enabled>
+is set in utils.py, the cognitive stages of the personas (perceive, retrieve,
+plan, reflect, execute), every inference strategy call, every embedding and
+every path finding call are recorded with their wall time, LLM token counts
+and cache hits.
+
+The records of a simulation are saved to storage/<sim_code>/trace/:
+  trace.json -- a Chrome trace (JSON array format) that can be opened in
+                chrome://tracing or https://ui.perfetto.dev
+  summary.csv -- one row per step, persona and stage with the totals.
+
+When tracing is disabled, @traced returns the decorated function as it is,
+so the instrumentation costs nothing.
+"""
+import csv
+import functools
+import json
+import os
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+import utils as config
+
+trace_enabled = getattr(config, "trace_enabled", False)
+# <COUNTERS> are the span arguments that are totalled in the summary.
+COUNTERS = ["llm_calls", "prompt_tokens", "completion_tokens",
+            "llm_cache_hits", "embedding_cache_hits"]
+
+
+class Tracer:
+  def __init__(self):
+    # <events> are the finished spans that have not been written yet, each
+    # with the totals of its counters and those of the spans it encloses.
+    # <local> keeps the stack of the open spans of each thread, so that
+    # counters (e.g., tokens) can be added to the innermost one, and the
+    # stack of their totals so far.
+    self.events = []
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.start = time.perf_counter()
+    self.step = None
+    self.folder = None
+
+
+  def open(self, folder):
+    """
+    Sets the folder the trace is written to and starts the trace. The trace
+    of a previous run in the same folder is replaced, and the spans recorded
+    before (e.g., while the modules were loaded) are dropped.
+
+    INPUT
+      folder: The trace folder, e.g., storage/<sim_code>/trace
+    OUTPUT
+      None
+    """
+    self.folder = folder
+    with self.lock:
+      self.events = []
+    os.makedirs(folder, exist_ok=True)
+    with open(f"{folder}/trace.json", "w") as outfile:
+      outfile.write("[\n")
+    with open(f"{folder}/summary.csv", "w", newline="") as outfile:
+      csv.writer(outfile).writerow(
+        ["step", "persona", "stage", "calls", "wall_ms", "llm_calls",
+         "prompt_tokens", "completion_tokens", "llm_cache_hits",
+         "embedding_cache_hits"])
+
+
+  def begin(self, name, cat, args):
+    stack = getattr(self.local, "stack", None)
+    if stack is None:
+      stack = self.local.stack = []
+      self.local.totals = []
+    span = {"name": name, "cat": cat, "ph": "X", "pid": 0,
+            "tid": threading.get_ident(),
+            "ts": (time.perf_counter() - self.start) * 1e6,
+            "args": dict(args, step=self.step)}
+    if stack and "persona" not in span["args"]:
+      persona = stack[-1]["args"].get("persona")
+      if persona:
+        span["args"]["persona"] = persona
+    stack.append(span)
+    self.local.totals.append(dict())
+    return span
+
+
+  def end(self, span):
+    self.local.stack.pop()
+    totals = self.local.totals.pop()
+    span["dur"] = (time.perf_counter() - self.start) * 1e6 - span["ts"]
+    # The counters of the span are included in the totals of all its
+    # enclosing spans, which are still open on the same thread.
+    for key in COUNTERS:
+      if key in span["args"]:
+        totals[key] = totals.get(key, 0) + span["args"][key]
+    if self.local.totals:
+      parent = self.local.totals[-1]
+      for key, value in totals.items():
+        parent[key] = parent.get(key, 0) + value
+    with self.lock:
+      self.events.append((span, totals))
+
+
+  def add(self, key, value=1):
+    """
+    Adds <value> to the counter <key> of the innermost open span of the
+    current thread.
+    """
+    stack = getattr(self.local, "stack", None)
+    if stack:
+      args = stack[-1]["args"]
+      args[key] = args.get(key, 0) + value
+
+
+  def end_step(self):
+    """
+    Writes out the spans of the finished step and prints its summary.
+
+    INPUT
+      None
+    OUTPUT
+      None
+    """
+    with self.lock:
+      events, self.events = self.events, []
+    if not events:
+      return
+
+    # <summary> totals every (persona, stage) pair of the step.
+    summary = dict()
+    for event, totals in events:
+      key = (event["args"].get("persona", ""), event["name"])
+      row = summary.setdefault(key, dict.fromkeys(["calls", "wall_ms"]
+                                                  + COUNTERS, 0))
+      row["calls"] += 1
+      row["wall_ms"] += event["dur"] / 1000
+      for counter, value in totals.items():
+        row[counter] += value
+
+    step = self.step
+    stages = dict()
+    for (persona, stage), row in summary.items():
+      stages[stage] = stages.get(stage, 0) + row["wall_ms"]
+    print(f"Trace of step {step}: " + ", ".join(
+      f"{stage} {wall_ms / 1000:.2f}s" for stage, wall_ms in stages.items()))
+
+    if not self.folder:
+      return
+    with open(f"{self.folder}/trace.json", "a") as outfile:
+      for event, totals in events:
+        outfile.write(json.dumps(event) + ",\n")
+    with open(f"{self.folder}/summary.csv", "a", newline="") as outfile:
+      writer = csv.writer(outfile)
+      for (persona, stage), row in summary.items():
+        writer.writerow([step, persona, stage, row["calls"],
+                         round(row["wall_ms"], 3)]
+                        + [row[key] for key in COUNTERS])
+
+
+tracer = Tracer()
+
+
+def traced(name, cat="function", args=None):
+  """
+  Decorates a function so that every call to it is recorded as a span.
+
+  INPUT
+    name: The name of the span, or a function that takes the call's
+          arguments and returns it.
+    cat: The category of the span.
+    args: An optional function that takes the call's arguments and returns
+          a dictionary of extra span arguments (e.g., the persona's name).
+  OUTPUT
+    The decorator.
+  """
+  def decorator(fn):
+    if not trace_enabled:
+      return fn
+    @functools.wraps(fn)
+    def traced_fn(*fn_args, **fn_kwargs):
+      span_name = name(*fn_args) if callable(name) else name
+      span = tracer.begin(span_name, cat, args(*fn_args) if args else {})
+      try:
+        return fn(*fn_args, **fn_kwargs)
+      finally:
+        tracer.end(span)
+    return traced_fn
+  return decorator
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+  """
+  Counts the LLM calls and tokens of the model it is attached to. A call
+  that reports no token usage is counted as a cache hit, since that is what
+  the LLM cache returns.
+  """
+  def on_llm_end(self, response, **kwargs):
+    tracer.add("llm_calls")
+    token_usage = (response.llm_output or {}).get("token_usage")
+    if not token_usage:
+      tracer.add("llm_cache_hits")
+      return
+    tracer.add("prompt_tokens", token_usage.get("prompt_tokens", 0))
+    tracer.add("completion_tokens", token_usage.get("completion_tokens", 0))
+
+
+def trace_callbacks():
+  """
+  Returns the callbacks to attach to the LLMs (none if tracing is off).
+  """
+  if not trace_enabled:
+    return None
+  return [TraceCallbackHandler()]
@@ -6,13 +6,17 @@ Description: Compresses a simulation for replay demos.
 """
 import shutil
 import json
+import os
+import sys
 from global_methods import *
 
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/backend_server")
+from step_log import read_step, last_step
+
 def compress(sim_code):
   sim_storage = f"../environment/frontend_server/storage/{sim_code}"
   compressed_storage = f"../environment/frontend_server/compressed_storage/{sim_code}"
   persona_folder = sim_storage + "/personas"
-  move_folder = sim_storage + "/movement"
   meta_file = sim_storage + "/reverie/meta.json"
 
   persona_names = []
@@ -21,34 +25,32 @@ def compress(sim_code):
     if x[0] != ".": 
       persona_names += [x]
 
-  max_move_count = max([int(i.split("/")[-1].split(".")[0]) 
-                 for i in find_filenames(move_folder, "json")])
+  max_move_count = last_step(sim_storage, "movement")
   
   persona_last_move = dict()
   master_move = dict()  
   for i in range(max_move_count+1): 
     master_move[i] = dict()
-    with open(f"{move_folder}/{str(i)}.json") as json_file:  
-      i_move_dict = json.load(json_file)["persona"]
-      for p in persona_names: 
-        move = False
-        if i == 0: 
-          move = True
-        elif (i_move_dict[p]["movement"] != persona_last_move[p]["movement"]
-          or i_move_dict[p]["pronunciatio"] != persona_last_move[p]["pronunciatio"]
-          or i_move_dict[p]["description"] != persona_last_move[p]["description"]
-          or i_move_dict[p]["chat"] != persona_last_move[p]["chat"]): 
-          move = True
-
-        if move: 
-          persona_last_move[p] = {"movement": i_move_dict[p]["movement"],
-                                  "pronunciatio": i_move_dict[p]["pronunciatio"], 
-                                  "description": i_move_dict[p]["description"], 
-                                  "chat": i_move_dict[p]["chat"]}
-          master_move[i][p] = {"movement": i_move_dict[p]["movement"],
-                               "pronunciatio": i_move_dict[p]["pronunciatio"], 
-                               "description": i_move_dict[p]["description"], 
-                               "chat": i_move_dict[p]["chat"]}
+    i_move_dict = read_step(sim_storage, "movement", i)["persona"]
+    for p in persona_names: 
+      move = False
+      if i == 0: 
+        move = True
+      elif (i_move_dict[p]["movement"] != persona_last_move[p]["movement"]
+        or i_move_dict[p]["pronunciatio"] != persona_last_move[p]["pronunciatio"]
+        or i_move_dict[p]["description"] != persona_last_move[p]["description"]
+        or i_move_dict[p]["chat"] != persona_last_move[p]["chat"]): 
+        move = True
+
+      if move: 
+        persona_last_move[p] = {"movement": i_move_dict[p]["movement"],
+                                "pronunciatio": i_move_dict[p]["pronunciatio"], 
+                                "description": i_move_dict[p]["description"], 
+                                "chat": i_move_dict[p]["chat"]}
+        master_move[i][p] = {"movement": i_move_dict[p]["movement"],
+                             "pronunciatio": i_move_dict[p]["pronunciatio"], 
+                             "description": i_move_dict[p]["description"], 
+                             "chat": i_move_dict[p]["chat"]}
 
 
   create_folder_if_not_there(compressed_storage)